@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Motion blur gating from the T265 gyro         ##
+#####################################################
+# While the vehicle rotates fast, the fisheye images are smeared and AprilTag detection on them mostly
+# wastes CPU time. The blur is predicted from the angular velocity the T265 reports with each pose, the
+# exposure time of the frame and the focal length of the image the detector runs on:
+#   - rotation about the axes across the optical axis moves every pixel by about f * w * t_exp
+#   - rotation about the optical axis moves a pixel at radius r by about r * w * t_exp
+# Frames above soft_threshold_px are only searched in the predicted region of the tag, frames above
+# hard_threshold_px are not searched at all.
+#
+# With enforce=False the gate only observes, so running the same recording with and without enforcing
+# shows what the gating costs in detections and saves in CPU time (see report()).
+
+import math as m
+
+class BlurGate(object):
+    decisions = ('detect', 'roi_only', 'skip')
+
+    # focal_px, image_radius_px: of the image the detector runs on. default_exposure_sec: used when the
+    # camera does not report the exposure of the frame
+    def __init__(self, focal_px, image_radius_px, soft_threshold_px=1.5, hard_threshold_px=3.0, default_exposure_sec=0.008, enforce=True):
+        self.focal_px = focal_px
+        self.image_radius_px = image_radius_px
+        self.soft_threshold_px = soft_threshold_px
+        self.hard_threshold_px = hard_threshold_px
+        self.default_exposure_sec = default_exposure_sec
+        self.enforce = enforce
+
+        self.frames = dict.fromkeys(self.decisions, 0)
+        self.attempts = dict.fromkeys(self.decisions, 0)
+        self.detections = dict.fromkeys(self.decisions, 0)
+        self.cpu_time = dict.fromkeys(self.decisions, 0.0)
+        self.max_blur_px = 0.0
+        self.skip_start = None          # frame number of the first frame of the current run of skipped frames
+
+    # angular_velocity: (x, y, z) in rad/s in the camera frame (z along the optical axis)
+    def predict_blur_px(self, angular_velocity, exposure_sec=None):
+        if exposure_sec is None:
+            exposure_sec = self.default_exposure_sec
+        (wx, wy, wz) = angular_velocity
+        across = m.sqrt(wx * wx + wy * wy) * self.focal_px
+        around = abs(wz) * self.image_radius_px
+        return (across + around) * exposure_sec
+
+    # Decision for a frame with the predicted blur. The runs of skipped frames are logged when enforcing
+    def decide(self, blur_px, frame_number):
+        if blur_px > self.max_blur_px:
+            self.max_blur_px = blur_px
+        if blur_px > self.hard_threshold_px:
+            decision = 'skip'
+        elif blur_px > self.soft_threshold_px:
+            decision = 'roi_only'
+        else:
+            decision = 'detect'
+        self.frames[decision] += 1
+
+        if self.enforce:
+            if decision == 'skip' and self.skip_start is None:
+                self.skip_start = frame_number
+                print("INFO: Blur gate: skipping detection from frame %d, predicted blur %.1f px" % (frame_number, blur_px))
+            elif decision != 'skip' and self.skip_start is not None:
+                print("INFO: Blur gate: detection resumed at frame %d, %d frames skipped" % (frame_number, frame_number - self.skip_start))
+                self.skip_start = None
+        return decision
+
+    # Outcome of a frame: whether detection ran, whether it found the landing tag, and the CPU time it took
+    def record(self, decision, attempted, detected, cpu_time):
+        if attempted:
+            self.attempts[decision] += 1
+            self.cpu_time[decision] += cpu_time
+            if detected:
+                self.detections[decision] += 1
+
+    def report(self):
+        total_detections = sum(self.detections.values())
+        total_cpu_time = sum(self.cpu_time.values())
+        rate = total_detections / total_cpu_time if total_cpu_time > 0 else 0.0
+        lines = ["INFO: Blur gate (%s): %.1f landing tag detections per CPU second, max predicted blur %.1f px" %
+                 ("enforced" if self.enforce else "observing", rate, self.max_blur_px)]
+        for decision in self.decisions:
+            lines.append("INFO:     %-8s frames %d, detection attempts %d, detections %d, CPU time %.2f s" %
+                         (decision, self.frames[decision], self.attempts[decision], self.detections[decision], self.cpu_time[decision]))
+        return "\n".join(lines)
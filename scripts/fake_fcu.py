@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+#####################################################
+##     Simulated FCU for testing the bridges       ##
+#####################################################
+# A minimal stand-in for the flight controller end of the link, so that
+# t265_to_mavlink.py and t265_precland_apriltags.py can be run and measured
+# on any Linux box without hardware.
+#
+# The fake FCU:
+#   - sends HEARTBEAT, ATTITUDE, GPS_RAW_INT and RADIO_STATUS at fixed rates,
+#   - replies to TIMESYNC, PARAM_REQUEST_LIST/READ and autopilot capability requests
+#     (enough for dronekit's connect(wait_ready=True) to succeed),
+#   - optionally streams the telemetry a real FCU would (--stream_msg_hz), and honors
+#     REQUEST_DATA_STREAM and MAV_CMD_SET_MESSAGE_INTERVAL for it,
+#   - sends STATUSTEXT on the same events ArduPilot does (first vision data, origin/home set),
+#   - accepts VISION_POSITION_ESTIMATE, VISION_SPEED_ESTIMATE, VISION_POSITION_DELTA,
+#     LANDING_TARGET, SET_GPS_GLOBAL_ORIGIN and SET_HOME_POSITION,
+#   - records arrival rate, inter-arrival jitter, message age and duplicates per message type.
+#
+# Install required packages:
+#   pip3 install pymavlink
+#
+# Usage, over UDP:
+#   python3 fake_fcu.py --listen udpin:127.0.0.1:14555
+#   python3 t265_to_mavlink.py --connect udpout:127.0.0.1:14555
+# Usage, over a pseudo-terminal (behaves like the serial port on a real companion):
+#   python3 fake_fcu.py --pty /tmp/fake_fcu
+#   python3 t265_to_mavlink.py --connect /tmp/fake_fcu
+
+# Set MAVLink protocol to 2.
+import os
+os.environ["MAVLINK20"] = "1"
+
+import math as m
+import time
+import json
+import argparse
+import select
+import tty
+
+from pymavlink import mavutil
+
+#######################################
+# Parameters
+#######################################
+
+listen_string_default = 'udpin:127.0.0.1:14555'
+attitude_msg_hz_default = 10
+report_interval_sec_default = 5
+
+heartbeat_msg_hz = 1
+gps_raw_int_msg_hz = 1
+radio_status_msg_hz = 1
+
+# Same values as the defaults in the bridges, so that origin/home messages can be checked
+home_lat = 151269321
+home_lon = 16624301
+home_alt = 163000
+
+# A handful of parameters, just enough for dronekit to consider the parameter download complete
+fcu_params = {
+    'SYSID_THISMAV' : 1,
+    'EK2_GPS_TYPE'  : 3,
+    'VISO_TYPE'     : 1,
+    'PLND_ENABLED'  : 1,
+    'PLND_TYPE'     : 1,
+}
+
+# Timestamp field used to compute the age of each message type (all are in microseconds)
+msg_timestamp_fields = {
+    'VISION_POSITION_ESTIMATE'  : 'usec',
+    'VISION_SPEED_ESTIMATE'     : 'usec',
+    'VISION_POSITION_DELTA'     : 'time_usec',
+    'LANDING_TARGET'            : 'time_usec',
+}
+
+# Messages the bridges are expected to send, always listed in the report even when not received
+expected_msg_types = ('VISION_POSITION_ESTIMATE', 'VISION_SPEED_ESTIMATE', 'VISION_POSITION_DELTA',
+                      'LANDING_TARGET', 'SET_GPS_GLOBAL_ORIGIN', 'SET_HOME_POSITION')
+
+#######################################
+# Parsing user' inputs
+#######################################
+
+parser = argparse.ArgumentParser(description='Simulated flight controller for testing the T265 bridges')
+parser.add_argument('--listen',
+                    help="pymavlink connection string to listen on. If not specified, a default string will be used.")
+parser.add_argument('--pty',
+                    help="Create a pseudo-terminal and symlink its device to this path, instead of using --listen.")
+parser.add_argument('--attitude_msg_hz', type=float,
+                    help="Update frequency for ATTITUDE message. If not specified, a default value will be used.")
+parser.add_argument('--stream_msg_hz', type=float, default=0,
+                    help="Also stream typical telemetry (RAW_IMU, SYS_STATUS, VFR_HUD...) at this rate per message, as a real FCU does")
+parser.add_argument('--heading_deg', type=float, default=0,
+                    help="Yaw reported in ATTITUDE, in degrees")
+parser.add_argument('--report_interval', type=float,
+                    help="Interval between statistics reports on terminal, in seconds. If not specified, a default value will be used.")
+parser.add_argument('--report_file',
+                    help="Write the final per-message statistics to this file as JSON")
+parser.add_argument('--duration', type=float,
+                    help="Stop after this many seconds. If not specified, run until interrupted.")
+
+args = parser.parse_args()
+
+listen_string = args.listen
+pty_link = args.pty
+attitude_msg_hz = args.attitude_msg_hz
+report_interval = args.report_interval
+
+if not listen_string:
+    listen_string = listen_string_default
+
+if not attitude_msg_hz:
+    attitude_msg_hz = attitude_msg_hz_default
+print("INFO: Using attitude_msg_hz", attitude_msg_hz)
+
+if not report_interval:
+    report_interval = report_interval_sec_default
+
+#######################################
+# Link
+#######################################
+
+# pymavlink has no pty support, so we serve the master side of a pseudo-terminal ourselves.
+# The bridge opens the slave side through the symlink, exactly like a real serial port.
+class mavpty(mavutil.mavfile):
+    def __init__(self, link_path, source_system=1, source_component=1):
+        (master_fd, self.slave_fd) = os.openpty()
+        tty.setraw(master_fd)
+        tty.setraw(self.slave_fd)
+        self.link_path = link_path
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(os.ttyname(self.slave_fd), link_path)
+        mavutil.mavfile.__init__(self, master_fd, link_path, source_system=source_system, source_component=source_component)
+
+    def recv(self, n=None):
+        if n is None:
+            n = self.mav.bytes_needed()
+        (rin, win, xin) = select.select([self.fd], [], [], 0)
+        if not rin:
+            return b''
+        return os.read(self.fd, n)
+
+    def write(self, buf):
+        return os.write(self.fd, bytes(buf))
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.slave_fd)
+        if os.path.lexists(self.link_path):
+            os.remove(self.link_path)
+
+#######################################
+# Statistics
+#######################################
+
+# Per message type statistics. Inter-arrival mean and variance are updated with Welford's method
+# so the cost per message is constant regardless of how long the test runs.
+class msg_stats(object):
+    def __init__(self):
+        self.count = 0
+        self.first_arrival = None
+        self.last_arrival = None
+        self.dt_mean = 0.0
+        self.dt_m2 = 0.0
+        self.dt_max = 0.0
+        self.age_sum = 0.0
+        self.age_count = 0
+        self.age_max = 0.0
+        self.duplicates = 0
+        self.last_key = None
+
+    def update(self, arrival, age, key):
+        if self.last_arrival is not None:
+            dt = arrival - self.last_arrival
+            n = self.count      # number of intervals after this one
+            delta = dt - self.dt_mean
+            self.dt_mean += delta / n
+            self.dt_m2 += delta * (dt - self.dt_mean)
+            self.dt_max = max(self.dt_max, dt)
+        else:
+            self.first_arrival = arrival
+        self.last_arrival = arrival
+        self.count += 1
+
+        if age is not None:
+            self.age_sum += age
+            self.age_count += 1
+            self.age_max = max(self.age_max, age)
+
+        if key == self.last_key:
+            self.duplicates += 1
+        self.last_key = key
+
+    def summary(self):
+        intervals = self.count - 1
+        rate = intervals / (self.last_arrival - self.first_arrival) if intervals > 0 and self.last_arrival > self.first_arrival else 0.0
+        jitter = m.sqrt(self.dt_m2 / (intervals - 1)) if intervals > 1 else 0.0
+        return {
+            'count'         : self.count,
+            'rate_hz'       : rate,
+            'jitter_ms'     : jitter * 1e3,
+            'max_gap_ms'    : self.dt_max * 1e3,
+            'mean_age_ms'   : self.age_sum / self.age_count * 1e3 if self.age_count > 0 else None,
+            'max_age_ms'    : self.age_max * 1e3 if self.age_count > 0 else None,
+            'duplicates'    : self.duplicates,
+        }
+
+stats = {}
+
+def record_msg(msg):
+    arrival = time.time()
+    msg_type = msg.get_type()
+
+    age = None
+    key = bytes(msg.get_payload())
+    if msg_type in msg_timestamp_fields:
+        stamp_us = getattr(msg, msg_timestamp_fields[msg_type])
+        age = arrival - stamp_us * 1e-6
+        # A re-sent sample carries the same timestamp, even if the scheduler re-encoded it
+        key = stamp_us
+
+    if msg_type not in stats:
+        stats[msg_type] = msg_stats()
+    stats[msg_type].update(arrival, age, key)
+
+def print_report():
+    print("INFO: %-26s %7s %8s %10s %10s %11s %10s %5s" % ('message', 'count', 'rate_hz', 'jitter_ms', 'max_gap_ms', 'mean_age_ms', 'max_age_ms', 'dups'))
+    for msg_type in sorted(set(stats) | set(expected_msg_types)):
+        if msg_type not in stats:
+            print("INFO: %-26s %7d" % (msg_type, 0))
+            continue
+        s = stats[msg_type].summary()
+        age_mean = "%11.2f" % s['mean_age_ms'] if s['mean_age_ms'] is not None else "%11s" % '-'
+        age_max  = "%10.2f" % s['max_age_ms']  if s['max_age_ms']  is not None else "%10s" % '-'
+        print("INFO: %-26s %7d %8.2f %10.2f %10.2f %s %s %5d" % (msg_type, s['count'], s['rate_hz'], s['jitter_ms'], s['max_gap_ms'], age_mean, age_max, s['duplicates']))
+
+def write_report(path):
+    report = {msg_type: stats[msg_type].summary() for msg_type in stats}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("INFO: Statistics written to", path)
+
+#######################################
+# Functions for MAVLink
+#######################################
+
+boot_time = time.time()
+is_vision_received = False
+
+def time_boot_ms():
+    return int((time.time() - boot_time) * 1000)
+
+def send_statustext(text):
+    master.mav.statustext_send(mavutil.mavlink.MAV_SEVERITY_INFO, text.encode())
+    print("INFO: Sent STATUSTEXT:", text)
+
+def send_heartbeat():
+    master.mav.heartbeat_send(
+        mavutil.mavlink.MAV_TYPE_QUADROTOR,
+        mavutil.mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA,
+        mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+        0,                                      # custom_mode: STABILIZE
+        mavutil.mavlink.MAV_STATE_STANDBY
+    )
+
+def send_attitude():
+    master.mav.attitude_send(
+        time_boot_ms(),
+        0, 0, m.radians(args.heading_deg),      # roll, pitch, yaw
+        0, 0, 0                                 # rollspeed, pitchspeed, yawspeed
+    )
+
+def send_gps_raw_int():
+    master.mav.gps_raw_int_send(
+        int(time.time() * 1e6),
+        mavutil.mavlink.GPS_FIX_TYPE_NO_GPS,
+        0, 0, 0,                                # lat, lon, alt
+        65535, 65535, 65535, 65535,             # eph, epv, vel, cog: unknown
+        0                                       # satellites_visible
+    )
+
+def send_radio_status():
+    master.mav.radio_status_send(
+        200, 200,                               # rssi, remrssi
+        100,                                    # txbuf, in percent
+        50, 50,                                 # noise, remnoise
+        0, 0                                    # rxerrors, fixed
+    )
+
+# Telemetry the bridges do not use, but a real FCU streams by default
+def send_raw_imu():
+    master.mav.raw_imu_send(int(time.time() * 1e6), 0, 0, -1000, 0, 0, 0, 0, 0, 0)
+
+def send_scaled_pressure():
+    master.mav.scaled_pressure_send(time_boot_ms(), 1013.25, 0, 2500)
+
+def send_servo_output_raw():
+    master.mav.servo_output_raw_send(int(time.time() * 1e6) & 0xFFFFFFFF, 0, 1000, 1000, 1000, 1000, 0, 0, 0, 0)
+
+def send_rc_channels():
+    master.mav.rc_channels_send(time_boot_ms(), 8, *([1500] * 18 + [255]))
+
+def send_sys_status():
+    master.mav.sys_status_send(0, 0, 0, 500, 12000, -1, -1, 0, 0, 0, 0, 0, 0)
+
+def send_vfr_hud():
+    master.mav.vfr_hud_send(0, 0, int(args.heading_deg) % 360, 0, 0, 0)
+
+def send_global_position_int():
+    master.mav.global_position_int_send(time_boot_ms(), home_lat, home_lon, home_alt * 10, 0, 0, 0, 0, int(args.heading_deg * 100) % 36000)
+
+def send_param_value(name, index):
+    master.mav.param_value_send(
+        name.encode(),
+        float(fcu_params[name]),
+        mavutil.mavlink.MAV_PARAM_TYPE_REAL32,
+        len(fcu_params),
+        index
+    )
+
+def handle_msg(msg):
+    global is_vision_received
+    msg_type = msg.get_type()
+
+    if msg_type == 'BAD_DATA':
+        return
+
+    record_msg(msg)
+
+    if msg_type == 'TIMESYNC':
+        # tc1 == 0 is a request, reply with our own clock in nanoseconds
+        if msg.tc1 == 0:
+            master.mav.timesync_send(int(time.time() * 1e9), msg.ts1)
+
+    elif msg_type == 'PARAM_REQUEST_LIST':
+        if msg.target_component in (0, master.mav.srcComponent):
+            for index, name in enumerate(sorted(fcu_params)):
+                send_param_value(name, index)
+
+    elif msg_type == 'PARAM_REQUEST_READ':
+        if msg.target_component in (0, master.mav.srcComponent):
+            names = sorted(fcu_params)
+            name = msg.param_id if msg.param_index < 0 else (names[msg.param_index] if msg.param_index < len(names) else None)
+            if name in fcu_params:
+                send_param_value(name, names.index(name))
+
+    elif msg_type == 'REQUEST_DATA_STREAM':
+        if msg.req_stream_id == mavutil.mavlink.MAV_DATA_STREAM_ALL and msg.start_stop == 0:
+            for msg_name in stream_msg_names:
+                periodic_msgs.pop(msg_name, None)
+            print("INFO: All data streams stopped on request")
+
+    elif msg_type == 'COMMAND_LONG':
+        master.mav.command_ack_send(msg.command, mavutil.mavlink.MAV_RESULT_ACCEPTED)
+        if msg.command == mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+            set_message_interval(int(msg.param1), msg.param2)
+        if msg.command == mavutil.mavlink.MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES:
+            master.mav.autopilot_version_send(
+                mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_MAVLINK2 | mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_SET_POSITION_TARGET_LOCAL_NED,
+                0, 0, 0, 0,                     # flight_sw_version, middleware_sw_version, os_sw_version, board_version
+                [0] * 8, [0] * 8, [0] * 8,      # custom versions
+                0, 0, 0                         # vendor_id, product_id, uid
+            )
+
+    elif msg_type in ('VISION_POSITION_ESTIMATE', 'VISION_POSITION_DELTA'):
+        if not is_vision_received:
+            is_vision_received = True
+            # Same text ArduPilot sends, the precision landing script uses it as the trigger to set EKF home
+            send_statustext('EKF2 IMU1 ext nav yaw alignment complete')
+
+    elif msg_type == 'SET_GPS_GLOBAL_ORIGIN':
+        if (msg.latitude, msg.longitude, msg.altitude) != (home_lat, home_lon, home_alt):
+            print("WARNING: Origin differs from the bridge defaults:", msg.latitude, msg.longitude, msg.altitude)
+        master.mav.gps_global_origin_send(msg.latitude, msg.longitude, msg.altitude)
+        send_statustext('EKF2 IMU1 origin set')
+
+    elif msg_type == 'SET_HOME_POSITION':
+        master.mav.home_position_send(msg.latitude, msg.longitude, msg.altitude,
+                                      msg.x, msg.y, msg.z, msg.q,
+                                      msg.approach_x, msg.approach_y, msg.approach_z)
+
+# MAV_CMD_SET_MESSAGE_INTERVAL: interval in us, -1 to stop, 0 for the default rate
+def set_message_interval(msg_id, interval_us):
+    if msg_id not in mavutil.mavlink.mavlink_map:
+        return
+    msg_name = mavutil.mavlink.mavlink_map[msg_id].msgname
+    if msg_name not in msg_senders:
+        print("WARNING: Streaming", msg_name, "is not supported")
+        return
+    if interval_us < 0:
+        periodic_msgs.pop(msg_name, None)
+        print("INFO: Stopped streaming", msg_name)
+    else:
+        period = interval_us * 1e-6 if interval_us > 0 else msg_senders[msg_name][1]
+        periodic_msgs[msg_name] = [msg_senders[msg_name][0], period, 0]
+        print("INFO: Streaming", msg_name, "at", 1 / period, "Hz")
+
+#######################################
+# Main code starts here
+#######################################
+
+if pty_link:
+    master = mavpty(pty_link)
+    print("INFO: Listening on pseudo-terminal", pty_link, "->", os.ttyname(master.slave_fd))
+else:
+    master = mavutil.mavlink_connection(listen_string, source_system=1, source_component=1)
+    print("INFO: Listening on", listen_string)
+
+# Outgoing messages that can be sent periodically, as message name: (function, default period)
+msg_senders = {
+    'HEARTBEAT'             : (send_heartbeat,          1.0 / heartbeat_msg_hz),
+    'ATTITUDE'              : (send_attitude,           1.0 / attitude_msg_hz),
+    'GPS_RAW_INT'           : (send_gps_raw_int,        1.0 / gps_raw_int_msg_hz),
+    'RADIO_STATUS'          : (send_radio_status,       1.0 / radio_status_msg_hz),
+}
+extra_stream_senders = {
+    'RAW_IMU'               : send_raw_imu,
+    'SCALED_PRESSURE'       : send_scaled_pressure,
+    'SERVO_OUTPUT_RAW'      : send_servo_output_raw,
+    'RC_CHANNELS'           : send_rc_channels,
+    'SYS_STATUS'            : send_sys_status,
+    'VFR_HUD'               : send_vfr_hud,
+    'GLOBAL_POSITION_INT'   : send_global_position_int,
+}
+if args.stream_msg_hz > 0:
+    for (msg_name, func) in extra_stream_senders.items():
+        msg_senders[msg_name] = (func, 1.0 / args.stream_msg_hz)
+
+# Messages that belong to a data stream, as opposed to HEARTBEAT from the autopilot and RADIO_STATUS from the radio
+stream_msg_names = set(msg_senders) - set(['HEARTBEAT', 'RADIO_STATUS'])
+
+# Periodic outgoing messages, as message name: [function, period, next due time]
+periodic_msgs = {msg_name: [func, period, 0] for (msg_name, (func, period)) in msg_senders.items()}
+
+start_time = time.time()
+next_report_time = start_time + report_interval
+
+try:
+    while True:
+        now = time.time()
+
+        if args.duration and now - start_time > args.duration:
+            break
+
+        for periodic_msg in list(periodic_msgs.values()):
+            if now >= periodic_msg[2]:
+                # With udpin, there is nobody to send to until the bridge has sent something
+                try:
+                    periodic_msg[0]()
+                except OSError:
+                    pass
+                periodic_msg[2] = max(periodic_msg[2] + periodic_msg[1], now)
+
+        if now >= next_report_time:
+            print_report()
+            next_report_time += report_interval
+
+        # Drain everything received, then sleep until the next periodic message is due
+        msg = master.recv_msg()
+        while msg is not None:
+            handle_msg(msg)
+            msg = master.recv_msg()
+
+        timeout = min(p[2] for p in periodic_msgs.values()) - time.time()
+        master.select(max(0.0, min(timeout, 0.01)))
+
+except KeyboardInterrupt:
+    print("INFO: KeyboardInterrupt has been caught. Cleaning up...")
+
+finally:
+    print_report()
+    if args.report_file:
+        write_report(args.report_file)
+    master.close()
+    print("INFO: Fake FCU closed.")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Per-consumer views of the fisheye streams     ##
+#####################################################
+# Both fisheye streams arrive at 848x800, but each consumer only needs part of one of them at a lower
+# resolution: the tag detector a 90 degree view at 300x300, stereo depth a 150 px high pair, the viewer
+# about what the tag detector sees. On small ARM boards memory bandwidth, not arithmetic, limits the image
+# stage, so the whole frames are never copied: every consumer gets a grayscale view sized for it, computed
+# from the librealsense buffers at most once per frame, and only the views are copied between processes.
+#
+# Two kinds of views:
+#   - rectified: the undistort/rectify maps go straight from the raw stream to the geometry of the consumer,
+#     so cropping, downsampling and rectification are a single pass over the pixels the consumer needs
+#   - raw: a crop of the raw stream, downsampled by an integer factor, for consumers that work in the fisheye
+#     image (raw tag detection) or rectify themselves (the viewer). The camera matrix of the view goes with
+#     it, so maps and undistortion built from it fold the crop and the downsampling in
+# A raw view of the whole frame at full resolution is a reference to the librealsense buffer, and is only
+# copied when asked for.
+#
+# Time and size per frame of the views of t265_precland_apriltags.py, against copying the whole frames:
+#   python3 fisheye_frontend.py --calib ../cfg/t265.yaml
+
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+import fisheye_rectify
+
+def gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+# Camera matrix of the raw view that starts at (x0, y0) and is downsampled by scale
+def view_camera_matrix(K, x0, y0, scale=1):
+    K = np.array(K, dtype=np.float64)
+    # The view pixel u covers the raw pixels x0 + scale * u to x0 + scale * (u + 1) - 1
+    K[0, 2] = (K[0, 2] - x0 - (scale - 1) / 2) / scale
+    K[1, 2] = (K[1, 2] - y0 - (scale - 1) / 2) / scale
+    K[0, 0] /= scale
+    K[0, 1] /= scale
+    K[1, 1] /= scale
+    return K
+
+# crop: (x0, y0, x1, y1) with its size a multiple of scale
+def raw_view(image, crop, scale, copy):
+    (x0, y0, x1, y1) = crop
+    image = image[y0:y1, x0:x1]
+    if scale > 1:
+        # INTER_AREA averages each scale x scale block, no aliasing and a single pass
+        return gray(cv2.resize(image, ((x1 - x0) // scale, (y1 - y0) // scale), interpolation = cv2.INTER_AREA))
+    image = gray(image)
+    return image.copy() if copy else image
+
+class FisheyeFrontEnd(object):
+    # raw_size: (width, height) of the fisheye streams
+    def __init__(self, raw_size):
+        self.raw_size = raw_size
+        self.views = {}             # name: (side, shape, function of the raw image)
+        self.produce_count = {}
+
+    # View rectified with maps, e.g. from fisheye_rectify.build_maps, of the raw image of side
+    def add_rectified(self, name, side, maps):
+        self.views[name] = (side, maps[0].shape[:2], lambda image: gray(fisheye_rectify.remap(image, maps)))
+        self.produce_count[name] = 0
+
+    # View of the region crop (x0, y0, x1, y1) of the raw image of side, None for all of it, downsampled by the
+    # integer scale. copy: a full-resolution view is a copy, not a reference to the raw image.
+    # Returns the camera matrix of the view, from K of the raw image
+    def add_raw(self, name, side, K, crop=None, scale=1, copy=False):
+        (x0, y0, x1, y1) = (0, 0) + tuple(self.raw_size) if crop is None else crop
+        # Whole blocks of scale x scale pixels
+        x1 = x0 + (x1 - x0) // scale * scale
+        y1 = y0 + (y1 - y0) // scale * scale
+        crop = (x0, y0, x1, y1)
+        self.views[name] = (side, ((y1 - y0) // scale, (x1 - x0) // scale), lambda image: raw_view(image, crop, scale, copy))
+        self.produce_count[name] = 0
+        return view_camera_matrix(K, x0, y0, scale)
+
+    # (height, width) of a view
+    def shape(self, name):
+        return self.views[name][1]
+
+    def produce(self, name, raw_image):
+        self.produce_count[name] += 1
+        return self.views[name][2](raw_image)
+
+    # Producers of the views for pipeline_utils.ProductGraph, whose sources are raw_left and raw_right
+    def producers(self):
+        return {name: (lambda name: lambda products: self.produce(name, products.get("raw_" + self.views[name][0])))(name)
+                for name in self.views}
+
+    def report(self):
+        (width, height) = self.raw_size
+        lines = ["INFO: Front-end views of the %dx%d fisheye frames (%d kB each):" % (width, height, width * height // 1024)]
+        for (name, (side, shape, function)) in self.views.items():
+            lines.append("INFO:     %-16s %-5s %4dx%-4d %5d kB, produced %d times" %
+                         (name, side, shape[1], shape[0], shape[0] * shape[1] // 1024, self.produce_count[name]))
+        return "\n".join(lines)
+
+if __name__ == "__main__":
+    import fisheye_tag_detection
+
+    parser = argparse.ArgumentParser(description='Measures the front-end views against copies of the whole fisheye frames')
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml")
+    parser.add_argument('--viewer_scale', type=int, default=2,
+                        help="Downsampling of the raw view of the viewer")
+    parser.add_argument('--iterations', type=int, default=200,
+                        help="Frames per measurement")
+    args = parser.parse_args()
+
+    calib = fisheye_rectify.load_calibration(args.calib)
+    (width, height) = calib["input"]
+    random = np.random.RandomState(0)
+    raw = {"left": random.randint(0, 256, (height, width)).astype(np.uint8),
+           "right": random.randint(0, 256, (height, width)).astype(np.uint8)}
+    tag_geometry = fisheye_rectify.RectifyGeometry(300, 90)
+    stereo_geometry = fisheye_rectify.RectifyGeometry(150, 90, pad_left_px = 32)
+    baseline = calib["T"][0]
+
+    front_end = FisheyeFrontEnd((width, height))
+    front_end.add_rectified("tag_rectified", "right", fisheye_rectify.build_maps(calib["K2"], calib["D2"], calib["R"],
+                            tag_geometry.projection_matrix(), tag_geometry.size()))
+    front_end.add_rectified("stereo_left", "left", fisheye_rectify.build_maps(calib["K1"], calib["D1"], np.eye(3),
+                            stereo_geometry.projection_matrix(), stereo_geometry.size()))
+    front_end.add_rectified("stereo_right", "right", fisheye_rectify.build_maps(calib["K2"], calib["D2"], calib["R"],
+                            stereo_geometry.projection_matrix(baseline), stereo_geometry.size()))
+    crop = fisheye_tag_detection.raw_crop(calib["K2"], calib["D2"], calib["R"], tag_geometry, (width, height))
+    front_end.add_raw("tag_raw", "right", calib["K2"], crop)
+    front_end.add_raw("viewer", "right", calib["K2"], crop, args.viewer_scale)
+
+    # What the stereo worker and the viewer were handed before: a copy of the whole frame into shared memory
+    buffer = np.empty_like(raw["right"])
+    measurements = [("whole frame copy", lambda: np.copyto(buffer, raw["right"]) or buffer)]
+    for name in front_end.views:
+        measurements.append((name, (lambda name: lambda: front_end.produce(name, raw[front_end.views[name][0]]))(name)))
+
+    print("INFO: %dx%d fisheye frames, %d iterations" % (width, height, args.iterations))
+    print("%-18s %-10s %8s %10s" % ("view", "size", "kB", "ms/frame"))
+    for (name, produce) in measurements:
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            view = produce()
+        elapsed = (time.perf_counter() - start) / args.iterations
+        print("%-18s %-10s %8d %10.3f" % (name, "%dx%d" % (view.shape[1], view.shape[0]), view.nbytes // 1024, elapsed * 1e3))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Fisheye rectification maps for the T265       ##
+#####################################################
+# The undistort/rectify maps are computed once and then used by cv2.remap on every frame, which is a
+# large share of the per-frame cost on ARM companion computers. Two things can keep that cost down:
+#   - Fixed-point maps (CV_16SC2 plus an interpolation table) instead of float maps (CV_32FC1): a quarter
+#     less memory to stream through per output pixel, at a precision of 1/32 pixel. On x86 they remap
+#     slower at every size (e.g. 4.3 ms against 2.2 ms at 800x800, 0.61 against 0.45 ms at 300x300), and
+#     they have not been measured on an ARM board yet, so float maps are the default: benchmark on the
+#     target board before switching
+#   - Each consumer gets the output geometry it needs (resolution, field of view, padding), e.g. the tag
+#     detector does not need the extra columns that stereo matching needs for valid disparities.
+#
+# Building the maps takes a while and a lot of temporary memory on small boards, so they can be cached
+# on disk as .npy files, keyed by a hash of the calibration and output geometry. On the next start they
+# are memory-mapped instead of recomputed; a changed calibration gives a different key, and the stale
+# files of the same consumer are removed.
+#
+# Run this file to benchmark the variants per frame on the calibration of cfg/t265.yaml:
+#   python3 fisheye_rectify.py --calib ../cfg/t265.yaml
+
+import os
+import glob
+import hashlib
+import math as m
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+map_types = {"float": cv2.CV_32FC1, "fixed": cv2.CV_16SC2}
+
+# Output geometry of a rectified image: a pinhole camera with the given vertical field of view.
+# pad_left_px adds columns on the left, the principal point stays on the center of the unpadded image.
+class RectifyGeometry(object):
+    def __init__(self, height_px=300, fov_deg=90, width_px=None, pad_left_px=0):
+        self.height_px = height_px
+        self.width_px = height_px if width_px is None else width_px
+        self.fov_deg = fov_deg
+        self.pad_left_px = pad_left_px
+
+    # We calculate the undistorted focal length:
+    #
+    #         h
+    # -----------------
+    #  \      |      /
+    #    \    | f  /
+    #     \   |   /
+    #      \ fov /
+    #        \|/
+    def focal_px(self):
+        return self.height_px / 2 / m.tan(m.radians(self.fov_deg) / 2)
+
+    def size(self):
+        return (self.width_px + self.pad_left_px, self.height_px)
+
+    def principal_point(self):
+        return ((self.width_px - 1) / 2 + self.pad_left_px, (self.height_px - 1) / 2)
+
+    # For the right camera of a stereo pair, the projection matrix is shifted by baseline * focal_length
+    def projection_matrix(self, baseline=0):
+        f = self.focal_px()
+        (cx, cy) = self.principal_point()
+        return np.array([[f, 0, cx, baseline * f],
+                         [0, f, cy, 0],
+                         [0, 0,  1, 0]])
+
+    # Camera parameters as expected by the AprilTag detector: [fx, fy, cx, cy]
+    def camera_params(self):
+        f = self.focal_px()
+        (cx, cy) = self.principal_point()
+        return [f, f, cx, cy]
+
+    def __repr__(self):
+        return "%dx%d px, fov %g deg, padding %d px" % (self.width_px, self.height_px, self.fov_deg, self.pad_left_px)
+
+# Undistort/rectify maps of one camera. R: rotation applied to the camera, P: from RectifyGeometry
+def build_maps(K, D, R, P, size, map_type=cv2.CV_32FC1):
+    return cv2.fisheye.initUndistortRectifyMap(K, D, R, P, size, map_type)
+
+# Key of the maps: everything they are computed from, and the OpenCV version that computed them
+def maps_key(K, D, R, P, size, map_type):
+    h = hashlib.sha1()
+    for a in (K, D, R, P):
+        h.update(np.ascontiguousarray(a, dtype=np.float64).tobytes())
+    h.update(repr((tuple(size), map_type, cv2.__version__)).encode())
+    return h.hexdigest()[:16]
+
+# Expected shapes and types, to validate the cached files
+def maps_layout(size, map_type):
+    (width, height) = size
+    if map_type == cv2.CV_16SC2:
+        return (((height, width, 2), np.int16), ((height, width), np.uint16))
+    return (((height, width), np.float32), ((height, width), np.float32))
+
+# Same as build_maps, through the cache in cache_dir. name identifies the consumer (e.g. "tag"), its
+# maps with any other key are stale and get removed. The returned maps are read-only memory maps.
+def cached_maps(cache_dir, name, K, D, R, P, size, map_type=cv2.CV_32FC1):
+    key = maps_key(K, D, R, P, size, map_type)
+    paths = [os.path.join(cache_dir, "%s_%s.map%d.npy" % (name, key, i)) for i in (1, 2)]
+
+    try:
+        maps = tuple(np.load(path, mmap_mode='r') for path in paths)
+        if all(a.shape == shape and a.dtype == dtype for (a, (shape, dtype)) in zip(maps, maps_layout(size, map_type))):
+            return maps
+        print("WARNING: Cached rectification maps", paths[0], "do not match, rebuilding")
+    except (IOError, ValueError, EOFError):
+        pass
+
+    maps = build_maps(K, D, R, P, size, map_type)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale_path in glob.glob(os.path.join(cache_dir, name + "_*.npy")):
+            if stale_path not in paths:
+                os.remove(stale_path)
+        # Write to a temporary file first, so a crash never leaves a half-written file behind
+        for (a, path) in zip(maps, paths):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, a)
+            os.replace(tmp_path, path)
+    except OSError as e:
+        print("WARNING: Could not cache rectification maps in", cache_dir, ":", e)
+    return maps
+
+def remap(image, maps, interpolation=cv2.INTER_LINEAR):
+    return cv2.remap(src = image, map1 = maps[0], map2 = maps[1], interpolation = interpolation)
+
+# Calibration of both cameras in the format of cfg/t265.yaml
+def load_calibration(path):
+    fs = cv2.FileStorage(path, cv2.FILE_STORAGE_READ)
+    if not fs.isOpened():
+        raise IOError("Cannot open calibration file " + path)
+    calib = {name: fs.getNode(name).mat() for name in ("K1", "D1", "K2", "D2", "R")}
+    # Plain sequences, not opencv-matrix
+    sequence = lambda node: [node.at(i).real() for i in range(node.size())]
+    calib["T"] = np.array(sequence(fs.getNode("T")))
+    calib["input"] = tuple(int(v) for v in sequence(fs.getNode("input")))
+    calib["output"] = tuple(int(v) for v in sequence(fs.getNode("output")))
+    fs.release()
+    return calib
+
+# Build and remap time of each geometry and map type, per frame, and the difference of the fixed-point
+# output to the float output. image: a raw fisheye frame
+def benchmark(image, K, D, geometries, iterations=100):
+    results = []
+    for (name, geometry) in geometries.items():
+        P = geometry.projection_matrix()
+        outputs = {}
+        for (type_name, map_type) in map_types.items():
+            start = time.perf_counter()
+            maps = build_maps(K, D, np.eye(3), P, geometry.size(), map_type)
+            build_time = time.perf_counter() - start
+
+            remap_times = []
+            for i in range(iterations):
+                start = time.perf_counter()
+                outputs[type_name] = remap(image, maps)
+                remap_times.append(time.perf_counter() - start)
+            remap_times.sort()
+
+            map_bytes = maps[0].nbytes + maps[1].nbytes
+            results.append({"geometry": name, "map_type": type_name, "size": geometry.size(),
+                            "build_ms": build_time * 1e3, "map_kb": map_bytes / 1024,
+                            "remap_mean_ms": sum(remap_times) / iterations * 1e3,
+                            "remap_p95_ms": remap_times[int(0.95 * (iterations - 1))] * 1e3})
+        diff = np.abs(outputs["fixed"].astype(np.int16) - outputs["float"].astype(np.int16))
+        results[-1]["max_diff"] = int(diff.max())
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks fisheye rectification maps per frame')
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml")
+    parser.add_argument('--image', type=str,
+                        help="Raw fisheye image to remap. If not specified, a synthetic image is used.")
+    parser.add_argument('--iterations', type=int, default=100,
+                        help="Number of frames remapped per variant")
+    args = parser.parse_args()
+
+    calib = load_calibration(args.calib)
+    (width, height) = calib["input"]
+    if args.image:
+        image = cv2.imread(args.image, cv2.IMREAD_GRAYSCALE)
+    else:
+        # Noise has no structure the remap could benefit from, which makes for a fair worst case
+        image = np.random.RandomState(0).randint(0, 256, (height, width)).astype(np.uint8)
+
+    geometries = {"tag 300":          RectifyGeometry(300, 90),
+                  "stereo 300+112":   RectifyGeometry(300, 90, pad_left_px=112),
+                  "tag 200":          RectifyGeometry(200, 90),
+                  "tag 400":          RectifyGeometry(400, 90),
+                  "cfg output":       RectifyGeometry(calib["output"][1], 90, width_px=calib["output"][0])}
+
+    print("INFO: Remapping %dx%d fisheye frames, %d iterations per variant" % (width, height, args.iterations))
+    print("%-16s %-6s %-10s %9s %9s %10s %10s %8s" % ("geometry", "maps", "size", "build ms", "maps kB", "remap ms", "p95 ms", "max diff"))
+    for r in benchmark(image, calib["K1"], calib["D1"], geometries, args.iterations):
+        print("%-16s %-6s %-10s %9.1f %9.0f %10.3f %10.3f %8s" % (r["geometry"], r["map_type"], "%dx%d" % r["size"],
+              r["build_ms"], r["map_kb"], r["remap_mean_ms"], r["remap_p95_ms"], r.get("max_diff", "")))
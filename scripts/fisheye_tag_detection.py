@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   AprilTag detection on raw fisheye images      ##
+#####################################################
+# Instead of rectifying the whole image and detecting tags in it, the detector runs on the raw fisheye image
+# (cropped to the field of view of interest), and only the four corners of each tag are undistorted, into the
+# same rectified camera the remap path would use. The pose of the tag is then solved from those corners, so
+# both paths give the same kind of result and one full-frame remap per frame is saved.
+#
+# The detector finds the quads by fitting straight lines to the edges, which the fisheye distortion bends.
+# That is negligible for tags that are small in the image, less so for large tags near the edge of the image:
+# run this file to compare accuracy and latency of both paths across the field of view, on tags rendered
+# with the calibration of cfg/t265.yaml:
+#   python3 fisheye_tag_detection.py --calib ../cfg/t265.yaml
+
+import math as m
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+import fisheye_rectify
+
+# Corners of a tag in the tag frame, in the order returned by the detector (see estimate_tag_pose of apriltag)
+def tag_object_points(tag_size):
+    s = tag_size / 2
+    return np.array([[-s,  s, 0],
+                     [ s,  s, 0],
+                     [ s, -s, 0],
+                     [-s, -s, 0]])
+
+def camera_params_matrix(camera_params):
+    (fx, fy, cx, cy) = camera_params
+    return np.array([[fx, 0, cx],
+                     [0, fy, cy],
+                     [0,  0,  1]])
+
+# The detector puts the origin of the image at the top left corner of the first pixel, OpenCV (and the
+# calibration) at its center: a point at (x, y) for the detector is at (x - 0.5, y - 0.5) for OpenCV
+def opencv_points(detector_points):
+    return np.asarray(detector_points, dtype=np.float64) - 0.5
+
+def detector_points(opencv_points):
+    return np.asarray(opencv_points, dtype=np.float64) + 0.5
+
+# [fx, fy, cx, cy] of an OpenCV camera, for the pose estimation of the detector
+def detector_camera_params(camera_params):
+    (fx, fy, cx, cy) = camera_params
+    return [fx, fy, cx + 0.5, cy + 0.5]
+
+# Pose of a tag from its corners, as returned by the detector, in an undistorted image with the given
+# [fx, fy, cx, cy]. Returns (pose_R, pose_t, mean reprojection error in pixels)
+def solve_tag_pose(corners, camera_params, tag_size):
+    object_points = tag_object_points(tag_size)
+    K = camera_params_matrix(camera_params)
+    corners = opencv_points(corners)
+    (ok, rvec, tvec) = cv2.solvePnP(object_points, corners.reshape(-1, 1, 2), K, None, flags = cv2.SOLVEPNP_IPPE_SQUARE)
+    projected = cv2.projectPoints(object_points, rvec, tvec, K, None)[0].reshape(-1, 2)
+    error = np.mean(np.linalg.norm(projected - corners, axis=1))
+    return (cv2.Rodrigues(rvec)[0], tvec, error)
+
+# Bounding box (x0, y0, x1, y1) of the raw fisheye pixels seen by a rectified image of the given geometry,
+# taken along the border of the rectified image. R: rotation of the rectified camera, as for the maps
+def raw_crop(K, D, R, geometry, raw_size, margin_px=8):
+    (width, height) = geometry.size()
+    steps = 32
+    border = np.concatenate([np.column_stack((np.linspace(0, width - 1, steps), np.zeros(steps))),
+                             np.column_stack((np.linspace(0, width - 1, steps), np.full(steps, height - 1))),
+                             np.column_stack((np.zeros(steps), np.linspace(0, height - 1, steps))),
+                             np.column_stack((np.full(steps, width - 1), np.linspace(0, height - 1, steps)))])
+    (fx, fy, cx, cy) = geometry.camera_params()
+    rays = np.column_stack(((border[:, 0] - cx) / fx, (border[:, 1] - cy) / fy, np.ones(len(border))))
+    # Back into the raw camera frame
+    rays = rays.dot(np.asarray(R))
+    normalized = (rays[:, :2] / rays[:, 2:]).reshape(-1, 1, 2)
+    raw = cv2.fisheye.distortPoints(normalized, K, D).reshape(-1, 2)
+    x0 = int(max(0, m.floor(raw[:, 0].min()) - margin_px))
+    y0 = int(max(0, m.floor(raw[:, 1].min()) - margin_px))
+    x1 = int(min(raw_size[0], m.ceil(raw[:, 0].max()) + margin_px + 1))
+    y1 = int(min(raw_size[1], m.ceil(raw[:, 1].max()) + margin_px + 1))
+    return (x0, y0, x1, y1)
+
+class RawFisheyeDetector(object):
+    # detector: apriltags3.Detector. K, D: raw fisheye calibration. R, camera_params: the rectified camera the
+    # corners and poses are expressed in. crop: (x0, y0, x1, y1) of the raw image to search, None for all of it
+    def __init__(self, detector, K, D, R, camera_params, crop=None):
+        self.detector = detector
+        self.K = K
+        self.D = D
+        self.R = R
+        self.camera_params = camera_params
+        self.P = camera_params_matrix(camera_params)
+        self.crop = crop
+
+    # Points of the raw image to the rectified image, both in the coordinates of the detector
+    def undistort(self, raw_points):
+        raw_points = opencv_points(raw_points).reshape(-1, 1, 2)
+        return detector_points(cv2.fisheye.undistortPoints(raw_points, self.K, self.D, R = self.R, P = self.P).reshape(-1, 2))
+
+    # Same result as apriltags3.Detector.detect on the rectified image
+    def detect(self, raw_image, tag_size, estimate_tag_pose=True):
+        (x0, y0) = (0, 0)
+        if self.crop is not None:
+            (x0, y0, x1, y1) = self.crop
+            # No copy, the detector copies the rows into its own image anyway
+            raw_image = raw_image[y0:y1, x0:x1]
+
+        tags = self.detector.detect(raw_image, False)
+        for tag in tags:
+            tag.corners = self.undistort(tag.corners + (x0, y0))
+            tag.center = self.undistort(np.asarray(tag.center) + (x0, y0))[0]
+            if estimate_tag_pose:
+                (tag.pose_R, tag.pose_t, tag.pose_err) = solve_tag_pose(tag.corners, self.camera_params, tag_size)
+        return tags
+
+#######################################
+# Accuracy and latency comparison
+#######################################
+
+# Raw fisheye image of a tag texture (with its white border) lying on a plane at pose H_camera_tag.
+# tag_size: size of the black square, which is texture_tag_px pixels wide in the texture
+# rays: from camera_rays, to render many images with the same camera
+def render_tag(K, D, raw_size, H_camera_tag, texture, texture_tag_px, tag_size, background=128, rays=None):
+    (width, height) = raw_size
+    if rays is None:
+        rays = camera_rays(K, D, raw_size)
+
+    # Intersect the rays with the plane of the tag, then express the points in the tag frame
+    R = H_camera_tag[:3, :3]
+    c = H_camera_tag[:3, 3]
+    n = R[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        depth = n.dot(c) / rays.dot(n)
+    points = (rays * depth[:, None] - c).dot(R)
+
+    # Tag frame (x right, y up as in tag_object_points) to texture pixels
+    scale = texture_tag_px / tag_size
+    center = (texture.shape[1] - 1) / 2
+    map_x = (center + points[:, 0] * scale).reshape(height, width).astype(np.float32)
+    map_y = (center - points[:, 1] * scale).reshape(height, width).astype(np.float32)
+    behind = ~(depth > 0).reshape(height, width)
+    map_x[behind] = -1
+    map_y[behind] = -1
+    return cv2.remap(texture, map_x, map_y, cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT, borderValue = background)
+
+# Ray of each pixel of the raw image, (width * height, 3) with z = 1
+def camera_rays(K, D, raw_size):
+    (width, height) = raw_size
+    (u, v) = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+    pixels = np.column_stack((u.ravel(), v.ravel())).reshape(-1, 1, 2)
+    normalized = cv2.fisheye.undistortPoints(pixels, K, D).reshape(-1, 2)
+    return np.column_stack((normalized, np.ones(len(normalized))))
+
+# Texture of a tag36h11 tag with its white border, upright: rendered by render_tag with the rotation
+# diag(1, -1, -1), the pose estimated by the detector has no rotation
+def tag_texture(tag_id, tag_px=160):
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    # The aruco markers of the AprilTag dictionaries are rotated by 180 degrees
+    tag = np.rot90(cv2.aruco.generateImageMarker(dictionary, tag_id, tag_px), 2).copy()
+    border = tag_px // 8
+    return cv2.copyMakeBorder(tag, border, border, border, border, cv2.BORDER_CONSTANT, value = 255)
+
+def compare(detector, calib, geometry, tag_size, distances, angles_deg, iterations):
+    K = calib["K1"]
+    D = calib["D1"]
+    raw_size = calib["input"]
+    R = np.eye(3)
+    camera_params = geometry.camera_params()
+    maps = fisheye_rectify.build_maps(K, D, R, geometry.projection_matrix(), geometry.size())
+    crop = raw_crop(K, D, R, geometry, raw_size)
+    raw_detectors = {"raw": RawFisheyeDetector(detector, K, D, R, camera_params),
+                     "raw crop": RawFisheyeDetector(detector, K, D, R, camera_params, crop)}
+    texture = tag_texture(0)
+    texture_tag_px = texture.shape[1] * 8 // 10
+
+    def remap_path(image):
+        return detector.detect(fisheye_rectify.remap(image, maps), True, detector_camera_params(camera_params), tag_size)
+
+    paths = {"remap": remap_path}
+    for (name, raw_detector) in raw_detectors.items():
+        paths[name] = (lambda raw_detector: lambda image: raw_detector.detect(image, tag_size))(raw_detector)
+
+    print("INFO: Raw crop for the %s rectified view: %s" % (geometry, crop))
+    print("%-8s %-9s %-9s %10s %10s %10s" % ("dist m", "angle deg", "path", "found", "err mm", "ms/frame"))
+    for distance in distances:
+        for angle_deg in angles_deg:
+            # Tag facing the camera, off the optical axis along the diagonal of the image
+            angle = m.radians(angle_deg)
+            direction = np.array([m.sin(angle) / m.sqrt(2), m.sin(angle) / m.sqrt(2), m.cos(angle)])
+            H_camera_tag = np.eye(4)
+            H_camera_tag[:3, :3] = np.diag([1.0, -1.0, -1.0])
+            H_camera_tag[:3, 3] = direction * distance
+            image = render_tag(K, D, raw_size, H_camera_tag, texture, texture_tag_px, tag_size)
+
+            for (name, path) in paths.items():
+                start = time.perf_counter()
+                for i in range(iterations):
+                    tags = path(image)
+                elapsed = (time.perf_counter() - start) / iterations
+                tags = [tag for tag in tags if tag.tag_id == 0]
+                if tags:
+                    error = np.linalg.norm(np.asarray(tags[0].pose_t).ravel() - H_camera_tag[:3, 3]) * 1e3
+                    print("%-8.1f %-9.0f %-9s %10s %10.1f %10.2f" % (distance, angle_deg, name, "yes", error, elapsed * 1e3))
+                else:
+                    print("%-8.1f %-9.0f %-9s %10s %10s %10.2f" % (distance, angle_deg, name, "no", "-", elapsed * 1e3))
+
+if __name__ == "__main__":
+    import apriltags3
+
+    parser = argparse.ArgumentParser(description='Compares AprilTag detection on rectified and on raw fisheye images')
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml")
+    parser.add_argument('--apriltag_lib', type=str, default='apriltags',
+                        help="Directory of the AprilTag 3 library")
+    parser.add_argument('--tag_size', type=float, default=0.144,
+                        help="Size of the tag in meters")
+    parser.add_argument('--iterations', type=int, default=10,
+                        help="Number of detections per case, for the timing")
+    args = parser.parse_args()
+
+    detector = apriltags3.Detector(searchpath=[args.apriltag_lib, args.apriltag_lib + '/lib', args.apriltag_lib + '/lib64'],
+                                   families='tag36h11', nthreads=1, quad_decimate=1.0, quad_sigma=0.0,
+                                   refine_edges=1, decode_sharpening=0.25, debug=0)
+    compare(detector, fisheye_rectify.load_calibration(args.calib), fisheye_rectify.RectifyGeometry(300, 90),
+            args.tag_size, distances=[1.0, 3.0], angles_deg=[0, 15, 30, 40, 55], iterations=args.iterations)
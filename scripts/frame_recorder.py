@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Asynchronous recorder of the T265 streams     ##
+#####################################################
+# Compressing a 848x800 fisheye pair takes tens of milliseconds, 30 times per second: done inline it would
+# take most of the time budget of the image stage. The camera callback only hands references to the
+# images (and the frameset that keeps their buffers alive) to the recorder, which compresses them in a
+# pool of low priority threads (cv2.imencode releases the GIL) and writes them in capture order from a
+# writer thread, in the format of recording.py, along with the pose samples.
+#
+# At most max_pending pairs wait to be compressed or written, which also bounds the framesets kept away
+# from librealsense. When that many are waiting, a pair is dropped instead of waiting:
+#   - "newest": the incoming pair, the recording has gaps but every recorded run of pairs is contiguous
+#   - "oldest": the oldest pair whose compression has not started yet, the recording stays recent
+#
+# Frame rate, compression ratio and disk throughput a computer sustains, and the latency a stand-in
+# image stage sees with and without recording:
+#   python3 frame_recorder.py --output /tmp/recorder_test --threads 2
+
+import time
+import queue
+import threading
+import collections
+import concurrent.futures
+import argparse
+
+import recording
+import realtime_utils
+
+class FrameRecorder(object):
+    drop_policies = ('newest', 'oldest')
+
+    # calib: in the format of fisheye_rectify.load_calibration. png_level: see recording.encode_image
+    def __init__(self, path, calib, num_threads=2, max_pending=8, drop_policy='newest', png_level=1, niceness=10):
+        if drop_policy not in self.drop_policies:
+            raise ValueError("Unknown drop policy %s, expected one of %s" % (drop_policy, self.drop_policies))
+        self.path = path
+        self.num_threads = num_threads
+        self.max_pending = max_pending
+        self.drop_policy = drop_policy
+        self.png_level = png_level
+        self.writer = recording.RecordingWriter(path, calib)
+        self.executor = concurrent.futures.ThreadPoolExecutor(num_threads, thread_name_prefix='recorder',
+                                                              initializer=realtime_utils.lower_priority, initargs=('recorder', niceness))
+        self.lock = threading.Lock()
+        self.pending = collections.deque()      # [future, frame_number, capture_time, exposure], in capture order
+        self.poses = queue.SimpleQueue()        # (capture_time, pose_data)
+        self.wakeup = threading.Event()
+        self.closing = False
+
+        self.start_time = time.time()
+        self.submit_count = 0
+        self.drop_count = 0
+        self.pending_max = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.encode_time_sum = 0.0
+
+        self.thread = threading.Thread(target=self.write_loop, name='recorder_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # left, right: images of the pair, not copied. keep: whatever keeps their buffers alive until they are
+    # compressed, e.g. the librealsense frameset. Never waits, returns False when a pair was dropped
+    def add_frameset(self, frame_number, capture_time, exposure, left, right, keep=None):
+        with self.lock:
+            if self.closing:
+                return False
+            if len(self.pending) >= self.max_pending:
+                self.drop_count += 1
+                if self.drop_policy == 'newest' or not self.drop_oldest():
+                    return False
+            future = self.executor.submit(self.encode, left, right, keep)
+            self.pending.append([future, frame_number, capture_time, exposure])
+            self.submit_count += 1
+            self.pending_max = max(self.pending_max, len(self.pending))
+        self.wakeup.set()
+        return True
+
+    # Cancels the oldest pair whose compression has not started, False if all of them have
+    def drop_oldest(self):
+        for (i, item) in enumerate(self.pending):
+            if item[0].cancel():
+                del self.pending[i]
+                return True
+        return False
+
+    # pose_data: librealsense pose data
+    def add_pose(self, capture_time, pose_data):
+        self.poses.put((capture_time, pose_data))
+
+    def encode(self, left, right, keep):
+        start = time.perf_counter()
+        encoded = (recording.encode_image(left, self.png_level), recording.encode_image(right, self.png_level))
+        return encoded + (left.nbytes + right.nbytes, time.perf_counter() - start)
+
+    # Writes the pairs in capture order as their compression ends, and the poses as they come
+    def write_loop(self):
+        while True:
+            while True:
+                try:
+                    (capture_time, pose_data) = self.poses.get_nowait()
+                except queue.Empty:
+                    break
+                self.writer.add_pose(capture_time, pose_data)
+
+            with self.lock:
+                head = self.pending[0] if self.pending else None
+                if head is None:
+                    if self.closing:
+                        break
+                    self.wakeup.clear()
+            if head is None:
+                self.wakeup.wait(0.1)
+                continue
+
+            (future, frame_number, capture_time, exposure) = head
+            try:
+                (left, right, raw_bytes, encode_time) = future.result()
+            except concurrent.futures.CancelledError:
+                continue
+            self.writer.add_frameset(frame_number, capture_time, exposure, left, right)
+            with self.lock:
+                self.pending.popleft()
+                self.raw_bytes += raw_bytes
+                self.compressed_bytes += len(left) + len(right)
+                self.encode_time_sum += encode_time
+
+    # Writes what is pending and closes the recording
+    def close(self):
+        with self.lock:
+            self.closing = True
+        self.wakeup.set()
+        self.executor.shutdown(wait=True)
+        self.thread.join()
+        self.writer.close()
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            written = self.writer.frame_count
+            ratio = self.raw_bytes / self.compressed_bytes if self.compressed_bytes > 0 else 0.0
+            encode_ms = self.encode_time_sum / written * 1e3 if written > 0 else 0.0
+            return ("INFO: Recorder %s: %d pairs at %.1f fps, dropped %d (%s policy), %d poses, compression ratio %.2f, "
+                    "disk %.1f MB/s, compression %.1f ms per pair on %d threads, pending max %d of %d" %
+                    (self.path, written, written / elapsed, self.drop_count, self.drop_policy, self.writer.pose_count, ratio,
+                     self.writer.bytes_written / elapsed / 1e6, encode_ms, self.num_threads, self.pending_max, self.max_pending))
+
+#######################################
+# Recording load test
+#######################################
+
+# Latencies of a stand-in image stage (rectification and edge detection of the left image) run on pairs
+# arriving at rate_hz for the given duration, handing each pair to recorder when there is one
+def run_stage(pairs, maps, rate_hz, seconds, recorder=None):
+    import cv2
+    import fisheye_rectify
+
+    latencies = []
+    start = time.perf_counter()
+    frame_number = 0
+    while time.perf_counter() - start < seconds:
+        arrival = start + frame_number / rate_hz
+        time.sleep(max(0.0, arrival - time.perf_counter()))
+        (left, right) = pairs[frame_number % len(pairs)]
+        if recorder is not None:
+            recorder.add_frameset(frame_number, time.time(), None, left, right)
+        cv2.Canny(fisheye_rectify.remap(left, maps), 50, 150)
+        latencies.append(time.perf_counter() - arrival)
+        frame_number += 1
+    return latencies
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import numpy as np
+    import fisheye_rectify
+
+    parser = argparse.ArgumentParser(description='Measures what recording the fisheye pairs costs and sustains on this computer')
+    parser.add_argument('--output', type=str, required=True,
+                        help="Directory of the test recording, must not exist")
+    parser.add_argument('--recording', type=str,
+                        help="Recording to take the pairs from. If not specified, tags are rendered with --calib")
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml, for rendered pairs")
+    parser.add_argument('--threads', type=int, default=2,
+                        help="Compression threads")
+    parser.add_argument('--max_pending', type=int, default=8,
+                        help="Pairs waiting to be compressed or written before pairs are dropped")
+    parser.add_argument('--drop_policy', type=str, default='newest', choices=FrameRecorder.drop_policies,
+                        help="Pair dropped when max_pending pairs are waiting")
+    parser.add_argument('--rate', type=float, default=30,
+                        help="Frame rate in Hz")
+    parser.add_argument('--seconds', type=float, default=10,
+                        help="Duration of each measurement")
+    args = parser.parse_args()
+
+    if args.recording:
+        source = recording.Recording(args.recording)
+    else:
+        rendered = os.path.join(tempfile.mkdtemp(), 'pairs')
+        recording.synthetic_recording(rendered, fisheye_rectify.load_calibration(args.calib), num_frames=8)
+        source = recording.Recording(rendered)
+    pairs = [source.images(i) for i in range(min(len(source), 30))]
+    calib = source.calibration
+    geometry = fisheye_rectify.RectifyGeometry(300, 90)
+    maps = fisheye_rectify.build_maps(calib["K1"], calib["D1"], np.eye(3), geometry.projection_matrix(), geometry.size())
+
+    baseline = run_stage(pairs, maps, args.rate, args.seconds)
+    recorder = FrameRecorder(args.output, calib, args.threads, args.max_pending, args.drop_policy)
+    recorded = run_stage(pairs, maps, args.rate, args.seconds, recorder)
+    recorder.close()
+    print(recorder.report())
+    print("%-20s %16s %16s %16s" % ("stage latency", "mean ms", "p95 ms", "max ms"))
+    for (name, latencies) in (("without recording", baseline), ("recording", recorded)):
+        print("%-20s %16.2f %16.2f %16.2f" % (name, np.mean(latencies) * 1e3, np.percentile(latencies, 95) * 1e3, np.max(latencies) * 1e3))
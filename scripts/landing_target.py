@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Landing target propagation                    ##
+#####################################################
+# Tags are detected at the camera rate at best, while the T265 gives the pose of the camera at 200 Hz.
+# Between two detections the landing target does not move on the ground, only the vehicle does: the last
+# detected position is kept in the T265 reference frame and brought back into the camera frame at the
+# latest pose, so LANDING_TARGET can be sent with fresh angles and distance at any rate, along with the
+# time since the detection it is based on.
+
+import math as m
+
+# Angular offsets and distance of a target at position (x right, y down, z forward) in the camera frame
+def target_angles(position_camera):
+    (x, y, z) = position_camera
+    return (m.atan(x / z), m.atan(y / z), m.sqrt(x * x + y * y + z * z))
+
+class LandingTargetPropagator(object):
+    # max_age_sec: how long after the last detection the target is still propagated
+    def __init__(self, max_age_sec=1.0):
+        self.max_age_sec = max_age_sec
+        self.target = None              # (capture time, position in the T265 reference frame) of the last detection
+        self.detection_count = 0
+        self.propagated_count = 0
+        self.expired_count = 0
+
+    # Detected position in the camera frame, H_ref_camera: camera pose in the T265 reference frame when the image was taken
+    def update(self, capture_time, H_ref_camera, position_camera):
+        position_ref = H_ref_camera[:3, :3].dot(position_camera) + H_ref_camera[:3, 3]
+        self.target = (capture_time, position_ref)
+        self.detection_count += 1
+
+    # Position in the camera frame at camera pose H_ref_camera taken at pose_time, and the time since the
+    # detection. None when there is no recent detection, or the target is not in front of the camera
+    def propagate(self, H_ref_camera, pose_time):
+        if self.target is None:
+            return None
+        (capture_time, position_ref) = self.target
+        age = pose_time - capture_time
+        if age > self.max_age_sec:
+            self.target = None
+            self.expired_count += 1
+            return None
+        position_camera = H_ref_camera[:3, :3].T.dot(position_ref - H_ref_camera[:3, 3])
+        if position_camera[2] <= 0:
+            return None
+        self.propagated_count += 1
+        return (position_camera, age)
+
+    def report(self):
+        return ("INFO: Landing target: %d detections, %d propagated estimates, %d expired after %.1f s without detection" %
+                (self.detection_count, self.propagated_count, self.expired_count, self.max_age_sec))
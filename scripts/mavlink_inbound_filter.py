@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Inbound MAVLink filter for the T265 bridges   ##
+#####################################################
+# The FCU streams hundreds of messages per second, and dronekit's reader thread fully decodes and
+# dispatches every one of them while the bridges only use a handful. The filter hooks into the
+# pymavlink parser: the message id is read from the raw header and the payload is only decoded
+# (CRC check, unpacking, object creation, dispatch to listeners) for subscribed ids.
+#
+# It can also ask the FCU to stop streaming everything and to send only the messages we need,
+# which saves the link bandwidth and the framing cost as well.
+#
+# The hook relies on private parts of the pure Python parser of pymavlink. With the native parser, or a
+# pymavlink without them, install() leaves the filter off with a warning.
+
+import time
+
+from pymavlink import mavutil
+
+PROTOCOL_MARKER_V2 = 0xFD
+
+class InboundFilter(object):
+    def __init__(self, vehicle):
+        self.vehicle = vehicle
+        self.mav = vehicle._master.mav
+        self.decode = self.mav.decode
+        # The parse step that calls decode on the next complete message in the buffer, None without one.
+        # Private to pymavlink, see unsupported_reason()
+        self.parse_next = getattr(self.mav, '_MAVLink__parse_char_legacy', None)
+        self.skipping = False
+        self.msg_ids = set()
+        self.decoded_count = 0
+        self.decode_time = 0.0
+        self.skipped_count = {}
+
+    # Subscribe to a message by name, e.g. 'HEARTBEAT'
+    def subscribe(self, *msg_names):
+        for msg_name in msg_names:
+            self.msg_ids.add(getattr(mavutil.mavlink, 'MAVLINK_MSG_ID_' + msg_name))
+
+    # Why the filter cannot hook into this parser, None if it can: the native parser never calls decode
+    def unsupported_reason(self):
+        if getattr(self.mav, 'native', False):
+            return "the native pymavlink parser does not call decode"
+        if self.parse_next is None:
+            return "this pymavlink has no _MAVLink__parse_char_legacy"
+        return None
+
+    # Hook into the parser. Messages are dropped from then on, so only call this once dronekit
+    # has finished its own initialization (parameters, home location etc.)
+    # Returns False, and leaves the filter off, when the parser is not supported
+    def install(self):
+        reason = self.unsupported_reason()
+        if reason is not None:
+            print("WARNING: Inbound MAVLink filter off,", reason)
+            return False
+        self.mav.decode = self.filtered_decode
+        return True
+
+    def uninstall(self):
+        if 'decode' in self.mav.__dict__:
+            del self.mav.decode
+
+    def filtered_decode(self, msgbuf):
+        if msgbuf[0] == PROTOCOL_MARKER_V2:
+            msg_id = msgbuf[7] | (msgbuf[8] << 8) | (msgbuf[9] << 16)
+        else:
+            msg_id = msgbuf[5]
+
+        if msg_id in self.msg_ids:
+            start = time.perf_counter()
+            msg = self.decode(msgbuf)
+            self.decode_time += time.perf_counter() - start
+            self.decoded_count += 1
+            return msg
+        self.skipped_count[msg_id] = self.skipped_count.get(msg_id, 0) + 1
+
+        # The parser takes None for "no complete message in the buffer": parse_char, parse_buffer and recv_msg
+        # stop there, and the subscribed messages behind this one would wait for the next receive. So the
+        # outermost skip parses on until a subscribed message is decoded or no complete message is left, the
+        # skips nested in it just return None
+        if self.skipping:
+            return None
+        self.skipping = True
+        try:
+            while True:
+                buf_index = self.mav.buf_index
+                msg = self.parse_next()
+                if msg is not None or self.mav.buf_index == buf_index:
+                    return msg
+        finally:
+            self.skipping = False
+
+    # Ask the FCU to stop all of its data streams, then to stream only the given messages.
+    # msg_rates: {message name: rate in Hz}
+    def request_streams(self, msg_rates):
+        target_system = self.vehicle._master.target_system
+        target_component = self.vehicle._master.target_component
+
+        msg = self.vehicle.message_factory.request_data_stream_encode(
+            target_system,
+            target_component,
+            mavutil.mavlink.MAV_DATA_STREAM_ALL,
+            0,              # req_message_rate
+            0               # start_stop: 0 = stop
+        )
+        self.vehicle.send_mavlink(msg)
+
+        for (msg_name, rate_hz) in msg_rates.items():
+            msg = self.vehicle.message_factory.command_long_encode(
+                target_system,
+                target_component,
+                mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL,
+                0,                                                          # confirmation
+                getattr(mavutil.mavlink, 'MAVLINK_MSG_ID_' + msg_name),     # param1: message id
+                int(1e6 / rate_hz),                                         # param2: interval in us
+                0, 0, 0, 0, 0
+            )
+            self.vehicle.send_mavlink(msg)
+        self.vehicle.flush()
+
+    # Decode counts and an estimate of the CPU time saved, from the mean cost of the messages that were decoded.
+    # Dispatch to dronekit's listeners is saved as well, so this is a lower bound.
+    def report(self):
+        skipped_total = sum(self.skipped_count.values())
+        mean_decode_time = self.decode_time / self.decoded_count if self.decoded_count > 0 else 0.0
+        lines = ["INFO: Inbound MAVLink: decoded %d, skipped %d, decode time %.3f s, CPU time saved at least %.3f s" % (
+                    self.decoded_count, skipped_total, self.decode_time, skipped_total * mean_decode_time)]
+        for (msg_id, count) in sorted(self.skipped_count.items(), key=lambda item: -item[1]):
+            msg_type = mavutil.mavlink.mavlink_map[msg_id].msgname if msg_id in mavutil.mavlink.mavlink_map else str(msg_id)
+            lines.append("INFO:     skipped %-24s %d" % (msg_type, count))
+        return "\n".join(lines)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   MAVLink parameter server for bridge settings  ##
+#####################################################
+# Serves the settings of a bridge script as the parameter table of its own MAVLink component,
+# so they can be read and changed from the GCS (PARAM_REQUEST_LIST / PARAM_REQUEST_READ / PARAM_SET)
+# while the script keeps running. See https://mavlink.io/en/services/parameter.html
+#
+# Values live in memory. A change is handed to the script's apply callback, which validates it and
+# applies it atomically; accepted changes are then persisted to a JSON file and loaded on next start.
+
+import os
+import json
+import math as m
+import threading
+
+from pymavlink import mavutil
+
+# MAVLink limits parameter names to 16 characters
+param_name_max_len = 16
+
+class ParamServer(object):
+    # apply_callback(name, value) returns the value actually applied, or None to reject the change
+    def __init__(self, param_file, apply_callback):
+        self.param_file = param_file
+        self.apply_callback = apply_callback
+        self.names = []
+        self.values = {}
+        self.vehicle = None
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        assert len(name) <= param_name_max_len, name
+        self.names.append(name)
+        self.values[name] = float(value)
+
+    def get(self, name):
+        return self.values[name]
+
+    # Values persisted by a previous run, for the known parameters only
+    def load(self):
+        if not self.param_file or not os.path.exists(self.param_file):
+            return {}
+        try:
+            with open(self.param_file) as f:
+                stored = json.load(f)
+        except (IOError, ValueError) as e:
+            print("WARNING: Could not read parameter file", self.param_file, ":", e)
+            return {}
+        return {name: float(value) for (name, value) in stored.items() if name in self.values}
+
+    # Write to a temporary file first, so a crash never leaves a half-written file behind
+    def save(self):
+        if not self.param_file:
+            return
+        tmp_file = self.param_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({name: self.values[name] for name in self.names}, f, indent=2)
+        os.replace(tmp_file, self.param_file)
+
+    # Listen to the parameter protocol on the given vehicle (again after a reconnection)
+    def attach(self, vehicle):
+        self.vehicle = vehicle
+        vehicle.add_message_listener('PARAM_REQUEST_LIST', self.request_list_callback)
+        vehicle.add_message_listener('PARAM_REQUEST_READ', self.request_read_callback)
+        vehicle.add_message_listener('PARAM_SET', self.set_callback)
+
+    # Change a parameter from within the script, e.g. from an estimator, and tell the GCS about it
+    def set(self, name, value):
+        with self.lock:
+            applied = self.apply_callback(name, value)
+            if applied is None:
+                return False
+            self.values[name] = float(applied)
+            self.save()
+        self.send_value(name)
+        return True
+
+    def is_for_us(self, msg):
+        mav = self.vehicle._master.mav
+        return msg.target_system in (0, mav.srcSystem) and msg.target_component in (0, mav.srcComponent)
+
+    def send_value(self, name):
+        msg = self.vehicle.message_factory.param_value_encode(
+            name.encode(),                          # param_id
+            self.values[name],                      # param_value
+            mavutil.mavlink.MAV_PARAM_TYPE_REAL32,  # param_type
+            len(self.names),                        # param_count
+            self.names.index(name)                  # param_index
+        )
+        self.vehicle.send_mavlink(msg)
+        self.vehicle.flush()
+
+    def request_list_callback(self, vehicle, attr_name, msg):
+        if self.is_for_us(msg):
+            for name in self.names:
+                self.send_value(name)
+
+    def request_read_callback(self, vehicle, attr_name, msg):
+        if not self.is_for_us(msg):
+            return
+        if msg.param_index >= 0:
+            if msg.param_index < len(self.names):
+                self.send_value(self.names[msg.param_index])
+        elif msg.param_id in self.values:
+            self.send_value(msg.param_id)
+
+    # Unknown names are ignored, they may belong to another component. The protocol expects a
+    # PARAM_VALUE reply in any case, with the old value when the change was rejected.
+    def set_callback(self, vehicle, attr_name, msg):
+        if not self.is_for_us(msg) or msg.param_id not in self.values:
+            return
+        if m.isfinite(msg.param_value) and self.set(msg.param_id, msg.param_value):
+            print("INFO: Parameter", msg.param_id, "set to", self.values[msg.param_id])
+        else:
+            print("WARNING: Rejected value", msg.param_value, "for parameter", msg.param_id)
+            self.send_value(msg.param_id)
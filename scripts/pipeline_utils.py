@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Building blocks for staged frame pipelines    ##
+#####################################################
+# Stages run in their own threads and are connected by latest-only slots: the producer never
+# waits, and a slow consumer only ever sees the most recent item, so one stage falling behind
+# does not slow down the others or build up latency in a queue.
+
+import threading
+import time
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Bounded handoff of capacity one. put() replaces any item not taken yet, get() waits for a new item.
+class LatestSlot(object):
+    def __init__(self, name):
+        self.name = name
+        self.item = None
+        self.condition = threading.Condition()
+        self.put_count = 0
+        self.drop_count = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.drop_count += 1
+            self.item = item
+            self.put_count += 1
+            self.condition.notify_all()
+
+    # Returns None on timeout
+    def get(self, timeout=None):
+        with self.condition:
+            if self.item is None:
+                self.condition.wait(timeout)
+            item = self.item
+            self.item = None
+            self.condition.notify_all()
+            return item
+
+    # For a producer that must not drop items, e.g. a replay: waits until the item put last was taken
+    def wait_taken(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.item is None, timeout)
+
+    def report(self):
+        return "INFO: Slot  %-20s put %d, dropped %d" % (self.name, self.put_count, self.drop_count)
+
+# Rate and latency counters of a stage. Latency is whatever the stage measures, typically from the
+# capture or arrival of the frame to the end of its processing.
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.start_time = time.time()
+        self.window_start = self.start_time
+        self.window_count = 0
+
+    def tick(self, latency_sec):
+        with self.lock:
+            self.count += 1
+            self.window_count += 1
+            self.latency_sum += latency_sec
+            if latency_sec > self.latency_max:
+                self.latency_max = latency_sec
+
+    # Rate since the previous call (or since start), and resets the window
+    def window_rate(self):
+        with self.lock:
+            now = time.time()
+            rate = self.window_count / (now - self.window_start) if now > self.window_start else 0.0
+            self.window_start = now
+            self.window_count = 0
+            return rate
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            rate = self.count / elapsed if elapsed > 0 else 0.0
+            mean = self.latency_sum / self.count if self.count > 0 else 0.0
+            return "INFO: Stage %-20s n=%d rate=%.1f Hz latency mean=%.1f ms max=%.1f ms" % (
+                    self.name, self.count, rate, mean * 1e3, self.latency_max * 1e3)
+
+# Per-frame products computed on demand. producers: {name: function(graph)}, where the function may
+# get() other products it depends on. Each product is computed at most once per frame, when a consumer
+# first asks for it, and everything is discarded when the next frame begins.
+class ProductGraph(object):
+    def __init__(self, name, producers):
+        self.name = name
+        self.producers = producers
+        self.frame_number = None
+        self.cache = {}
+        self.frame_count = 0
+        self.compute_count = dict.fromkeys(producers, 0)
+        self.compute_time = dict.fromkeys(producers, 0.0)
+
+    # Products known once the pipeline is set up, e.g. those depending on the camera calibration
+    def add_producers(self, producers):
+        self.producers.update(producers)
+        for name in producers:
+            self.compute_count.setdefault(name, 0)
+            self.compute_time.setdefault(name, 0.0)
+
+    # sources: the raw inputs of the frame, e.g. the camera images
+    def begin_frame(self, frame_number, **sources):
+        self.frame_number = frame_number
+        self.cache = sources
+        self.frame_count += 1
+
+    def get(self, name):
+        if name not in self.cache:
+            start = time.time()
+            self.cache[name] = self.producers[name](self)
+            self.compute_time[name] += time.time() - start
+            self.compute_count[name] += 1
+        return self.cache[name]
+
+    def report(self):
+        lines = ["INFO: Products of %s over %d frames:" % (self.name, self.frame_count)]
+        for name in self.producers:
+            count = self.compute_count[name]
+            mean = self.compute_time[name] / count if count > 0 else 0.0
+            lines.append("INFO:     %-20s computed %d times, mean %.1f ms" % (name, count, mean * 1e3))
+        return "\n".join(lines)
+
+# Keeps a stage within its per-frame time budget by doing less when it falls behind, in this order:
+#   1. drop the optional work (e.g. visualization)
+#   2. prefer the cheap variant of the main work (e.g. search a region of interest, not the whole image)
+#   3. do the main work only on every n-th frame, n growing while frames keep missing the deadline
+# A frame misses the deadline when its latency (from arrival to the end of its processing) exceeds the
+# budget. After recover_frames frames well within budget, the scheduler steps back one level.
+class DeadlineScheduler(object):
+    levels = ('normal', 'no optional work', 'prefer cheap work', 'skip frames')
+
+    def __init__(self, name, budget_sec, miss_frames=2, recover_ratio=0.7, recover_frames=30, max_skip=6):
+        self.name = name
+        self.budget_sec = budget_sec
+        self.miss_frames = miss_frames
+        self.recover_ratio = recover_ratio
+        self.recover_frames = recover_frames
+        self.max_skip = max_skip
+
+        self.level = 0
+        self.work_every = 1
+        self.consecutive_misses = 0
+        self.calm_frames = 0
+
+        self.lock = threading.Lock()
+        self.frame_count = 0
+        self.work_count = 0
+        self.skip_count = 0
+        self.miss_count = 0
+        self.start_time = time.time()
+        self.window_start = self.start_time
+        self.window_work_count = 0
+        self.window_miss_count = 0
+
+    # What to do with the next frame: (do the main work, prefer the cheap variant, do the optional work)
+    def plan(self):
+        self.frame_count += 1
+        do_work = self.level < 3 or self.frame_count % self.work_every == 0
+        return (do_work, self.level >= 2, self.level < 1)
+
+    def set_level(self, level, work_every):
+        if (level, work_every) != (self.level, self.work_every):
+            (self.level, self.work_every) = (level, work_every)
+            if level == 3:
+                print("INFO: %s: %s, main work on 1 of %d frames" % (self.name, self.levels[level], work_every))
+            else:
+                print("INFO: %s: %s" % (self.name, self.levels[level]))
+
+    # latency_sec: from arrival of the frame to now, did_work: whether the main work was done on it
+    def end_frame(self, latency_sec, did_work):
+        with self.lock:
+            if did_work:
+                self.work_count += 1
+                self.window_work_count += 1
+            else:
+                self.skip_count += 1
+            missed = latency_sec > self.budget_sec
+            if missed:
+                self.miss_count += 1
+                self.window_miss_count += 1
+
+        # Only the frames worked on tell whether the work fits: a skipped frame is always fast, and counting
+        # it as calm would undo every step up from skipping 1 of 2 frames
+        if not did_work:
+            return
+        if missed:
+            self.calm_frames = 0
+            self.consecutive_misses += 1
+            if self.consecutive_misses >= self.miss_frames:
+                self.consecutive_misses = 0
+                if self.level < 3:
+                    self.set_level(self.level + 1, 2 if self.level + 1 == 3 else 1)
+                else:
+                    self.set_level(3, min(self.max_skip, self.work_every + 1))
+        else:
+            self.consecutive_misses = 0
+            if latency_sec < self.recover_ratio * self.budget_sec:
+                self.calm_frames += 1
+                if self.calm_frames >= self.recover_frames:
+                    self.calm_frames = 0
+                    if self.level == 3 and self.work_every > 2:
+                        self.set_level(3, self.work_every - 1)
+                    elif self.level > 0:
+                        self.set_level(self.level - 1, 1)
+
+    # Rate of the main work and number of deadline misses since the previous call, and resets the window
+    def window_stats(self):
+        with self.lock:
+            now = time.time()
+            rate = self.window_work_count / (now - self.window_start) if now > self.window_start else 0.0
+            misses = self.window_miss_count
+            self.window_start = now
+            self.window_work_count = 0
+            self.window_miss_count = 0
+            return (rate, misses)
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            rate = self.work_count / elapsed if elapsed > 0 else 0.0
+            return "INFO: Scheduler %-16s frames %d, worked on %d (%.1f Hz), skipped %d, deadline misses %d, level: %s" % (
+                    self.name, self.frame_count, self.work_count, rate, self.skip_count, self.miss_count, self.levels[self.level])
+
+# Context for worker processes that attach shared memory created by this one. The resource tracker is
+# started before forking so the workers share it, otherwise the memory they attach is reported as leaked
+# by their own tracker once its creator unlinked it
+def fork_context():
+    resource_tracker.ensure_running()
+    return multiprocessing.get_context('fork')
+
+# Latest-only slot between processes, in shared memory. The producer creates it and the consumer attaches
+# to it with spec(). put() never waits: the item is dropped if the consumer is copying the previous one.
+# lock, event: from fork_context(), created before the consumer is forked. arrays: {key: (shape, dtype)}
+class SharedLatestSlot(object):
+    def __init__(self, name, lock, event, arrays, shm_name=None):
+        self.name = name
+        self.lock = lock
+        self.event = event
+        self.arrays = arrays
+        offsets = [8]       # the first 8 bytes hold the sequence number of the item
+        for (shape, dtype) in arrays.values():
+            offsets.append(offsets[-1] + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self.owner = shm_name is None
+        self.shm = shared_memory.SharedMemory(name=shm_name, create=self.owner, size=offsets[-1] if self.owner else 0)
+        self.sequence = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.views = {}
+        for ((key, (shape, dtype)), offset) in zip(arrays.items(), offsets):
+            self.views[key] = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+        if self.owner:
+            self.sequence[0] = 0
+        self.last_sequence = 0
+        self.put_count = 0
+        self.drop_count = 0
+
+    # To attach in the consumer: SharedLatestSlot(name, lock, event, *spec())
+    def spec(self):
+        return (self.arrays, self.shm.name)
+
+    # Returns False when the item was dropped
+    def put(self, **items):
+        if not self.lock.acquire(block=False):
+            self.drop_count += 1
+            return False
+        try:
+            for (key, value) in items.items():
+                self.views[key][...] = value
+            self.sequence[0] += 1
+        finally:
+            self.lock.release()
+        self.event.set()
+        self.put_count += 1
+        return True
+
+    # Copy of the newest item not taken yet, {key: array}, None on timeout
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            return None
+        self.event.clear()
+        with self.lock:
+            if self.sequence[0] == self.last_sequence:
+                return None
+            self.last_sequence = int(self.sequence[0])
+            return {key: view.copy() for (key, view) in self.views.items()}
+
+    def close(self):
+        del self.sequence, self.views
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def report(self):
+        return "INFO: Slot  %-20s put %d, dropped %d" % (self.name, self.put_count, self.drop_count)
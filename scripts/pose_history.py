@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Time-indexed history of T265 poses            ##
+#####################################################
+# A tag is detected in an image captured tens of milliseconds before its detection is done, while the
+# latest pose is from a few milliseconds ago. To pair the detection with the pose of the camera when the
+# image was taken, the recent poses are kept in a ring buffer indexed by capture time and interpolated:
+# linearly for the position, SLERP for the orientation.
+#
+# Written by the pose stage and read by the image stage, hence the lock.
+
+import threading
+
+import numpy as np
+import transformations as tf
+
+class PoseHistory(object):
+    # capacity: number of poses kept, 2 s at the 200 Hz of the T265 by default
+    # max_extrapolation_sec: how far past the latest pose a lookup may be, answered with the latest pose
+    def __init__(self, capacity=400, max_extrapolation_sec=0.010):
+        self.capacity = capacity
+        self.max_extrapolation_sec = max_extrapolation_sec
+        self.times = np.zeros(capacity)
+        self.quaternions = np.zeros((capacity, 4))
+        self.translations = np.zeros((capacity, 3))
+        self.head = 0       # index of the next pose to write
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.lookup_count = 0
+        self.too_old_count = 0
+        self.too_new_count = 0
+
+    # capture_time in seconds, quaternion as [w, x, y, z] like transformations
+    def add(self, capture_time, quaternion, translation):
+        with self.lock:
+            if self.count > 0 and capture_time <= self.times[(self.head - 1) % self.capacity]:
+                return
+            self.times[self.head] = capture_time
+            self.quaternions[self.head] = quaternion
+            self.translations[self.head] = translation
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    # Pose as a 4x4 matrix at capture_time, None if it is out of the range of the history
+    def at(self, capture_time):
+        with self.lock:
+            self.lookup_count += 1
+            if self.count == 0:
+                return None
+            order = (self.head - self.count + np.arange(self.count)) % self.capacity
+            times = self.times[order]
+            if capture_time < times[0]:
+                self.too_old_count += 1
+                return None
+            if capture_time >= times[-1]:
+                if capture_time - times[-1] > self.max_extrapolation_sec:
+                    self.too_new_count += 1
+                    return None
+                (quaternion, translation) = (self.quaternions[order[-1]].copy(), self.translations[order[-1]].copy())
+            else:
+                i = np.searchsorted(times, capture_time, side='right')
+                (i0, i1) = (order[i - 1], order[i])
+                fraction = (capture_time - self.times[i0]) / (self.times[i1] - self.times[i0])
+                quaternion = tf.quaternion_slerp(self.quaternions[i0], self.quaternions[i1], fraction)
+                translation = self.translations[i0] + fraction * (self.translations[i1] - self.translations[i0])
+
+        H = tf.quaternion_matrix(quaternion)
+        H[:3, 3] = translation
+        return H
+
+    # (capture time, 4x4 pose) of the latest pose, None if there is none
+    def latest(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            i = (self.head - 1) % self.capacity
+            (capture_time, quaternion, translation) = (self.times[i], self.quaternions[i].copy(), self.translations[i].copy())
+        H = tf.quaternion_matrix(quaternion)
+        H[:3, 3] = translation
+        return (capture_time, H)
+
+    def report(self):
+        with self.lock:
+            span = 0.0
+            if self.count > 1:
+                span = self.times[(self.head - 1) % self.capacity] - self.times[(self.head - self.count) % self.capacity]
+            return ("INFO: Pose history: %d poses over %.2f s, %d lookups, %d older than the history, %d newer than the latest pose" %
+                    (self.count, span, self.lookup_count, self.too_old_count, self.too_new_count))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+#####################################################
+##      Real-time scheduling helpers (Linux)       ##
+#####################################################
+# Helpers for the opt-in real-time mode of the bridges:
+#   - SCHED_FIFO priority and CPU affinity for the calling thread,
+#   - locking the process memory to avoid page faults in the steady-state loop,
+#   - garbage collector control with explicit collection points,
+#   - a lower priority for background threads, e.g. compression,
+#   - scheduling latency histograms, so that jitter can be compared with and without the mode.
+#
+# Setting a real-time priority and locking memory need root or CAP_SYS_NICE / CAP_IPC_LOCK.
+# Failures are reported and the script carries on with normal scheduling.
+
+import os
+import gc
+import ctypes
+import ctypes.util
+import threading
+import time
+
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+
+# Parse a CPU list such as "2,3" or "1-3" into a set of CPU indices
+def parse_cpu_list(cpu_list):
+    cpus = set()
+    for item in cpu_list.split(','):
+        item = item.strip()
+        if '-' in item:
+            (first, last) = item.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif item:
+            cpus.add(int(item))
+    return cpus
+
+# Apply SCHED_FIFO priority and CPU affinity to the calling thread.
+# On Linux each thread is a task, so pid 0 refers to the calling thread only.
+def apply_realtime(thread_name, priority, cpus=None):
+    ok = True
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (OSError, AttributeError) as e:
+            print("WARNING: Could not set CPU affinity of", thread_name, "thread:", e)
+            ok = False
+    if priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (OSError, AttributeError) as e:
+            print("WARNING: Could not set SCHED_FIFO priority of", thread_name, "thread:", e)
+            ok = False
+    if ok:
+        print("INFO: Real-time mode for", thread_name, "thread: SCHED_FIFO priority", priority, "CPUs", sorted(cpus) if cpus else "all")
+    return ok
+
+# Lower the priority of the calling thread, for background work that must not delay the loops.
+# On Linux each thread is a task, so pid 0 refers to the calling thread only.
+def lower_priority(thread_name, niceness):
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, niceness)
+    except (OSError, AttributeError) as e:
+        print("WARNING: Could not lower the priority of", thread_name, "thread:", e)
+        return False
+    return True
+
+# Lock current and future memory pages, so that the loop never waits for a page fault
+def lock_memory():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        print("WARNING: Could not lock memory:", os.strerror(ctypes.get_errno()))
+        return False
+    print("INFO: Memory locked")
+    return True
+
+# Stop automatic garbage collection. Everything allocated during start up is moved to the
+# permanent generation, so the explicit collections in the loop only scan what the loop allocated.
+# They must include the older generations from time to time (collect_gc(2)), since the survivors of
+# the young collections are promoted there and would never be collected otherwise.
+def disable_gc():
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    gc.disable()
+    print("INFO: Automatic garbage collection disabled")
+
+# Controlled collection point, call it where the loop has slack (e.g. right after a pose was processed).
+# generation: 0 for the young objects only, 2 for all of them. Returns the time spent, in seconds.
+def collect_gc(generation=0):
+    start = time.perf_counter()
+    gc.collect(generation)
+    return time.perf_counter() - start
+
+#######################################
+# Latency histograms
+#######################################
+
+# Histogram of latencies with power-of-two buckets in microseconds: [0, 1), [1, 2), [2, 4) ... [2^(n-2), inf).
+# Recording is O(1) and allocation free, so it can stay enabled in the steady-state loop.
+class LatencyHistogram(object):
+    num_buckets = 24
+
+    def __init__(self, name):
+        self.name = name
+        self.buckets = [0] * self.num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency_sec):
+        latency_us = int(latency_sec * 1e6)
+        index = min(max(latency_us, 0).bit_length(), self.num_buckets - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += latency_sec
+        if latency_sec > self.max:
+            self.max = latency_sec
+
+    # Upper bound of the bucket holding the given fraction of samples, in microseconds
+    def percentile_us(self, fraction):
+        target = fraction * self.count
+        accumulated = 0
+        for index, n in enumerate(self.buckets):
+            accumulated += n
+            if accumulated >= target:
+                return 1 << index
+        return 1 << (self.num_buckets - 1)
+
+    def report(self):
+        if self.count == 0:
+            return "INFO: Latency %-32s no samples" % self.name
+        lines = ["INFO: Latency %-32s n=%d mean=%.0fus p50<%dus p99<%dus p99.9<%dus max=%.0fus" % (
+                    self.name, self.count, self.total / self.count * 1e6,
+                    self.percentile_us(0.5), self.percentile_us(0.99), self.percentile_us(0.999), self.max * 1e6)]
+        for index, n in enumerate(self.buckets):
+            if n > 0:
+                lower = (1 << (index - 1)) if index > 0 else 0
+                lines.append("INFO:     %8dus - %8dus: %d" % (lower, 1 << index, n))
+        return "\n".join(lines)
+
+#######################################
+# Periodic jobs
+#######################################
+
+# Wrap a job run by a scheduler at a fixed period. On first run in each worker thread the real-time
+# settings are applied to that thread, and every run records how late it started against its slot.
+def periodic_job(func, period_sec, histogram, priority=None, cpus=None):
+    thread_state = threading.local()
+    state = {'first_start': None}
+
+    def job():
+        start = time.time()
+        if not getattr(thread_state, 'configured', False):
+            thread_state.configured = True
+            if priority or cpus:
+                apply_realtime(func.__name__ + '/' + threading.current_thread().name, priority, cpus)
+
+        if state['first_start'] is None:
+            state['first_start'] = start
+        else:
+            elapsed = start - state['first_start']
+            histogram.record(elapsed - int(elapsed / period_sec) * period_sec)
+
+        func()
+
+    job.__name__ = func.__name__
+    return job
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Recordings of the T265 and offline replay     ##
+#####################################################
+# A recording is a directory with everything the precision landing pipeline gets from the T265:
+#   meta.json       format version and calibration (K1, D1, K2, D2, R, T, input as in cfg/t265.yaml)
+#   frames.idx      one frame_index_dtype record per fisheye pair, in capture order
+#   frames_NNNN.bin chunks of losslessly compressed (PNG) images, the left then the right image of each pair
+#   poses.bin       one pose_dtype record per pose sample, in capture order
+#   reference.npy   optional, landing targets to compare the replay to (targets_dtype)
+# The index, the poses and the chunks are raw records and bytes: they are appended while recording, and
+# memory-mapped when reading, so a frame is found by its frame number without loading the recording.
+#
+# ReplaySource feeds a recording to t265_precland_apriltags.py instead of the camera (--replay), as fast as
+# the image stage takes the frames, and compares the landing targets it produces to the reference.
+#
+# A recording of a tag rendered with the calibration of cfg/t265.yaml, with its true position as reference:
+#   python3 recording.py --synthetic synthetic_recording --calib ../cfg/t265.yaml
+#   python3 recording.py --info synthetic_recording
+
+import os
+import json
+import time
+import threading
+import collections
+import argparse
+
+import numpy as np
+import cv2
+
+import landing_target
+
+format_version = 1
+
+frame_index_dtype = np.dtype([('frame_number', '<i8'), ('capture_time', '<f8'), ('exposure', '<f8'),  # exposure in s, NaN if unknown
+                              ('chunk', '<i4'), ('left_offset', '<i8'), ('left_size', '<i4'), ('right_offset', '<i8'), ('right_size', '<i4')])
+
+# Rotation as [w, x, y, z] like transformations
+pose_dtype = np.dtype([('capture_time', '<f8'), ('translation', '<f8', 3), ('velocity', '<f8', 3), ('acceleration', '<f8', 3),
+                       ('rotation', '<f8', 4), ('angular_velocity', '<f8', 3), ('angular_acceleration', '<f8', 3),
+                       ('tracker_confidence', '<i4'), ('mapper_confidence', '<i4')])
+
+# Landing targets of a run, as sent in LANDING_TARGET
+targets_dtype = np.dtype([('frame_number', '<i8'), ('capture_time', '<f8'), ('x_angle', '<f8'), ('y_angle', '<f8'), ('distance', '<f8')])
+
+# Replayed poses have the attributes of the librealsense pose data the pipeline uses
+Vector = collections.namedtuple('Vector', 'x y z')
+Quaternion = collections.namedtuple('Quaternion', 'x y z w')
+RecordedPose = collections.namedtuple('RecordedPose', 'translation velocity acceleration rotation angular_velocity '
+                                                      'angular_acceleration tracker_confidence mapper_confidence')
+
+def save_targets(path, targets):
+    np.save(path, np.array(targets, dtype=targets_dtype))
+
+def load_targets(path):
+    return np.load(path)
+
+# Lossless, level 1 is several times faster than the default and only a little larger
+def encode_image(image, level=1):
+    (ok, buffer) = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, level])
+    if not ok:
+        raise ValueError("Cannot encode image of shape %s" % (image.shape,))
+    return buffer
+
+# pose_data: librealsense pose data or RecordedPose
+def pose_record(capture_time, pose_data):
+    vector = lambda v: (v.x, v.y, v.z)
+    return np.array((capture_time, vector(pose_data.translation), vector(pose_data.velocity), vector(pose_data.acceleration),
+                     (pose_data.rotation.w, pose_data.rotation.x, pose_data.rotation.y, pose_data.rotation.z),
+                     vector(pose_data.angular_velocity), vector(pose_data.angular_acceleration),
+                     pose_data.tracker_confidence, pose_data.mapper_confidence), dtype=pose_dtype)
+
+# Calibration of recordings, in the format of fisheye_rectify.load_calibration
+def calibration_to_json(calib):
+    return {name: np.asarray(calib[name]).tolist() for name in ("K1", "D1", "K2", "D2", "R", "T", "input")}
+
+def calibration_from_json(calib):
+    calibration = {name: np.array(calib[name], dtype=np.float64) for name in ("K1", "D1", "K2", "D2", "R", "T")}
+    calibration["input"] = tuple(calib["input"])
+    return calibration
+
+# Records of a raw file, memory-mapped
+def memmap_records(path, dtype):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(os.path.getsize(path) // dtype.itemsize,))
+
+class RecordingWriter(object):
+    # calib: in the format of fisheye_rectify.load_calibration. chunk_bytes: size at which a new chunk is started
+    def __init__(self, path, calib, chunk_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        os.makedirs(path)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({"format": format_version, "calibration": calibration_to_json(calib)}, f, indent=1)
+        self.index = open(os.path.join(path, 'frames.idx'), 'ab')
+        self.poses = open(os.path.join(path, 'poses.bin'), 'ab')
+        self.chunk = -1
+        self.chunk_file = None
+        self.chunk_size = 0
+        self.lock = threading.Lock()
+
+        self.frame_count = 0
+        self.pose_count = 0
+        self.bytes_written = 0
+
+    def next_chunk(self):
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+            self.index.flush()
+            self.poses.flush()
+        self.chunk += 1
+        self.chunk_file = open(os.path.join(self.path, 'frames_%04d.bin' % self.chunk), 'wb')
+        self.chunk_size = 0
+
+    # left, right: encoded with encode_image. exposure in seconds, None if unknown. Pairs must come in capture order
+    def add_frameset(self, frame_number, capture_time, exposure, left, right):
+        with self.lock:
+            if self.chunk_file is None or self.chunk_size + len(left) + len(right) > self.chunk_bytes:
+                self.next_chunk()
+            record = np.array((frame_number, capture_time, np.nan if exposure is None else exposure, self.chunk,
+                               self.chunk_size, len(left), self.chunk_size + len(left), len(right)), dtype=frame_index_dtype)
+            self.chunk_file.write(left)
+            self.chunk_file.write(right)
+            self.index.write(record.tobytes())
+            self.chunk_size += len(left) + len(right)
+            self.bytes_written += len(left) + len(right) + frame_index_dtype.itemsize
+            self.frame_count += 1
+
+    # pose_data: librealsense pose data or RecordedPose. Poses must come in capture order
+    def add_pose(self, capture_time, pose_data):
+        with self.lock:
+            self.poses.write(pose_record(capture_time, pose_data).tobytes())
+            self.bytes_written += pose_dtype.itemsize
+            self.pose_count += 1
+
+    def close(self):
+        with self.lock:
+            if self.chunk_file is not None:
+                self.chunk_file.close()
+            self.index.close()
+            self.poses.close()
+
+class Recording(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta["format"] != format_version:
+            raise ValueError("Recording %s has format %s, expected %d" % (path, meta["format"], format_version))
+        self.calibration = calibration_from_json(meta["calibration"])
+        self.frames = memmap_records(os.path.join(path, 'frames.idx'), frame_index_dtype)
+        self.poses = memmap_records(os.path.join(path, 'poses.bin'), pose_dtype)
+        self.chunks = {}
+        reference_path = os.path.join(path, 'reference.npy')
+        self.reference = load_targets(reference_path) if os.path.exists(reference_path) else None
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Index of the pair with this frame number, None if it was not recorded
+    def index_of(self, frame_number):
+        i = np.searchsorted(self.frames['frame_number'], frame_number)
+        if i < len(self.frames) and self.frames['frame_number'][i] == frame_number:
+            return int(i)
+        return None
+
+    # Decoded (left, right) images of the pair at index i, None for the sides not asked for
+    def images(self, i, sides=('left', 'right')):
+        record = self.frames[i]
+        chunk = int(record['chunk'])
+        if chunk not in self.chunks:
+            self.chunks[chunk] = np.memmap(os.path.join(self.path, 'frames_%04d.bin' % chunk), dtype=np.uint8, mode='r')
+        data = self.chunks[chunk]
+        images = []
+        for side in ('left', 'right'):
+            if side not in sides:
+                images.append(None)
+                continue
+            (offset, size) = (int(record[side + '_offset']), int(record[side + '_size']))
+            images.append(cv2.imdecode(np.asarray(data[offset:offset + size]), cv2.IMREAD_UNCHANGED))
+        return tuple(images)
+
+    # Pose sample at index i, as RecordedPose
+    def pose(self, i):
+        record = self.poses[i]
+        (w, x, y, z) = record['rotation']
+        return RecordedPose(Vector(*record['translation']), Vector(*record['velocity']), Vector(*record['acceleration']),
+                            Quaternion(x, y, z, w), Vector(*record['angular_velocity']), Vector(*record['angular_acceleration']),
+                            int(record['tracker_confidence']), int(record['mapper_confidence']))
+
+    def duration(self):
+        if len(self.frames) < 2:
+            return 0.0
+        return float(self.frames['capture_time'][-1] - self.frames['capture_time'][0])
+
+    def report(self):
+        (width, height) = self.calibration["input"]
+        compressed = int(np.sum(self.frames['left_size'], dtype=np.int64) + np.sum(self.frames['right_size'], dtype=np.int64))
+        ratio = len(self.frames) * 2 * width * height / compressed if compressed > 0 else 0.0
+        lines = ["INFO: Recording %s: %d fisheye pairs of %dx%d px and %d poses over %.1f s, %.1f MB in %d chunks, compression ratio %.2f" %
+                 (self.path, len(self.frames), width, height, len(self.poses), self.duration(), compressed / 1e6,
+                  len(np.unique(self.frames['chunk'])), ratio)]
+        if self.reference is not None:
+            lines.append("INFO:     reference: %d landing targets" % len(self.reference))
+        return "\n".join(lines)
+
+# Replays a recording through the pipeline, in place of the camera callback and the pose stage
+class ReplaySource(object):
+    # reference_path: targets to compare to (see save_targets), instead of the reference of the recording.
+    # sides: images the pipeline uses, the others are not decoded and replayed as None
+    def __init__(self, path, reference_path=None, sides=('left', 'right')):
+        self.recording = Recording(path)
+        self.sides = sides
+        self.reference = load_targets(reference_path) if reference_path else self.recording.reference
+        self.frame_numbers = dict(zip(self.recording.frames['capture_time'].tolist(), self.recording.frames['frame_number'].tolist()))
+        self.targets = []
+        self.thread = None
+        self.done = threading.Event()
+        self.frame_count = 0
+        self.pose_count = 0
+        self.start_time = None
+        self.end_time = None
+
+    # Calls pose_callback(pose, capture_time) for each pose and puts the pairs into image_slot, in capture order.
+    # A pair is only put once the previous one was taken, so none is dropped and the replay goes as fast as
+    # the consumer of image_slot
+    def start(self, pose_callback, image_slot):
+        self.thread = threading.Thread(target=self.run, args=(pose_callback, image_slot))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, pose_callback, image_slot):
+        frames = self.recording.frames
+        pose_times = self.recording.poses['capture_time']
+        p = 0
+        self.start_time = time.time()
+        for i in range(len(frames)):
+            record = frames[i]
+            capture_time = float(record['capture_time'])
+            while p < len(pose_times) and pose_times[p] <= capture_time:
+                pose_callback(self.recording.pose(p), float(pose_times[p]))
+                p += 1
+                self.pose_count += 1
+            # Decoded while the previous pair is processed
+            (left, right) = self.recording.images(i, self.sides)
+            image_slot.wait_taken()
+            exposure = None if np.isnan(record['exposure']) else float(record['exposure'])
+            image_slot.put({"frame_number"  : int(record['frame_number']),
+                            "timestamp"     : capture_time * 1e3,
+                            "capture_time"  : capture_time,
+                            "arrival_time"  : time.time(),
+                            "exposure"      : exposure,
+                            "left"          : left,
+                            "right"         : right,
+                            "frameset"      : None})
+            self.frame_count += 1
+        image_slot.wait_taken()
+        self.end_time = time.time()
+        self.done.set()
+
+    # All pairs were taken by the consumer
+    def finished(self):
+        return self.done.is_set()
+
+    # Landing target detected at position_camera (x right, y down, z forward) in the pair taken at capture_time
+    def record_target(self, capture_time, position_camera):
+        (x_angle, y_angle, distance) = landing_target.target_angles(position_camera)
+        self.targets.append((self.frame_numbers.get(capture_time, -1), capture_time, x_angle, y_angle, distance))
+
+    def save_targets(self, path):
+        save_targets(path, self.targets)
+
+    def report(self):
+        elapsed = (self.end_time or time.time()) - (self.start_time or time.time())
+        replayed = self.recording.frames[:self.frame_count]
+        recorded = float(replayed['capture_time'][-1] - replayed['capture_time'][0]) if self.frame_count > 1 else 0.0
+        lines = ["INFO: Replay: %d pairs and %d poses of %.1f s replayed in %.1f s, %.1fx real time, %d landing targets" %
+                 (self.frame_count, self.pose_count, recorded, elapsed, recorded / elapsed if elapsed > 0 else 0.0, len(self.targets))]
+        if self.reference is None:
+            return "\n".join(lines)
+
+        # Reference targets of the replayed pairs, and the target of the run for the same pair
+        reference = self.reference[np.isin(self.reference['frame_number'], replayed['frame_number'])]
+        targets = {target[0]: target for target in self.targets}
+        matched = [(ref, targets[ref['frame_number']]) for ref in reference if ref['frame_number'] in targets]
+        extra = len(set(targets) - set(reference['frame_number'].tolist()))
+        recall = len(matched) / len(reference) if len(reference) > 0 else 0.0
+        lines.append("INFO:     recall %.3f (%d of %d reference targets), %d targets without reference" % (recall, len(matched), len(reference), extra))
+        if matched:
+            angle_errors = np.array([np.hypot(target[2] - ref['x_angle'], target[3] - ref['y_angle']) for (ref, target) in matched])
+            distance_errors = np.array([abs(target[4] - ref['distance']) for (ref, target) in matched])
+            lines.append("INFO:     target angle error mean %.2f mrad p95 %.2f mrad max %.2f mrad, distance error mean %.3f m" %
+                         (np.mean(angle_errors) * 1e3, np.percentile(angle_errors, 95) * 1e3, np.max(angle_errors) * 1e3, np.mean(distance_errors)))
+        return "\n".join(lines)
+
+#######################################
+# Synthetic recording
+#######################################
+
+# A tag descending from 3 m to 0.5 m in front of a static camera, sweeping across the field of view, with
+# its true position as reference. The pose of the T265 is constant. side: camera the tags are detected in, the
+# reference is in its rectified frame (the right one is rotated by R like in t265_precland_apriltags.py)
+def synthetic_recording(path, calib, tag_size=0.144, num_frames=60, rate_hz=30, pose_rate_hz=200, side='right'):
+    import fisheye_tag_detection
+
+    texture = fisheye_tag_detection.tag_texture(0)
+    texture_tag_px = texture.shape[1] * 8 // 10
+    H_right_left = np.eye(4)
+    H_right_left[:3, :3] = calib["R"].T
+    H_right_left[:3, 3] = calib["T"]
+    zero = Vector(0.0, 0.0, 0.0)
+    pose = RecordedPose(zero, zero, zero, Quaternion(0.0, 0.0, 0.0, 1.0), zero, zero, 3, 3)
+    random = np.random.RandomState(0)
+
+    writer = RecordingWriter(path, calib)
+    reference = []
+    start = time.time()
+    pose_time = start - 0.1
+    for i in range(num_frames):
+        capture_time = start + i / rate_hz
+        while pose_time <= capture_time:
+            writer.add_pose(pose_time, pose)
+            pose_time += 1 / pose_rate_hz
+
+        fraction = i / max(1, num_frames - 1)
+        distance = 3.0 - 2.5 * fraction
+        H_left_tag = np.eye(4)
+        H_left_tag[:3, :3] = np.diag([1.0, -1.0, -1.0])
+        H_left_tag[:3, 3] = [0.3 * distance * np.sin(2 * np.pi * fraction), 0.2 * distance * np.cos(2 * np.pi * fraction), distance]
+        images = []
+        for (K, D, H) in ((calib["K1"], calib["D1"], H_left_tag), (calib["K2"], calib["D2"], H_right_left.dot(H_left_tag))):
+            image = fisheye_tag_detection.render_tag(K, D, calib["input"], H, texture, texture_tag_px, tag_size)
+            images.append(encode_image(np.clip(image + random.normal(0, 4, image.shape), 0, 255).astype(np.uint8)))
+        writer.add_frameset(i, capture_time, 0.008, images[0], images[1])
+        position = H_left_tag[:3, 3] if side == 'left' else calib["R"].dot(H_right_left.dot(H_left_tag)[:3, 3])
+        reference.append((i, capture_time) + landing_target.target_angles(position))
+    writer.close()
+    save_targets(os.path.join(path, 'reference.npy'), reference)
+
+if __name__ == "__main__":
+    import fisheye_rectify
+
+    parser = argparse.ArgumentParser(description='Summary of a recording, or a synthetic recording for t265_precland_apriltags.py --replay')
+    parser.add_argument('--info', type=str,
+                        help="Recording to summarize")
+    parser.add_argument('--synthetic', type=str,
+                        help="Directory of the synthetic recording to create")
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml, for the synthetic recording")
+    parser.add_argument('--tag_size', type=float, default=0.144,
+                        help="Size of the tag in meters")
+    parser.add_argument('--frames', type=int, default=60,
+                        help="Number of fisheye pairs of the synthetic recording")
+    parser.add_argument('--side', type=str, default='right', choices=('left', 'right'),
+                        help="Camera the tags are detected in (tag_image_source), for the reference of the synthetic recording")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        synthetic_recording(args.synthetic, fisheye_rectify.load_calibration(args.calib), args.tag_size, args.frames, side = args.side)
+        print(Recording(args.synthetic).report())
+    if args.info:
+        print(Recording(args.info).report())
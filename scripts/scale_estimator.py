@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+#####################################################
+##     Online scale estimator for the T265         ##
+#####################################################
+# Estimates the scale factor between the T265 position and an independent distance source of the FCU
+# (rangefinder, barometer altitude or GPS) while flying, instead of typing in a scale by hand.
+#
+# Model: the displacement measured by the reference equals scale * displacement measured by the T265.
+# Displacements are taken between consecutive accepted samples, so constant offsets between the two
+# sources (e.g. barometer altitude vs. T265 origin) cancel out. A sample is only accepted once the T265
+# has moved by min_displacement, so noise is not fitted while the vehicle holds still.
+#
+# The scalar is solved with recursive least squares with a forgetting factor, which is O(1) per sample.
+
+import math as m
+
+# Altitude from static pressure, standard atmosphere. press_hpa: absolute pressure in hPa
+def pressure_altitude(press_hpa, press_sea_level_hpa=1013.25):
+    return 44330.0 * (1.0 - (press_hpa / press_sea_level_hpa) ** (1.0 / 5.255))
+
+# Local north/east/up position in meters of a GPS fix relative to an origin fix (equirectangular, fine for a few km)
+def gps_to_local(lat_deg, lon_deg, alt_m, origin_lat_deg, origin_lon_deg, origin_alt_m):
+    earth_radius = 6378137.0
+    north = m.radians(lat_deg - origin_lat_deg) * earth_radius
+    east  = m.radians(lon_deg - origin_lon_deg) * earth_radius * m.cos(m.radians(origin_lat_deg))
+    return (north, east, alt_m - origin_alt_m)
+
+class ScaleEstimator(object):
+    def __init__(self, initial_scale=1.0, forgetting_factor=0.99, min_displacement=0.1, initial_variance=1.0):
+        self.scale = initial_scale
+        self.P = initial_variance               # RLS covariance, scaled by the measurement noise
+        self.forgetting_factor = forgetting_factor
+        self.min_displacement = min_displacement
+        self.noise_variance = None              # exponentially weighted variance of the residuals
+        self.num_samples = 0
+        self.anchor_t265 = None
+        self.anchor_reference = None
+
+    # Forget the anchor, e.g. after a T265 pose jump or relocalization
+    def reset_anchor(self):
+        self.anchor_t265 = None
+        self.anchor_reference = None
+
+    # t265_position and reference_position: both scalars (altitudes) or both sequences (positions).
+    # For positions, the lengths of the displacements are compared, so the two frames need not be aligned.
+    # Returns True if the sample was used.
+    def add_sample(self, t265_position, reference_position):
+        if self.anchor_t265 is None:
+            self.anchor_t265 = t265_position
+            self.anchor_reference = reference_position
+            return False
+
+        if isinstance(t265_position, (int, float)):
+            x = t265_position - self.anchor_t265
+            y = reference_position - self.anchor_reference
+        else:
+            x = m.sqrt(sum((a - b) ** 2 for (a, b) in zip(t265_position, self.anchor_t265)))
+            y = m.sqrt(sum((a - b) ** 2 for (a, b) in zip(reference_position, self.anchor_reference)))
+
+        if abs(x) < self.min_displacement:
+            return False
+        self.anchor_t265 = t265_position
+        self.anchor_reference = reference_position
+
+        # Recursive least squares update for y = scale * x
+        lam = self.forgetting_factor
+        error = y - self.scale * x
+        gain = self.P * x / (lam + x * self.P * x)
+        self.scale += gain * error
+        self.P = (self.P - gain * x * self.P) / lam
+
+        if self.noise_variance is None:
+            self.noise_variance = error * error
+        else:
+            self.noise_variance = lam * self.noise_variance + (1 - lam) * error * error
+        self.num_samples += 1
+        return True
+
+    # Standard deviation of the scale estimate
+    def std(self):
+        if self.noise_variance is None:
+            return float('inf')
+        return m.sqrt(self.noise_variance * self.P)
+
+    # Confidence bounds, by default about 95%
+    def bounds(self, num_std=2.0):
+        return (self.scale - num_std * self.std(), self.scale + num_std * self.std())
+
+    def is_converged(self, max_std=0.02, min_samples=20):
+        return self.num_samples >= min_samples and self.std() <= max_std
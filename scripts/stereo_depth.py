@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Stereo depth to OBSTACLE_DISTANCE             ##
+#####################################################
+# Disparity of the T265 fisheye pair, turned into the distance to the nearest obstacle in 72 sectors across
+# the horizontal field of view, as expected by MAVLink OBSTACLE_DISTANCE.
+#
+# Semi-global matching takes tens of milliseconds per frame even on downsampled images, so it runs in a
+# worker process at a lower priority. The image stage only copies the pair into a shared memory slot
+# (latest only, dropped if the worker is reading it) at most rate_hz times per second, so the pose and tag
+# paths do the same work whether the worker keeps up or not. The pair is rectified straight to the low
+# resolution of the stereo geometry, that is the downsampling: either by the image stage before the copy
+# (see fisheye_frontend.py, a few kB instead of the whole frames), or by the worker from the raw pair.
+#
+# Disparity to range uses the Q matrix of the rectified pair, on the band of rows around the horizon only.
+# The distance of a sector is a low percentile of the ranges of its matched pixels, not their minimum: a few
+# wrong matches would otherwise win and bring every wall closer. Sectors with too few matched pixels are
+# reported as unknown (UINT16_MAX), sectors farther than max_distance as free (max_distance + 1).
+#
+# Workers are forked, create the worker before starting threads or connecting to devices.
+#
+# Compute time per frame at several resolutions, on a textured wall rendered with cfg/t265.yaml:
+#   python3 stereo_depth.py --heights 100 150 200 300
+
+import os
+import time
+import math as m
+import queue
+import signal
+import argparse
+
+import numpy as np
+import cv2
+
+import fisheye_rectify
+import pipeline_utils
+
+sector_count = 72
+unknown_distance = 65535
+
+# Parameters of cv2.StereoSGBM_create for grayscale images.
+# See https://docs.opencv.org/3.4/d2/d85/classcv_1_1StereoSGBM.html for a description of the parameters
+def sgbm_params(min_disparity, num_disparities, window_size):
+    return dict(minDisparity = min_disparity,
+                numDisparities = num_disparities,
+                blockSize = window_size,
+                P1 = 8 * window_size**2,
+                P2 = 32 * window_size**2,
+                disp12MaxDiff = 1,
+                uniquenessRatio = 10,
+                speckleWindowSize = 100,
+                speckleRange = 32)
+
+# Q matrix of a pair rectified to the same RectifyGeometry, the right one shifted by baseline (negative
+# when the right camera is on the right, as the T265 extrinsics give it). [x, y, d, 1] -> [X, Y, Z, W]
+def stereo_q_matrix(geometry, baseline):
+    f = geometry.focal_px()
+    (cx, cy) = geometry.principal_point()
+    return np.array([[1, 0, 0, -cx],
+                     [0, 1, 0, -cy],
+                     [0, 0, 0, f],
+                     [0, 0, -1 / baseline, 0]])
+
+# Disparity image to the distances of OBSTACLE_DISTANCE
+class ObstacleSectors(object):
+    # geometry: of the rectified pair, the padding on the left has no valid disparity.
+    # band_fraction: fraction of the rows, around the horizon, searched for obstacles. percentile: of the
+    # ranges of the matched pixels of a sector, its distance. min_matched_fraction: of the pixels of a sector,
+    # to report a distance
+    def __init__(self, geometry, Q, min_disparity, min_distance_m, max_distance_m, band_fraction=1/3,
+                 percentile=5, min_matched_fraction=0.05):
+        (width, height) = geometry.size()
+        self.Q = Q.astype(np.float32)
+        self.min_disparity = min_disparity
+        self.percentile = percentile
+        self.min_distance_cm = int(round(min_distance_m * 100))
+        self.max_distance_cm = int(round(max_distance_m * 100))
+        self.rows = slice(int(round(height * (1 - band_fraction) / 2)), int(round(height * (1 + band_fraction) / 2)))
+        self.columns = slice(geometry.pad_left_px, width)
+
+        # Homogeneous pixels of the band, the disparity goes in the third coordinate
+        (x, y) = np.meshgrid(np.arange(width)[self.columns], np.arange(height)[self.rows])
+        self.pixels = np.stack((x, y, np.zeros_like(x), np.ones_like(x)), axis=-1).astype(np.float32)
+
+        # Sectors from left to right, angles positive to the right like the x axis of the camera
+        f = geometry.focal_px()
+        fov_deg = m.degrees(2 * m.atan(geometry.width_px / 2 / f))
+        self.increment_deg = fov_deg / sector_count
+        self.angle_offset_deg = -fov_deg / 2
+        angles_deg = np.degrees(np.arctan((x[0] - geometry.principal_point()[0]) / f))
+        self.column_sector = np.clip(((angles_deg - self.angle_offset_deg) / self.increment_deg).astype(int), 0, sector_count - 1)
+        self.pixel_sector = np.broadcast_to(self.column_sector, x.shape)
+        sector_pixels = np.bincount(self.pixel_sector.ravel(), minlength=sector_count)
+        self.min_matched_px = np.maximum(1, np.ceil(sector_pixels * min_matched_fraction)).astype(int)
+
+    # disparity: from StereoSGBM, 16.4 fixed point. Returns the distances in cm, uint16
+    def distances_cm(self, disparity):
+        d = disparity[self.rows, self.columns].astype(np.float32) / 16.0
+        pixels = self.pixels.copy()
+        pixels[..., 2] = d
+        points = pixels.dot(self.Q.T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            horizontal_range = np.hypot(points[..., 0], points[..., 2]) / points[..., 3]
+        # Unmatched pixels have min_disparity - 1, zero disparity is farther than any range
+        matched = d >= self.min_disparity
+        horizontal_range[d <= 0] = np.inf
+
+        # Ranges of the matched pixels sorted by sector then range, the percentile is picked in each sector
+        ranges = horizontal_range[matched]
+        sectors = self.pixel_sector[matched]
+        order = np.lexsort((ranges, sectors))
+        counts = np.bincount(sectors, minlength=sector_count)
+        starts = np.cumsum(counts) - counts
+        known = counts >= self.min_matched_px
+        sector_range = np.full(sector_count, np.inf)
+        if known.any():
+            ranks = (counts[known] - 1) * self.percentile // 100
+            sector_range[known] = ranges[order[starts[known] + ranks]]
+
+        distances = np.clip(sector_range * 100, self.min_distance_cm, self.max_distance_cm + 1)
+        distances[~known] = unknown_distance
+        return distances.astype(np.uint16)
+
+# Rectify the raw pair, match and bin. Returns the distances and the disparity. maps: None for a pair
+# already rectified
+def compute_distances(stereo, maps, sectors, raw_left, raw_right):
+    (left, right) = (raw_left, raw_right)
+    if maps is not None:
+        left = fisheye_rectify.remap(raw_left, maps[0])
+        right = fisheye_rectify.remap(raw_right, maps[1])
+    disparity = stereo.compute(left, right)
+    return (sectors.distances_cm(disparity), disparity)
+
+def worker_main(control, lock, new_frame, results, niceness):
+    # Ctrl-C is for the main process, which stops the worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Below the pose and tag stages, with one core
+    os.nice(niceness)
+    cv2.setNumThreads(1)
+
+    setup = control.get()
+    if setup is None:
+        return
+    (slot_spec, maps, params, sectors) = setup
+    slot = pipeline_utils.SharedLatestSlot('stereo', lock, new_frame, *slot_spec)
+    stereo = cv2.StereoSGBM_create(**params)
+    try:
+        while True:
+            try:
+                if control.get_nowait() is None:
+                    break
+            except queue.Empty:
+                pass
+            item = slot.get(0.1)
+            if item is None:
+                continue
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            (distances, _) = compute_distances(stereo, maps, sectors, item["left"], item["right"])
+            (frame_number, capture_time) = item["meta"]
+            results.put((int(frame_number), capture_time, distances, time.perf_counter() - start, time.process_time() - cpu_start))
+    finally:
+        slot.close()
+
+class StereoDepth(object):
+    # rate_hz: at most this many pairs are handed to the worker per second
+    def __init__(self, rate_hz, niceness=10):
+        self.rate_hz = rate_hz
+        context = pipeline_utils.fork_context()
+        self.control = context.Queue()
+        self.results = context.Queue()
+        self.lock = context.Lock()
+        self.new_frame = context.Event()
+        self.slot = None
+        self.sectors = None
+        self.process = context.Process(target=worker_main, name="stereo_depth",
+                                       args=(self.control, self.lock, self.new_frame, self.results, niceness))
+        self.process.daemon = True
+        self.process.start()
+
+        self.last_submit = 0.0
+        self.latest_result = None
+        self.result_count = 0
+        self.compute_time_sum = 0.0
+        self.compute_time_max = 0.0
+        self.cpu_time_sum = 0.0
+
+    # frame_shape: of the frames handed to submit. maps: (left, right) from the raw fisheye frames to the
+    # rectified geometry, None when the frames are rectified already. baseline: of the right projection
+    # matrix, see stereo_q_matrix. params: of cv2.StereoSGBM_create, see sgbm_params
+    def setup(self, frame_shape, maps, geometry, baseline, params, min_distance_m, max_distance_m, band_fraction=1/3):
+        self.geometry = geometry
+        self.sectors = ObstacleSectors(geometry, stereo_q_matrix(geometry, baseline), params['minDisparity'],
+                                       min_distance_m, max_distance_m, band_fraction)
+        self.slot = pipeline_utils.SharedLatestSlot('stereo', self.lock, self.new_frame,
+                                                    {"meta": ((2,), np.float64),
+                                                     "left": (frame_shape, np.uint8),
+                                                     "right": (frame_shape, np.uint8)})
+        self.control.put((self.slot.spec(), maps, params, self.sectors))
+
+    # Whether submit would take a pair now, to only produce the pair when it would
+    def due(self):
+        return self.slot is not None and time.time() - self.last_submit >= 1 / self.rate_hz
+
+    # Never waits. Returns False when the pair was not handed to the worker
+    def submit(self, frame_number, capture_time, raw_left, raw_right):
+        now = time.time()
+        if not self.due():
+            return False
+        if not self.slot.put(meta = (frame_number, capture_time), left = raw_left, right = raw_right):
+            return False
+        self.last_submit = now
+        return True
+
+    # Newest result as (frame_number, capture_time, distances in cm), None if there is none yet
+    def latest(self):
+        while True:
+            try:
+                (frame_number, capture_time, distances, compute_time, cpu_time) = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.latest_result = (frame_number, capture_time, distances)
+            self.result_count += 1
+            self.compute_time_sum += compute_time
+            self.compute_time_max = max(self.compute_time_max, compute_time)
+            self.cpu_time_sum += cpu_time
+        return self.latest_result
+
+    def close(self):
+        self.control.put(None)
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+        if self.slot is not None:
+            self.slot.close()
+
+    def report(self):
+        if self.slot is None:
+            return "INFO: Stereo depth: not set up"
+        count = max(1, self.result_count)
+        return ("INFO: Stereo depth at %s: %d frames, compute mean %.1f ms max %.1f ms, worker CPU %.2f s\n%s" %
+                (self.geometry, self.result_count, self.compute_time_sum / count * 1e3, self.compute_time_max * 1e3,
+                 self.cpu_time_sum, self.slot.report()))
+
+#######################################
+# Compute time per resolution
+#######################################
+
+# Raw fisheye pair of a fronto-parallel wall with a random texture at distance_m from the left camera
+def synthetic_pair(calib, distance_m, wall_size_m=20.0, texture_px=4096):
+    import fisheye_tag_detection
+
+    random = np.random.RandomState(0)
+    texture = cv2.GaussianBlur(random.randint(0, 256, (texture_px, texture_px)).astype(np.uint8), (0, 0), 2)
+    texture = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX)
+    H_left_wall = np.eye(4)
+    H_left_wall[2, 3] = distance_m
+    # Right camera from the left one. The rectification rotates the right camera by R, so the render undoes it
+    H_right_left = np.eye(4)
+    H_right_left[:3, :3] = calib["R"].T
+    H_right_left[:3, 3] = calib["T"]
+    pair = []
+    for (K, D, H) in ((calib["K1"], calib["D1"], H_left_wall), (calib["K2"], calib["D2"], H_right_left.dot(H_left_wall))):
+        pair.append(fisheye_tag_detection.render_tag(K, D, calib["input"], H, texture, texture_px, wall_size_m))
+    return pair
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures the stereo depth compute time per frame at several resolutions')
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml")
+    parser.add_argument('--heights', type=int, nargs='+', default=[100, 150, 200, 300],
+                        help="Heights in pixels of the rectified images to measure")
+    parser.add_argument('--fov', type=float, default=90,
+                        help="Field of view in degrees of the rectified images")
+    parser.add_argument('--num_disp', type=int, default=32,
+                        help="Number of disparities, divisible by 16")
+    parser.add_argument('--window_size', type=int, default=5,
+                        help="Matching block size, odd")
+    parser.add_argument('--distance', type=float, default=1.5,
+                        help="Distance in meters of the rendered wall")
+    parser.add_argument('--iterations', type=int, default=20,
+                        help="Frames per measurement")
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    calib = fisheye_rectify.load_calibration(args.calib)
+    (raw_left, raw_right) = synthetic_pair(calib, args.distance)
+    baseline = calib["T"][0]
+    params = sgbm_params(0, args.num_disp, args.window_size)
+    stereo = cv2.StereoSGBM_create(**params)
+
+    print("INFO: Wall at %.2f m, %d disparities, one thread" % (args.distance, args.num_disp))
+    print("%-24s %10s %12s %12s %10s %10s" % ("geometry", "min dist m", "rectify ms", "disparity ms", "total ms", "center m"))
+    for height in args.heights:
+        geometry = fisheye_rectify.RectifyGeometry(height, args.fov, pad_left_px = args.num_disp)
+        maps = (fisheye_rectify.build_maps(calib["K1"], calib["D1"], np.eye(3), geometry.projection_matrix(), geometry.size()),
+                fisheye_rectify.build_maps(calib["K2"], calib["D2"], calib["R"], geometry.projection_matrix(baseline), geometry.size()))
+        sectors = ObstacleSectors(geometry, stereo_q_matrix(geometry, baseline), 0, 0.1, 10.0)
+
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            rectified = (fisheye_rectify.remap(raw_left, maps[0]), fisheye_rectify.remap(raw_right, maps[1]))
+        rectify_ms = (time.perf_counter() - start) / args.iterations * 1e3
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            (distances, _) = compute_distances(stereo, maps, sectors, raw_left, raw_right)
+        total_ms = (time.perf_counter() - start) / args.iterations * 1e3
+
+        min_distance_m = geometry.focal_px() * abs(baseline) / (args.num_disp - 1)
+        center = distances[sector_count // 2 - 1:sector_count // 2 + 1]
+        center_m = np.mean(center) / 100 if np.all(center != unknown_distance) else float('nan')
+        print("%-24s %10.2f %12.2f %12.2f %10.2f %10.2f" % (geometry, min_distance_m, rectify_ms, total_ms - rectify_ms, total_ms, center_m))
@@ -37,6 +37,24 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from dronekit import connect, VehicleMode
 from pymavlink import mavutil
 
+import mavlink_inbound_filter
+import pipeline_utils
+import fisheye_rectify
+import fisheye_frontend
+import tag_tracking
+import fisheye_tag_detection
+import tag_detector_control
+import tag_detector_tuning
+import tag_detector_pool
+import pose_history
+import landing_target
+import tag_bundle
+import tag_visualization
+import stereo_depth
+import recording
+import frame_recorder
+import blur_gate
+
 try:
     import apriltags3 
 except ImportError:
@@ -52,6 +70,7 @@ connection_baudrate_default = 921600
 vision_msg_hz_default = 20
 landing_target_msg_hz_default = 20
 confidence_msg_hz_default = 1
+detection_stats_msg_hz = 1
 camera_orientation_default = 1
 
 # In NED frame, offset from the IMU or the center of gravity to the camera's origin point
@@ -65,6 +84,11 @@ scale_factor = 1.0
 
 # Enable using yaw from compass to align north (zero degree is facing north)
 compass_enabled = 0
+attitude_msg_hz_default = 10    # Rate at which ATTITUDE is requested from the FCU when compass is enabled
+
+# Only decode the inbound MAVLink messages that are used, and ask the FCU to stop streaming the others
+enable_inbound_msg_filter = True
+inbound_msg_filter = None
 
 # Default global position of home/ origin
 home_lat = 151269321       # Somewhere in Africa
@@ -80,6 +104,89 @@ pipe = None
 # pose data confidence: 0x0 - Failed / 0x1 - Low / 0x2 - Medium / 0x3 - High 
 pose_data_confidence_level = ('Failed', 'Low', 'Medium', 'High')
 
+# With debug messages enabled, rate and latency of each pipeline stage are printed at this interval
+stage_stats_report_sec = 10
+
+# Stereo depth, sent as OBSTACLE_DISTANCE in 72 sectors. The disparity of the downsampled pair is computed
+# in a worker process, see stereo_depth.py. Only for a forward-facing camera (camera_orientation 0)
+stereo_enable = 0
+stereo_window_size = 5
+stereo_min_disp = 0
+stereo_num_disp = 32 - stereo_min_disp      # must be divisible by 16
+stereo_max_disp = stereo_min_disp + stereo_num_disp
+obstacle_distance_msg_hz = 5
+obstacle_distance_min_m = 0.2               # about the range of stereo_max_disp at 150 px
+obstacle_distance_max_m = 4.0
+obstacle_distance_band = 1/3                # fraction of the rows, around the horizon, searched for obstacles
+stereo_depth_worker = None
+
+# Output geometry of the rectified images, per consumer. The stereo algorithm needs max_disp extra
+# pixels in order to produce valid disparity on the desired output region, the tag detector does not.
+# 300x300 pixels with a 90 degree field of view seems to work ok for the tags. Stereo runs on a downsampled
+# pair, run stereo_depth.py for the compute time per frame at other resolutions
+tag_rectify_geometry    = fisheye_rectify.RectifyGeometry(height_px = 300, fov_deg = 90)
+stereo_rectify_geometry = fisheye_rectify.RectifyGeometry(height_px = 150, fov_deg = 90, pad_left_px = stereo_max_disp)
+
+# Every consumer gets a grayscale view of the fisheye streams of the size it needs, computed at most once per
+# frame, and only the views are copied to the workers, see fisheye_frontend.py. The viewer rectifies the raw
+# crop of the tag view downsampled by viewer_raw_scale, the raw tag detection (tag_detection_mode = "raw")
+# searches it downsampled by tag_raw_scale
+viewer_raw_scale = 2
+tag_raw_scale = 1
+stream_frontend = None
+
+# Float maps remap faster on x86 at every size. Fixed-point maps (cv2.CV_16SC2) are a quarter smaller and may
+# be faster on ARM boards, run fisheye_rectify.py to compare on yours
+rectify_map_type = cv2.CV_32FC1
+
+# Rectification maps are cached on disk and memory-mapped on the next start, until the calibration changes
+enable_rectify_cache = True
+rectify_cache_dir_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rectify_cache')
+
+# Region (x0, y0, x1, y1) of the rectified image that tag detection runs on, None for the whole image
+tag_roi = None
+
+# Where tags are detected:
+#   "rectified": in the rectified image
+#   "raw": in the raw fisheye image, cropped to the field of view of the rectified image. Only the corners
+#          are undistorted and the pose is solved from them, which saves the remap. Compare both on your
+#          calibration with fisheye_tag_detection.py
+tag_detection_mode = "rectified"
+raw_tag_detector = None
+
+# Once the landing tag is found, only rectify and search a region around where it is predicted to be next.
+# The whole image is searched again after a miss, and at least every tag_tracking_full_search_frames frames
+tag_tracking_enable = True
+tag_tracking_full_search_frames = 30
+tag_tracker = None
+
+# Predict the motion blur of each frame from the T265 angular velocity and the exposure, see blur_gate.py.
+# Above the soft threshold a frame is only searched around the tracked tag, above the hard one not at all.
+# With blur_gate_enforce = False the gate only measures, to compare the detections per CPU second of both
+blur_gate_enable = True
+blur_gate_enforce = True
+blur_gate_soft_px = 1.5
+blur_gate_hard_px = 3.0
+blur_gate_default_exposure_sec = 0.008     # when the camera does not report the exposure of the frame
+tag_blur_gate = None
+
+# T265 pose in the T265 reference frame, for the tag tracking, and angular velocity in the camera frame
+H_T265Ref_T265body_latest = None
+angular_velocity_camera_latest = None
+
+# Recent T265 poses by capture time, to pair each detection with the camera pose when its image was taken
+t265_pose_history = pose_history.PoseHistory()
+
+# Between detections, send LANDING_TARGET at landing_target_msg_hz with the last detected position seen from
+# the latest T265 pose, for up to landing_target_max_propagation_sec after the detection
+landing_target_propagation_enable = True
+landing_target_max_propagation_sec = 1.0
+landing_target_propagator = landing_target.LandingTargetPropagator(landing_target_max_propagation_sec)
+
+# Fisheye camera frame (x right, y down, z forward) in the T265 body frame (x right, y up, z backward).
+# The offset between the cameras and the center of the T265 is neglected
+H_T265body_camera = tf.euler_matrix(m.pi, 0, 0, 'sxyz')
+
 #######################################
 # Parsing user' inputs
 #######################################
@@ -101,8 +208,20 @@ parser.add_argument('--camera_orientation', type=int,
                     help="Configuration for camera orientation. Currently supported: forward, usb port to the right - 0; downward, usb port to the right - 1")
 parser.add_argument('--visualization',type=int,
                     help="Enable visualization. Ensure that a monitor is connected")
+parser.add_argument('--visualization_file',type=str,
+                    help="Headless visualization: write the annotated frames to this MJPEG (.avi) file at a low rate instead of showing them")
 parser.add_argument('--debug_enable',type=int,
                     help="Enable debug messages on terminal")
+parser.add_argument('--rectify_cache_dir',
+                    help="Directory where the rectification maps are cached. If not specified, a default directory will be used.")
+parser.add_argument('--record', type=str,
+                    help="Record the fisheye pairs and poses to this new directory, see frame_recorder.py and recording.py")
+parser.add_argument('--replay', type=str,
+                    help="Replay this recording instead of connecting to the T265, as fast as the pipeline goes, see recording.py")
+parser.add_argument('--replay_reference', type=str,
+                    help="Landing targets to compare the replay to, instead of the reference of the recording")
+parser.add_argument('--replay_targets', type=str,
+                    help="Save the landing targets of the replay to this .npy file, e.g. as a reference for later replays")
 
 args = parser.parse_args()
 
@@ -114,7 +233,11 @@ confidence_msg_hz = args.confidence_msg_hz
 scale_calib_enable = args.scale_calib_enable
 camera_orientation = args.camera_orientation
 visualization = args.visualization
+visualization_file = args.visualization_file
 debug_enable = args.debug_enable
+rectify_cache_dir = args.rectify_cache_dir
+record_path = args.record
+replay_path = args.replay
 
 # Using default values if no input is provided
 if not connection_string:
@@ -165,17 +288,29 @@ else:
     else:
         print("INFO: Using scale factor", scale_factor)
 
-if not visualization:
+# The annotated frames are drawn and shown (or written) by a separate process, see tag_visualization.py
+WINDOW_TITLE = 'Apriltag detection from T265 images'
+visualization_mjpeg_hz = 5
+tag_viewer = None
+
+if not visualization and not visualization_file:
     visualization = 0
     print("INFO: Visualization: Disabled")
+elif visualization_file:
+    visualization = 1
+    print("INFO: Visualization: Headless, annotated frames written to", visualization_file, "at", visualization_mjpeg_hz, "Hz")
 else:
     visualization = 1
-    print("INFO: Visualization: Enabled. Checking if monitor is connected...")
-    WINDOW_TITLE = 'Apriltag detection from T265 images'
-    cv2.namedWindow(WINDOW_TITLE, cv2.WINDOW_AUTOSIZE)
-    print("INFO: Monitor is connected. Press `q` to exit.")
+    print("INFO: Visualization: Enabled. Ensure that a monitor is connected. Press `q` in the window to exit.")
     display_mode = "stack"
 
+if not enable_rectify_cache:
+    print("INFO: Rectification map cache: Disabled")
+else:
+    if not rectify_cache_dir:
+        rectify_cache_dir = rectify_cache_dir_default
+    print("INFO: Rectification map cache:", rectify_cache_dir)
+
 if not debug_enable:
     debug_enable = 0
 else:
@@ -243,14 +378,30 @@ Returns the fisheye distortion from librealsense intrinsics
 def fisheye_distortion(intrinsics):
     return np.array(intrinsics.coeffs[:4])
 
+# Undistort/rectify maps of one camera, from the cache if enabled. name: the consumer of the maps
+def rectify_maps(name, K, D, R, geometry, baseline = 0):
+    P = geometry.projection_matrix(baseline)
+    if enable_rectify_cache:
+        return fisheye_rectify.cached_maps(rectify_cache_dir, name, K, D, R, P, geometry.size(), rectify_map_type)
+    return fisheye_rectify.build_maps(K, D, R, P, geometry.size(), rectify_map_type)
+
 #######################################
 # Functions for AprilTag detection
 #######################################
 tag_landing_id = 0
 tag_landing_size = 0.144            # tag's border size, measured in meter
+
+# Landing pad made of several tags, see tag_bundle.py: {tag_id: (size in m, (x, y) of its center on the pad in m)}.
+# The pose of the pad is solved from the corners of all its tags found in a frame, and the per-tag pose
+# estimates are skipped. None to land on tag_landing_id alone. For example, with two small tags beside the
+# large one for the last meters:
+#   landing_pad_layout = {0: (0.144, (0.0, 0.0)), 1: (0.048, (0.13, 0.0)), 2: (0.048, (-0.13, 0.0))}
+landing_pad_layout = None
+landing_pad = None if landing_pad_layout is None else tag_bundle.TagBundle(landing_pad_layout)
 tag_image_source = "right"   # for Realsense T265, we can use "left" or "right"
 
-at_detector = apriltags3.Detector(searchpath=['apriltags'],
+apriltag_searchpath = ['apriltags']
+at_detector = apriltags3.Detector(searchpath=apriltag_searchpath,
                        families='tag36h11',
                        nthreads=1,
                        quad_decimate=1.0,
@@ -259,55 +410,112 @@ at_detector = apriltags3.Detector(searchpath=['apriltags'],
                        decode_sharpening=0.25,
                        debug=0)
 
+# Adapt the detector settings to the size of the landing tag in the image, see tag_detector_control.py.
+# The decimated tag should stay at least 30 px wide to be found reliably
+tag_detector_adaptive = True
+tag_detector_levels = [
+    # min tag px, quad_decimate, quad_sigma, nthreads
+    (0,     1.0,    0.0,    2),
+    (60,    2.0,    0.0,    1),
+    (120,   3.0,    0.8,    1),
+    (200,   4.0,    0.8,    1),
+]
+detector_control = None
+
+# Detect in tag_detector_workers worker processes, each with its own detector, see tag_detector_pool.py.
+# 0 to detect in the image stage. The results are handled in frame order when they come back, one or more
+# frames later. Only for tag_detection_mode = "rectified", and without the adaptive settings
+tag_detector_workers = 0
+detector_pool = None
+
+# At the first start on a computer, time the detector on live frames showing the landing tag and pick the most
+# accurate configuration that fits in tag_detection_deadline_sec. The choice is stored per host and reused on
+# the next start. When the tag is not seen in enough frames within tag_detector_autotune_timeout_sec, nothing
+# is tuned nor stored
+tag_detector_autotune = False
+tag_detection_deadline_sec = 0.020
+tag_detector_autotune_frames = 30
+tag_detector_autotune_timeout_sec = 60
+tag_detector_tuning_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tag_detector_tuning.json')
+
+if tag_detector_adaptive and tag_detector_workers == 0:
+    detector_control = tag_detector_control.AdaptiveDetectorControl(at_detector, tag_detector_levels)
+
 #######################################
 # Functions for MAVLink
 #######################################
 
 # Define function to send landing_target mavlink message for mavlink based precision landing
 # http://mavlink.org/messages/common#LANDING_TARGET
+# Each detection is sent once, stamped with the capture time of its image. In between, the last detection is
+# propagated with the latest T265 pose and stamped with the time of that pose, see landing_target.py
 def send_land_target_message():
-    global current_time, H_camera_tag, is_landing_tag_detected
-
-    if is_landing_tag_detected == True:
-        x = H_camera_tag[0][3]
-        y = H_camera_tag[1][3]
-        z = H_camera_tag[2][3]
-
-        x_offset_rad = m.atan(x / z)
-        y_offset_rad = m.atan(y / z)
-        distance = np.sqrt(x * x + y * y + z * z)
-
-        msg = vehicle.message_factory.landing_target_encode(
-            current_time,                       # time target data was processed, as close to sensor capture as possible
-            0,                                  # target num, not used
-            mavutil.mavlink.MAV_FRAME_BODY_NED, # frame, not used
-            x_offset_rad,                       # X-axis angular offset, in radians
-            y_offset_rad,                       # Y-axis angular offset, in radians
-            distance,                           # distance, in meters
-            0,                                  # Target x-axis size, in radians
-            0,                                  # Target y-axis size, in radians
-            0,                                  # x	float	X Position of the landing target on MAV_FRAME
-            0,                                  # y	float	Y Position of the landing target on MAV_FRAME
-            0,                                  # z	float	Z Position of the landing target on MAV_FRAME
-            (1,0,0,0),      # q	float[4]	Quaternion of landing target orientation (w, x, y, z order, zero-rotation is 1, 0, 0, 0)
-            2,              # type of landing target: 2 = Fiducial marker
-            1,              # position_valid boolean
-        )
-        vehicle.send_mavlink(msg)
-        vehicle.flush()
+    global landing_target_age
+
+    target = landing_target_slot.get(timeout = 0)
+    if target is not None:
+        position_camera = target["H_camera_tag"][:3, 3]
+        target_time = target["capture_time"]
+        landing_target_age = time.time() - target_time
+        if target["H_ref_camera"] is not None:
+            landing_target_propagator.update(target_time, target["H_ref_camera"], position_camera)
+        # Time from the capture of the image to the message
+        landing_target_stats.tick(landing_target_age)
+    else:
+        latest_pose = t265_pose_history.latest() if landing_target_propagation_enable else None
+        if latest_pose is None:
+            return
+        (target_time, H_T265Ref_T265body) = latest_pose
+        estimate = landing_target_propagator.propagate(H_T265Ref_T265body.dot(H_T265body_camera), target_time)
+        if estimate is None:
+            return
+        # Time since the capture of the image of the detection
+        (position_camera, landing_target_age) = estimate
+        landing_target_propagated_stats.tick(landing_target_age)
+
+    (x_offset_rad, y_offset_rad, distance) = landing_target.target_angles(position_camera)
+
+    # Position relative to the vehicle in its body FRD frame, the only frame ArduPilot accepts a valid position in
+    position_body = H_T265body_aeroBody[:3, :3].T.dot(H_T265body_camera[:3, :3].dot(position_camera))
+    if body_offset_enabled == 1:
+        position_body = position_body + (body_offset_x, body_offset_y, body_offset_z)
+        # ArduPilot divides x, y, z by the distance for the line of sight, which must stay a unit vector
+        distance = np.linalg.norm(position_body)
+
+    msg = vehicle.message_factory.landing_target_encode(
+        int(round(target_time * 1e6)),      # time target data was processed, as close to sensor capture as possible
+        0,                                  # target num, not used
+        mavutil.mavlink.MAV_FRAME_BODY_FRD, # frame of the x, y, z position
+        x_offset_rad,                       # X-axis angular offset, in radians
+        y_offset_rad,                       # Y-axis angular offset, in radians
+        distance,                           # distance, in meters
+        0,                                  # Target x-axis size, in radians
+        0,                                  # Target y-axis size, in radians
+        position_body[0],                   # x	float	X Position of the landing target on MAV_FRAME
+        position_body[1],                   # y	float	Y Position of the landing target on MAV_FRAME
+        position_body[2],                   # z	float	Z Position of the landing target on MAV_FRAME
+        (1,0,0,0),      # q	float[4]	Quaternion of landing target orientation (w, x, y, z order, zero-rotation is 1, 0, 0, 0)
+        2,              # type of landing target: 2 = Fiducial marker
+        1,              # position_valid boolean
+    )
+    vehicle.send_mavlink(msg)
+    vehicle.flush()
 
 # https://mavlink.io/en/messages/common.html#VISION_POSITION_ESTIMATE
 def send_vision_position_message():
     global current_time, H_aeroRef_aeroBody
 
-    if H_aeroRef_aeroBody is not None:
-        rpy_rad = np.array( tf.euler_from_matrix(H_aeroRef_aeroBody, 'sxyz'))
+    with frame_mutex:
+        (pose_time, H_pose) = (current_time, H_aeroRef_aeroBody)
+
+    if H_pose is not None:
+        rpy_rad = np.array( tf.euler_from_matrix(H_pose, 'sxyz'))
 
         msg = vehicle.message_factory.vision_position_estimate_encode(
-            current_time,                       # us Timestamp (UNIX time or time since system boot)
-            H_aeroRef_aeroBody[0][3],	        # Global X position
-            H_aeroRef_aeroBody[1][3],           # Global Y position
-            H_aeroRef_aeroBody[2][3],	        # Global Z position
+            pose_time,                          # us Timestamp (UNIX time or time since system boot)
+            H_pose[0][3],	                    # Global X position
+            H_pose[1][3],                       # Global Y position
+            H_pose[2][3],	                    # Global Z position
             rpy_rad[0],	                        # Roll angle
             rpy_rad[1],	                        # Pitch angle
             rpy_rad[2]	                        # Yaw angle
@@ -316,6 +524,42 @@ def send_vision_position_message():
         vehicle.send_mavlink(msg)
         vehicle.flush()
 
+# Effective tag detection rate, number of frames that missed the deadline since the last message and
+# time in ms since the capture of the detection the last landing target was based on, as NAMED_VALUE_FLOAT so they can be graphed on the GCS
+def send_detection_stats_message():
+    (rate, misses) = detection_scheduler.window_stats()
+    time_boot_ms = int(round((time.time() - detection_scheduler.start_time) * 1000))
+    for (name, value) in ((b'TAG_HZ', rate), (b'TAG_MISS', misses), (b'TAG_AGE', landing_target_age * 1000)):
+        msg = vehicle.message_factory.named_value_float_encode(time_boot_ms, name, value)
+        vehicle.send_mavlink(msg)
+    vehicle.flush()
+
+# https://mavlink.io/en/messages/common.html#OBSTACLE_DISTANCE
+# Nearest obstacle in each of the 72 sectors across the field of view of the forward-facing camera, stamped
+# with the capture time of the pair. Each result of the stereo depth worker is sent once
+def send_obstacle_distance_message():
+    result = stereo_depth_worker.latest()
+    if result is None or result[0] == send_obstacle_distance_message.last_frame_number:
+        return
+    (frame_number, capture_time, distances) = result
+    send_obstacle_distance_message.last_frame_number = frame_number
+    sectors = stereo_depth_worker.sectors
+
+    msg = vehicle.message_factory.obstacle_distance_encode(
+        int(round(capture_time * 1e6)),     # us Timestamp of the capture of the pair
+        mavutil.mavlink.MAV_DISTANCE_SENSOR_UNKNOWN, # sensor_type, stereo is not in the enum
+        distances.tolist(),                 # distances in cm, UINT16_MAX unknown, max_distance + 1 no obstacle
+        0,                                  # increment in degrees, superseded by increment_f
+        sectors.min_distance_cm,            # min_distance in cm
+        sectors.max_distance_cm,            # max_distance in cm
+        sectors.increment_deg,              # increment_f, angular width of the sectors in degrees
+        sectors.angle_offset_deg,           # angle_offset of the first sector, positive clockwise
+        mavutil.mavlink.MAV_FRAME_BODY_FRD  # frame, 0 degrees is forward
+    )
+    vehicle.send_mavlink(msg)
+    vehicle.flush()
+send_obstacle_distance_message.last_frame_number = None
+
 # For a lack of a dedicated message, we pack the confidence level into a message that will not be used, so we can view it on GCS
 # Confidence level value: 0 - 3, remapped to 0 - 100: 0% - Failed / 33.3% - Low / 66.6% - Medium / 100% - High 
 def send_confidence_level_dummy_message():
@@ -431,7 +675,8 @@ def vehicle_connect():
     try:
         vehicle = connect(connection_string, wait_ready = True, baud = connection_baudrate, source_system = 1)
     except KeyboardInterrupt:    
-        pipe.stop()
+        if pipe is not None:
+            pipe.stop()
         print("INFO: Exiting")
         sys.exit()
     except:
@@ -458,7 +703,428 @@ def realsense_connect():
     cfg.enable_stream(rs.stream.fisheye, 2)         # Image stream right
 
     # Start streaming with requested config and callback
-    pipe.start(cfg)
+    pipe.start(cfg, frame_callback)
+
+#######################################
+# Functions for the pipeline stages
+#######################################
+"""
+Pose frames arrive at 200 Hz and fisheye framesets at 30 Hz, separately. The
+camera callback hands each one over to its own stage through a latest-only slot
+and returns immediately:
+  - the pose stage runs in its own thread on every pose frame, so
+    VISION_POSITION_ESTIMATE never waits for the image processing,
+  - the image stage (remap, AprilTag detection) runs in the main thread on the
+    most recent frameset, and simply skips framesets it cannot keep up with,
+  - the visualization runs in its own process and skips what it cannot keep up
+    with in turn.
+"""
+pose_slot  = pipeline_utils.LatestSlot('pose')
+image_slot = pipeline_utils.LatestSlot('image')
+
+# Landing targets from the image stage to LANDING_TARGET, a target not sent yet is replaced by a newer one
+landing_target_slot = pipeline_utils.LatestSlot('landing_target')
+
+# The fisheye images come at 30 Hz, the image stage should finish each frame before the next one arrives
+image_stage_budget_sec = 1 / 30
+detection_scheduler = pipeline_utils.DeadlineScheduler('detection', image_stage_budget_sec)
+
+pose_stats      = pipeline_utils.StageStats('pose')
+image_stats     = pipeline_utils.StageStats('image')
+detection_stats = pipeline_utils.StageStats('detection')
+landing_target_stats = pipeline_utils.StageStats('landing_target')     # latency: age of the target when sent
+landing_target_propagated_stats = pipeline_utils.StageStats('landing_target_propagated')   # latency: time since the detection
+
+# Capture time of a frame in seconds, in the clock of time.time(). librealsense gives it in ms in that clock
+# when the global time is enabled (the default), otherwise the arrival time is the best we have
+def capture_time(frame, arrival_time):
+    if frame.get_frame_timestamp_domain() == rs.timestamp_domain.global_time:
+        return frame.get_timestamp() / 1000
+    return arrival_time
+
+# Runs on the librealsense thread, must return quickly
+def frame_callback(frame):
+    arrival_time = time.time()
+    if frame.is_pose_frame():
+        pose = frame.as_pose_frame()
+        pose_data = pose.get_pose_data()
+        pose_capture_time = capture_time(pose, arrival_time)
+        pose_slot.put({"pose_data"      : pose_data,
+                       "capture_time"   : pose_capture_time,
+                       "arrival_time"   : arrival_time})
+        if stream_recorder is not None:
+            stream_recorder.add_pose(pose_capture_time, pose_data)
+    elif frame.is_frameset():
+        frameset = frame.as_frameset()
+        f1 = frameset.get_fisheye_frame(1)
+        f2 = frameset.get_fisheye_frame(2)
+        if f1 and f2:
+            # Keep the frameset alive outside the callback instead of copying the images
+            frameset.keep()
+            exposure = None
+            if f1.supports_frame_metadata(rs.frame_metadata_value.actual_exposure):
+                exposure = f1.get_frame_metadata(rs.frame_metadata_value.actual_exposure) * 1e-6
+            image_frame = {"frame_number"  : f1.get_frame_number(),
+                           "timestamp"     : f1.get_timestamp(),
+                           "capture_time"  : capture_time(f1, arrival_time),
+                           "arrival_time"  : arrival_time,
+                           "exposure"      : exposure,
+                           "left"          : np.asanyarray(f1.as_video_frame().get_data()),
+                           "right"         : np.asanyarray(f2.as_video_frame().get_data()),
+                           "frameset"      : frameset}
+            image_slot.put(image_frame)
+            # Every pair, also those the image stage skips. Only references, compressed in the background
+            if stream_recorder is not None:
+                stream_recorder.add_frameset(image_frame["frame_number"], image_frame["capture_time"], exposure,
+                                            image_frame["left"], image_frame["right"], keep = frameset)
+
+def process_pose(pose_data, pose_capture_time):
+    global current_time, data, H_aeroRef_aeroBody, H_T265Ref_T265body_latest, angular_velocity_camera_latest
+
+    # In transformations, Quaternions w+ix+jy+kz are represented as [w, x, y, z]!
+    H_T265Ref_T265body = tf.quaternion_matrix([pose_data.rotation.w, pose_data.rotation.x, pose_data.rotation.y, pose_data.rotation.z]) 
+    H_T265Ref_T265body[0][3] = pose_data.translation.x * scale_factor
+    H_T265Ref_T265body[1][3] = pose_data.translation.y * scale_factor
+    H_T265Ref_T265body[2][3] = pose_data.translation.z * scale_factor
+    t265_pose_history.add(pose_capture_time, [pose_data.rotation.w, pose_data.rotation.x, pose_data.rotation.y, pose_data.rotation.z],
+                          H_T265Ref_T265body[:3, 3])
+
+    # The angular velocity is given in the T265 reference frame, like the velocity: into the body frame, then the camera frame
+    angular_velocity_body = H_T265Ref_T265body[:3, :3].T.dot([pose_data.angular_velocity.x, pose_data.angular_velocity.y, pose_data.angular_velocity.z])
+    angular_velocity_camera = H_T265body_camera[:3, :3].T.dot(angular_velocity_body)
+
+    # Transform to aeronautic coordinates (body AND reference frame!)
+    H_pose = H_aeroRef_T265Ref.dot( H_T265Ref_T265body.dot( H_T265body_aeroBody))
+
+    # Take offsets from body's center of gravity (or IMU) to camera's origin into account
+    if body_offset_enabled == 1:
+        H_body_camera = tf.euler_matrix(0, 0, 0, 'sxyz')
+        H_body_camera[0][3] = body_offset_x
+        H_body_camera[1][3] = body_offset_y
+        H_body_camera[2][3] = body_offset_z
+        H_camera_body = np.linalg.inv(H_body_camera)
+        H_pose = H_body_camera.dot(H_pose.dot(H_camera_body))
+
+    # Realign heading to face north using initial compass data
+    if compass_enabled == 1:
+        H_pose = H_pose.dot( tf.euler_matrix(0, 0, heading_north_yaw, 'sxyz'))
+
+    with frame_mutex:
+        # Store the timestamp for MAVLink messages
+        current_time = int(round(time.time() * 1000000))
+        data = pose_data
+        H_aeroRef_aeroBody = H_pose
+        H_T265Ref_T265body_latest = H_T265Ref_T265body
+        angular_velocity_camera_latest = angular_velocity_camera
+
+    # Show debug messages here
+    if debug_enable == 1:
+        os.system('clear') # This helps in displaying the messages to be more readable
+        print("DEBUG: Raw RPY[deg]: {}".format( np.array( tf.euler_from_matrix( H_T265Ref_T265body, 'sxyz')) * 180 / m.pi))
+        print("DEBUG: NED RPY[deg]: {}".format( np.array( tf.euler_from_matrix( H_aeroRef_aeroBody, 'sxyz')) * 180 / m.pi))
+        print("DEBUG: Raw pos xyz : {}".format( np.array( [pose_data.translation.x, pose_data.translation.y, pose_data.translation.z])))
+        print("DEBUG: NED pos xyz : {}".format( np.array( tf.translation_from_matrix( H_aeroRef_aeroBody))))
+
+def pose_stage():
+    while True:
+        pose_frame = pose_slot.get()
+        process_pose(pose_frame["pose_data"], pose_frame["capture_time"])
+        pose_stats.tick(time.time() - pose_frame["arrival_time"])
+
+# In a replay the poses come from the recording, in capture order with the frames, see recording.py
+def replay_pose(pose_data, pose_capture_time):
+    start = time.time()
+    process_pose(pose_data, pose_capture_time)
+    pose_stats.tick(time.time() - start)
+
+#######################################
+# Per-frame image products
+#######################################
+"""
+The image stage asks the product graph for what it needs, instead of computing
+everything up front. Rectifying the whole image only happens if some consumer
+asks for it, and at most once per frame. The views of the fisheye streams for
+each consumer (tag_rectified, tag_raw, stereo_left, stereo_right, viewer) are
+added once the camera is known, see fisheye_frontend.py.
+"""
+# Grayscale region of the tag source image that the detector runs on
+def produce_tag_roi(products):
+    if tag_roi is None:
+        image = products.get("tag_rectified")
+    else:
+        # Only rectify the region, the rows and columns of the maps give its source pixels
+        (x0, y0, x1, y1) = tag_roi
+        (map1, map2) = undistort_rectify["tag"]
+        image = fisheye_rectify.remap(products.get("raw_" + tag_image_source), (map1[y0:y1, x0:x1], map2[y0:y1, x0:x1]))
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+image_products = pipeline_utils.ProductGraph('image', {
+    "tag_roi"           : produce_tag_roi,
+})
+
+# Detect the landing tag and visualize. Returns False when the user asked to quit.
+def process_image_frame(image_frame):
+    global tag_roi
+
+    image_products.begin_frame(image_frame["frame_number"], raw_left = image_frame["left"], raw_right = image_frame["right"])
+
+    # Less work when the stage falls behind, see pipeline_utils.DeadlineScheduler
+    (do_detection, prefer_roi, do_visualization) = detection_scheduler.plan()
+
+    # Blurred frames are searched around the tracked tag only, or not at all, see blur_gate.py
+    blur_decision = 'detect'
+    if tag_blur_gate is not None:
+        with frame_mutex:
+            angular_velocity_camera = angular_velocity_camera_latest
+        if angular_velocity_camera is not None:
+            blur_px = tag_blur_gate.predict_blur_px(angular_velocity_camera, image_frame["exposure"])
+            blur_decision = tag_blur_gate.decide(blur_px, image_frame["frame_number"])
+    require_roi = False
+    if tag_blur_gate is not None and tag_blur_gate.enforce:
+        if blur_decision == 'skip':
+            do_detection = False
+        elif blur_decision == 'roi_only' and tag_tracker is not None:
+            prefer_roi = True
+            require_roi = True
+
+    tags = []
+    tag_roi = None
+    attempted = False
+    if detector_pool is not None:
+        if do_detection:
+            attempted = submit_landing_tag_search(image_frame["frame_number"], image_frame["capture_time"], prefer_roi, require_roi,
+                                                  blur_decision, image_frame["arrival_time"])
+        # A submitted frame ends when its result is handled, see collect_pool_results. Dropped ones are skipped
+        if not attempted:
+            detection_scheduler.end_frame(time.time() - image_frame["arrival_time"], False)
+        tags = collect_pool_results()
+    else:
+        if do_detection:
+            cpu_start = time.process_time()
+            tags = detect_landing_tag(image_frame["capture_time"], prefer_roi, require_roi)
+            attempted = tags is not None
+            if tags is None:
+                tags = []
+            if tag_blur_gate is not None:
+                tag_blur_gate.record(blur_decision, attempted, is_landing_tag_detected, time.process_time() - cpu_start)
+        detection_scheduler.end_frame(time.time() - image_frame["arrival_time"], attempted)
+
+    # If enabled, hand the rectified pair to the stereo depth worker. Never waits for it, see stereo_depth.py
+    if stereo_depth_worker is not None and stereo_depth_worker.due():
+        stereo_depth_worker.submit(image_frame["frame_number"], image_frame["capture_time"],
+                                   image_products.get("stereo_left"), image_products.get("stereo_right"))
+
+    # If enabled, hand the frame to the viewer process. Never waits for it, see tag_visualization.py
+    if tag_viewer is not None:
+        if do_visualization:
+            tag_viewer.publish(image_frame["frame_number"], image_products.get("viewer"), [(tag.tag_id, tag.corners) for tag in tags], tag_roi)
+        if tag_viewer.quit_requested():
+            return False
+    return True
+
+# Detect the tags in the current frame of image_products, and update the landing tag.
+# prefer_roi: search the predicted region of the landing tag even if a full-frame search is due
+# require_roi: only search the predicted region of the tag, returns None without searching when there is none
+def detect_landing_tag(capture_time, prefer_roi, require_roi = False):
+    search = landing_tag_search(capture_time, prefer_roi, require_roi)
+    if search is None:
+        return None
+    (H_ref_camera, roi_camera_params) = search
+
+    # Run AprilTag detection algorithm on rectified image. 
+    # Params:
+    #   tag_image_source for "left" or "right"
+    #   tag_landing_size for actual size of the tag
+    detection_start = time.time()
+    if raw_tag_detector is not None:
+        tags = raw_tag_detector.detect(image_products.get("tag_raw"), tag_landing_size, estimate_tag_pose = landing_pad is None)
+    else:
+        tags = at_detector.detect(image_products.get("tag_roi"), landing_pad is None, roi_camera_params, tag_landing_size)
+    detection_time = time.time() - detection_start
+    return update_landing_tag(tags, tag_roi, H_ref_camera, capture_time, detection_time)
+
+# Region to search for the landing tag in the current frame, sets tag_roi. Returns the camera pose and the
+# camera parameters of the region, or None when require_roi and there is no region to search
+def landing_tag_search(capture_time, prefer_roi, require_roi):
+    global tag_roi
+
+    # Camera pose when the image was taken, to predict the region of the tag from the camera motion since the last frame
+    H_T265Ref_T265body = t265_pose_history.at(capture_time)
+    if H_T265Ref_T265body is None:
+        with frame_mutex:
+            H_T265Ref_T265body = H_T265Ref_T265body_latest
+    H_ref_camera = None if H_T265Ref_T265body is None else H_T265Ref_T265body.dot(H_T265body_camera)
+    tag_roi = None if tag_tracker is None else tag_tracker.roi_for_frame(H_ref_camera, allow_full_search = not prefer_roi)
+    if require_roi and tag_roi is None:
+        return None
+
+    # The principal point moves with the origin of the region of interest, and is in the pixel coordinates of the detector
+    (roi_x0, roi_y0) = (0, 0) if tag_roi is None else tag_roi[:2]
+    (fx, fy, cx, cy) = fisheye_tag_detection.detector_camera_params(camera_params)
+    roi_camera_params = [fx, fy, cx - roi_x0, cy - roi_y0]
+    return (H_ref_camera, roi_camera_params)
+
+# Update the landing tag from the tags detected in the region roi of a frame taken at capture_time, at camera pose H_ref_camera
+def update_landing_tag(tags, roi, H_ref_camera, capture_time, detection_time):
+    global H_camera_tag, is_landing_tag_detected
+
+    detection_stats.tick(detection_time)
+
+    # Corners back in the coordinates of the whole rectified image
+    (roi_x0, roi_y0) = (0, 0) if roi is None else roi[:2]
+    for tag in tags:
+        tag.corners = tag.corners + (roi_x0, roi_y0)
+        tag.center = tag.center + (roi_x0, roi_y0)
+
+    landing_tag = None
+    if landing_pad is not None:
+        # One pose for the whole pad, from the corners of all its tags
+        landing_tag = landing_pad.solve(tags, camera_params)
+        if landing_tag is not None:
+            (size_corners, size) = (landing_tag.largest_corners, landing_tag.largest_size)
+            landing_name = "pad from tags " + str(landing_tag.tag_ids)
+    else:
+        for tag in tags:
+            # Check for the tag that we want to land on
+            if tag.tag_id == tag_landing_id:
+                landing_tag = tag
+                (size_corners, size) = (tag.corners, tag_landing_size)
+                landing_name = "tag " + str(tag.tag_id)
+    if landing_tag is not None:
+        H_camera_tag = tf.euler_matrix(0, 0, 0, 'sxyz')
+        H_camera_tag[0][3] = landing_tag.pose_t[0][0]
+        H_camera_tag[1][3] = landing_tag.pose_t[1][0]
+        H_camera_tag[2][3] = landing_tag.pose_t[2][0]
+        print("INFO: Detected landing", landing_name, " relative to camera at x:", H_camera_tag[0][3], ", y:", H_camera_tag[1][3], ", z:", H_camera_tag[2][3])
+    is_landing_tag_detected = landing_tag is not None
+
+    # Paired with the camera pose when the image was taken, sent once by send_land_target_message
+    if landing_tag is not None:
+        landing_target_slot.put({"capture_time" : capture_time,
+                                 "H_camera_tag" : H_camera_tag,
+                                 "H_ref_camera" : H_ref_camera})
+        if replay_source is not None:
+            replay_source.record_target(capture_time, H_camera_tag[:3, 3])
+
+    if tag_tracker is not None:
+        if landing_tag is None:
+            tag_tracker.update(roi, H_ref_camera, None, None, detection_time)
+        else:
+            tag_tracker.update(roi, H_ref_camera, landing_tag.corners, float(landing_tag.pose_t[2][0]), detection_time)
+
+    # Settings for the next frame
+    if detector_control is not None:
+        tag_px = None
+        if landing_tag is not None:
+            tag_px = detector_control.tag_size_px(size_corners, float(landing_tag.pose_t[2][0]), camera_params[0], size)
+        detector_control.update(tag_px, detection_time)
+
+    return tags
+
+# Search for the landing tag in a worker of detector_pool, the result is handled by collect_pool_results.
+# Returns False when nothing was submitted
+def submit_landing_tag_search(frame_number, capture_time, prefer_roi, require_roi, blur_decision, arrival_time):
+    search = landing_tag_search(capture_time, prefer_roi, require_roi)
+    if search is None:
+        return False
+    (H_ref_camera, roi_camera_params) = search
+    # Without camera parameters the workers skip the per-tag pose estimates
+    if landing_pad is not None:
+        roi_camera_params = None
+    return detector_pool.submit(frame_number, image_products.get("tag_roi"), roi_camera_params, tag_landing_size,
+                                    context = (tag_roi, H_ref_camera, capture_time, blur_decision, arrival_time))
+
+# Handle the results of detector_pool, in frame order. Returns the tags of the most recent result
+def collect_pool_results(timeout = 0):
+    for (frame_number, tags, (roi, H_ref_camera, capture_time, blur_decision, arrival_time), detection_time, cpu_time) in detector_pool.collect(timeout):
+        # The deadline of a frame covers its detection in the worker, up to the release of its result
+        detection_scheduler.end_frame(time.time() - arrival_time, True)
+        collect_pool_results.tags = update_landing_tag(tags, roi, H_ref_camera, capture_time, detection_time)
+        if tag_blur_gate is not None:
+            tag_blur_gate.record(blur_decision, True, is_landing_tag_detected, cpu_time)
+    return collect_pool_results.tags
+collect_pool_results.tags = []
+
+# Stored or freshly tuned detector configuration, see tag_detector_tuning.py. A replay never tunes, it would
+# not detect on the frames used for tuning
+def autotune_detector():
+    # Tuned on the view the detector runs on: in raw mode the raw crop, much larger than the rectified image
+    if raw_tag_detector is not None:
+        tag_view = "tag_raw"
+        K = raw_tag_detector.K
+        tuning_camera_params = fisheye_tag_detection.detector_camera_params([K[0][0], K[1][1], K[0][2], K[1][2]])
+    else:
+        tag_view = "tag_rectified"
+        tuning_camera_params = fisheye_tag_detection.detector_camera_params(camera_params)
+    store = tag_detector_tuning.TuningStore(tag_detector_tuning_file)
+    image_size = stream_frontend.shape(tag_view)[::-1]
+    config = store.load(tag_detection_deadline_sec, image_size)
+    if config is not None:
+        print("INFO: Using stored detector configuration", config)
+    elif replay_source is not None:
+        print("INFO: No stored detector configuration, replaying with the default one")
+        return
+    else:
+        print("INFO: Tuning the AprilTag detector on", tag_detector_autotune_frames, "frames showing the landing tag, keep it in view")
+        # Frames without the tag would make the fastest configuration look as accurate as any other
+        tag_ids = list(landing_pad.layout) if landing_pad is not None else [tag_landing_id]
+        frames = []
+        tuning_end = time.time() + tag_detector_autotune_timeout_sec
+        while len(frames) < tag_detector_autotune_frames and time.time() < tuning_end:
+            image_frame = image_slot.get(timeout = 1)
+            if image_frame is not None:
+                frame = stream_frontend.produce(tag_view, image_frame[tag_image_source])
+                if tag_detector_tuning.shows_tags(at_detector, frame, tag_ids):
+                    frames.append(frame)
+        config = tag_detector_tuning.tune_and_store(store, at_detector, frames, image_size, tuning_camera_params, tag_landing_size,
+                                                    tag_detection_deadline_sec, tag_ids, tag_detector_autotune_frames,
+                                                    verbose = debug_enable == 1)
+        if config is None:
+            print("WARNING: Landing tag seen in", len(frames), "frames in", tag_detector_autotune_timeout_sec,
+                  "s, detector not tuned, using the default configuration")
+            return
+        print("INFO: Detector configuration", config, "saved to", tag_detector_tuning_file)
+    tag_detector_tuning.apply_config(at_detector, config)
+
+    # The pool scales with the number of workers, each of them detects with a single thread
+    if detector_pool is not None:
+        detector_pool.configure(quad_decimate = config["quad_decimate"], refine_edges = config["refine_edges"], nthreads = 1)
+
+    # The adaptive levels keep their decimation, the first one at full resolution for small tags at altitude,
+    # and use at most the tuned number of threads
+    if detector_control is not None:
+        detector_control.set_levels([(min_tag_px, quad_decimate, quad_sigma, min(nthreads, config["nthreads"]))
+                                     for (min_tag_px, quad_decimate, quad_sigma, nthreads) in tag_detector_levels])
+
+def report_stage_stats():
+    for stats in (pose_stats, image_stats, detection_stats, landing_target_stats, landing_target_propagated_stats):
+        print(stats.report())
+    for slot in (pose_slot, image_slot, landing_target_slot):
+        print(slot.report())
+    print(t265_pose_history.report())
+    print(landing_target_propagator.report())
+    print(image_products.report())
+    if stream_frontend is not None:
+        print(stream_frontend.report())
+    print(detection_scheduler.report())
+    if tag_tracker is not None:
+        print(tag_tracker.report())
+    if detector_control is not None:
+        print(detector_control.report())
+    if tag_blur_gate is not None:
+        print(tag_blur_gate.report())
+    if detector_pool is not None:
+        print(detector_pool.report())
+    if landing_pad is not None:
+        print(landing_pad.report())
+    if tag_viewer is not None:
+        print(tag_viewer.report())
+    if stereo_depth_worker is not None:
+        print(stereo_depth_worker.report())
+    if stream_recorder is not None:
+        print(stream_recorder.report())
 
 #######################################
 # Main code starts here
@@ -467,9 +1133,43 @@ def realsense_connect():
 # Set up a mutex to share data between threads 
 frame_mutex = threading.Lock()
 
-print("INFO: Connecting to Realsense camera.")
-realsense_connect()
-print("INFO: Realsense connected.")
+# Recording of the T265 streams, compressed in low priority threads, see frame_recorder.py. When more than
+# recorder_max_pending pairs wait, recorder_drop_policy ("newest" or "oldest") tells which one is dropped
+recorder_threads = 2
+recorder_max_pending = 8
+recorder_drop_policy = "newest"
+stream_recorder = None
+
+# Offline replay of a recording in place of the T265, see recording.py. The vehicle connection is still needed,
+# fake_fcu.py can stand in for it
+replay_source = None
+if replay_path:
+    replay_sides = ('left', 'right') if stereo_enable == 1 else (tag_image_source,)
+    replay_source = recording.ReplaySource(replay_path, args.replay_reference, replay_sides)
+    print("INFO: Replaying", replay_path, "instead of the T265")
+    if record_path:
+        print("WARNING: Nothing is recorded while replaying, --record ignored")
+    print(replay_source.recording.report())
+
+# The detector workers, the viewer and the stereo depth worker are forked, before any thread is started or device connected
+if tag_detector_workers > 0 and tag_detection_mode == "rectified":
+    detector_params = dict(at_detector.params, families = ' '.join(at_detector.params['families']), nthreads = 1)
+    detector_pool = tag_detector_pool.DetectorPool(tag_detector_workers, tag_rectify_geometry.size(), apriltag_searchpath, detector_params)
+    print("INFO: Detecting tags in", tag_detector_workers, "worker processes")
+
+if visualization == 1:
+    tag_viewer = tag_visualization.TagViewer(WINDOW_TITLE, visualization_file, visualization_mjpeg_hz)
+
+if stereo_enable == 1:
+    if camera_orientation == 0:
+        stereo_depth_worker = stereo_depth.StereoDepth(obstacle_distance_msg_hz)
+    else:
+        print("WARNING: Stereo depth is only sent for a forward-facing camera (camera_orientation 0), disabled")
+
+if replay_source is None:
+    print("INFO: Connecting to Realsense camera.")
+    realsense_connect()
+    print("INFO: Realsense connected.")
 
 print("INFO: Connecting to vehicle.")
 while (not vehicle_connect()):
@@ -483,10 +1183,24 @@ if compass_enabled == 1:
     # Listen to the attitude data in aeronautical frame
     vehicle.add_message_listener('ATTITUDE', att_msg_callback)
 
+# Decode only the messages this script listens to, and only have the FCU stream those
+if enable_inbound_msg_filter:
+    inbound_msg_filter = mavlink_inbound_filter.InboundFilter(vehicle)
+    inbound_msg_filter.subscribe('HEARTBEAT', 'STATUSTEXT', 'TIMESYNC', 'COMMAND_ACK')
+    streamed_msg_rates = {}
+    if compass_enabled == 1:
+        inbound_msg_filter.subscribe('ATTITUDE')
+        streamed_msg_rates['ATTITUDE'] = attitude_msg_hz_default
+    if inbound_msg_filter.install():
+        inbound_msg_filter.request_streams(streamed_msg_rates)
+    else:
+        inbound_msg_filter = None
+
 data = None
 current_confidence = None
 H_aeroRef_aeroBody = None
 H_camera_tag = None
+landing_target_age = 0.0
 is_landing_tag_detected = False # This flag returns true only if the tag with landing id is currently detected
 heading_north_yaw = None
 
@@ -494,7 +1208,12 @@ heading_north_yaw = None
 sched = BackgroundScheduler()
 sched.add_job(send_vision_position_message, 'interval', seconds = 1/vision_msg_hz)
 sched.add_job(send_confidence_level_dummy_message, 'interval', seconds = 1/confidence_msg_hz)
-sched.add_job(send_land_target_message, 'interval', seconds = 1/landing_target_msg_hz_default)
+sched.add_job(send_land_target_message, 'interval', seconds = 1/landing_target_msg_hz)
+sched.add_job(send_detection_stats_message, 'interval', seconds = 1/detection_stats_msg_hz)
+if stereo_depth_worker is not None:
+    sched.add_job(send_obstacle_distance_message, 'interval', seconds = 1/obstacle_distance_msg_hz)
+if debug_enable == 1:
+    sched.add_job(report_stage_stats, 'interval', seconds = stage_stats_report_sec)
 
 # For scale calibration, we will use a thread to monitor user input
 if scale_calib_enable == True:
@@ -511,235 +1230,148 @@ if compass_enabled == 1:
 print("INFO: Starting main loop...")
 
 try:
-    # Configure the OpenCV stereo algorithm. See
-    # https://docs.opencv.org/3.4/d2/d85/classcv_1_1StereoSGBM.html for a
-    # description of the parameters
-    window_size = 5
-    min_disp = 16
-    # must be divisible by 16
-    num_disp = 112 - min_disp
-    max_disp = min_disp + num_disp
-    stereo = cv2.StereoSGBM_create(minDisparity = min_disp,
-                                    numDisparities = num_disp,
-                                    blockSize = 16,
-                                    P1 = 8*3*window_size**2,
-                                    P2 = 32*3*window_size**2,
-                                    disp12MaxDiff = 1,
-                                    uniquenessRatio = 10,
-                                    speckleWindowSize = 100,
-                                    speckleRange = 32)
-
-    # Retreive the stream and intrinsic properties for both cameras
-    profiles = pipe.get_active_profile()
-
-    streams = {"left"  : profiles.get_stream(rs.stream.fisheye, 1).as_video_stream_profile(),
-               "right" : profiles.get_stream(rs.stream.fisheye, 2).as_video_stream_profile()}
-    intrinsics = {"left"  : streams["left"].get_intrinsics(),
-                  "right" : streams["right"].get_intrinsics()}
-
-    # Print information about both cameras
-    print("INFO: Using stereo fisheye cameras")
-    if debug_enable == 1:
-        print("INFO: T265 Left camera:",  intrinsics["left"])
-        print("INFO: T265 Right camera:", intrinsics["right"])
-
-    # Translate the intrinsics from librealsense into OpenCV
-    K_left  = camera_matrix(intrinsics["left"])
-    D_left  = fisheye_distortion(intrinsics["left"])
-    K_right = camera_matrix(intrinsics["right"])
-    D_right = fisheye_distortion(intrinsics["right"])
-    (width, height) = (intrinsics["left"].width, intrinsics["left"].height)
-
-    # Get the relative extrinsics between the left and right camera
-    (R, T) = get_extrinsics(streams["left"], streams["right"])
-
-    # We need to determine what focal length our undistorted images should have
-    # in order to set up the camera matrices for initUndistortRectifyMap.  We
-    # could use stereoRectify, but here we show how to derive these projection
-    # matrices from the calibration and a desired height and field of view
-
-    # We calculate the undistorted focal length:
-    #
-    #         h
-    # -----------------
-    #  \      |      /
-    #    \    | f  /
-    #     \   |   /
-    #      \ fov /
-    #        \|/
-    stereo_fov_rad = 90 * (m.pi/180)    # desired fov degree, 90 seems to work ok
-    stereo_height_px = 300              # 300x300 pixel stereo output
-    stereo_focal_px = stereo_height_px/2 / m.tan(stereo_fov_rad/2)
-
-    # We set the left rotation to identity and the right rotation
-    # the rotation between the cameras
-    R_left = np.eye(3)
-    R_right = R
-
-    # The stereo algorithm needs max_disp extra pixels in order to produce valid
-    # disparity on the desired output region. This changes the width, but the
-    # center of projection should be on the center of the cropped image
-    stereo_width_px = stereo_height_px + max_disp
-    stereo_size = (stereo_width_px, stereo_height_px)
-    stereo_cx = (stereo_height_px - 1)/2 + max_disp
-    stereo_cy = (stereo_height_px - 1)/2
-
-    # Construct the left and right projection matrices, the only difference is
-    # that the right projection matrix should have a shift along the x axis of
-    # baseline * focal_length
-    P_left = np.array([[stereo_focal_px, 0, stereo_cx, 0],
-                       [0, stereo_focal_px, stereo_cy, 0],
-                       [0,               0,         1, 0]])
-    P_right = P_left.copy()
-    P_right[0][3] = T[0] * stereo_focal_px
-
-    # Construct Q for use with cv2.reprojectImageTo3D. Subtract max_disp from x
-    # since we will crop the disparity later
-    Q = np.array([[1, 0,       0, -(stereo_cx - max_disp)],
-                  [0, 1,       0, -stereo_cy],
-                  [0, 0,       0, stereo_focal_px],
-                  [0, 0, -1/T[0], 0]])
-
-    # Create an undistortion map for the left and right camera which applies the
-    # rectification and undoes the camera distortion. This only has to be done
-    # once
-    m1type = cv2.CV_32FC1
-    (lm1, lm2) = cv2.fisheye.initUndistortRectifyMap(K_left, D_left, R_left, P_left, stereo_size, m1type)
-    (rm1, rm2) = cv2.fisheye.initUndistortRectifyMap(K_right, D_right, R_right, P_right, stereo_size, m1type)
-    undistort_rectify = {"left"  : (lm1, lm2),
-                         "right" : (rm1, rm2)}
+    if replay_source is not None:
+        # The calibration of the T265 the recording was made with
+        calib = replay_source.recording.calibration
+        (K_left, D_left, K_right, D_right, R, T) = (calib["K1"], calib["D1"], calib["K2"], calib["D2"], calib["R"], calib["T"])
+        (width, height) = calib["input"]
+    else:
+        # Retreive the stream and intrinsic properties for both cameras
+        profiles = pipe.get_active_profile()
+
+        streams = {"left"  : profiles.get_stream(rs.stream.fisheye, 1).as_video_stream_profile(),
+                   "right" : profiles.get_stream(rs.stream.fisheye, 2).as_video_stream_profile()}
+        intrinsics = {"left"  : streams["left"].get_intrinsics(),
+                      "right" : streams["right"].get_intrinsics()}
+
+        # Print information about both cameras
+        print("INFO: Using stereo fisheye cameras")
+        if debug_enable == 1:
+            print("INFO: T265 Left camera:",  intrinsics["left"])
+            print("INFO: T265 Right camera:", intrinsics["right"])
+
+        # Translate the intrinsics from librealsense into OpenCV
+        K_left  = camera_matrix(intrinsics["left"])
+        D_left  = fisheye_distortion(intrinsics["left"])
+        K_right = camera_matrix(intrinsics["right"])
+        D_right = fisheye_distortion(intrinsics["right"])
+        (width, height) = (intrinsics["left"].width, intrinsics["left"].height)
+
+        # Get the relative extrinsics between the left and right camera
+        (R, T) = get_extrinsics(streams["left"], streams["right"])
+
+        if record_path:
+            calib = {"K1" : K_left, "D1" : D_left, "K2" : K_right, "D2" : D_right, "R" : R, "T" : T, "input" : (width, height)}
+            stream_recorder = frame_recorder.FrameRecorder(record_path, calib, recorder_threads, recorder_max_pending, recorder_drop_policy)
+            print("INFO: Recording the fisheye pairs and poses to", record_path)
+
+    # The rectified images are pinhole cameras with the geometry of their consumer,
+    # see fisheye_rectify.RectifyGeometry. We set the left rotation to identity and
+    # the right rotation the rotation between the cameras
+    K_side = {"left" : K_left, "right" : K_right}
+    D_side = {"left" : D_left, "right" : D_right}
+    R_side = {"left" : np.eye(3), "right" : R}
+
+    # Create the undistortion maps which apply the rectification and undo the camera
+    # distortion. This only has to be done once
+    undistort_rectify = {}
+    undistort_rectify["tag"] = rectify_maps("tag", K_side[tag_image_source], D_side[tag_image_source], R_side[tag_image_source], tag_rectify_geometry)
+    print("INFO: Tag detection on rectified", tag_image_source, "image:", tag_rectify_geometry)
+
+    # The views of the fisheye streams, see fisheye_frontend.py. The raw fisheye pixels the tag view sees
+    stream_frontend = fisheye_frontend.FisheyeFrontEnd((width, height))
+    stream_frontend.add_rectified("tag_rectified", tag_image_source, undistort_rectify["tag"])
+    tag_raw_crop = fisheye_tag_detection.raw_crop(K_side[tag_image_source], D_side[tag_image_source], R_side[tag_image_source],
+                                                  tag_rectify_geometry, (width, height))
+
+    # The viewer rectifies its downsampled crop with maps built for it
+    if tag_viewer is not None:
+        K_viewer = stream_frontend.add_raw("viewer", tag_image_source, K_side[tag_image_source], tag_raw_crop, viewer_raw_scale)
+        tag_viewer.setup(stream_frontend.shape("viewer"),
+                         rectify_maps("viewer", K_viewer, D_side[tag_image_source], R_side[tag_image_source], tag_rectify_geometry))
+
+    if stereo_depth_worker is not None:
+        # The right projection matrix has a shift along the x axis of baseline * focal_length
+        for (side, baseline) in (("left", 0), ("right", T[0])):
+            undistort_rectify[side] = rectify_maps("stereo_" + side, K_side[side], D_side[side], R_side[side], stereo_rectify_geometry, baseline)
+            stream_frontend.add_rectified("stereo_" + side, side, undistort_rectify[side])
+        stereo_depth_worker.setup(stream_frontend.shape("stereo_left"), None, stereo_rectify_geometry, T[0],
+                                  stereo_depth.sgbm_params(stereo_min_disp, stereo_num_disp, stereo_window_size),
+                                  obstacle_distance_min_m, obstacle_distance_max_m, obstacle_distance_band)
+        print("INFO: Stereo depth on rectified images:", stereo_rectify_geometry, "sent at", obstacle_distance_msg_hz, "Hz")
 
     # For AprilTag detection
-    camera_params = [stereo_focal_px, stereo_focal_px, stereo_cx, stereo_cy]
+    camera_params = tag_rectify_geometry.camera_params()
+    if tag_detection_mode == "raw":
+        # The detector searches the crop, the corners are undistorted with the camera matrix of the crop
+        K_tag_raw = stream_frontend.add_raw("tag_raw", tag_image_source, K_side[tag_image_source], tag_raw_crop, tag_raw_scale)
+        raw_tag_detector = fisheye_tag_detection.RawFisheyeDetector(at_detector, K_tag_raw, D_side[tag_image_source],
+                                                                    R_side[tag_image_source], camera_params)
+        print("INFO: Tag detection on raw", tag_image_source, "image, cropped to", tag_raw_crop, "downsampled by", tag_raw_scale)
+    elif tag_tracking_enable:
+        tag_tracker = tag_tracking.RoiTracker(tag_rectify_geometry.size(), camera_params,
+                                              full_search_interval = tag_tracking_full_search_frames)
+
+    # The blur is measured in the image the detector runs on
+    if blur_gate_enable:
+        if raw_tag_detector is not None:
+            (blur_focal_px, blur_size) = (K_tag_raw[0][0], stream_frontend.shape("tag_raw")[::-1])
+        else:
+            (blur_focal_px, blur_size) = (camera_params[0], tag_rectify_geometry.size())
+        tag_blur_gate = blur_gate.BlurGate(blur_focal_px, m.hypot(*blur_size) / 2, blur_gate_soft_px, blur_gate_hard_px,
+                                           blur_gate_default_exposure_sec, blur_gate_enforce)
+
+    image_products.add_producers(stream_frontend.producers())
+
+    # The pose stage only needs the transformations set up above
+    if replay_source is None:
+        pose_thread = threading.Thread(target=pose_stage)
+        pose_thread.daemon = True
+        pose_thread.start()
+
+    if tag_detector_autotune:
+        autotune_detector()
+
+    if replay_source is not None:
+        replay_source.start(replay_pose, image_slot)
 
     while True:
-        # Wait for the next set of frames from the camera
-        frames = pipe.wait_for_frames()
-
-        # Fetch pose frame
-        pose = frames.get_pose_frame()
-
-        # Process pose streams
-        if pose:
-            # Store the timestamp for MAVLink messages
-            current_time = int(round(time.time() * 1000000))
-
-            # Pose data consists of translation and rotation
-            data = pose.get_pose_data()
-
-            # In transformations, Quaternions w+ix+jy+kz are represented as [w, x, y, z]!
-            H_T265Ref_T265body = tf.quaternion_matrix([data.rotation.w, data.rotation.x, data.rotation.y, data.rotation.z]) 
-            H_T265Ref_T265body[0][3] = data.translation.x * scale_factor
-            H_T265Ref_T265body[1][3] = data.translation.y * scale_factor
-            H_T265Ref_T265body[2][3] = data.translation.z * scale_factor
-
-            # Transform to aeronautic coordinates (body AND reference frame!)
-            H_aeroRef_aeroBody = H_aeroRef_T265Ref.dot( H_T265Ref_T265body.dot( H_T265body_aeroBody))
-
-            # Take offsets from body's center of gravity (or IMU) to camera's origin into account
-            if body_offset_enabled == 1:
-                H_body_camera = tf.euler_matrix(0, 0, 0, 'sxyz')
-                H_body_camera[0][3] = body_offset_x
-                H_body_camera[1][3] = body_offset_y
-                H_body_camera[2][3] = body_offset_z
-                H_camera_body = np.linalg.inv(H_body_camera)
-                H_aeroRef_aeroBody = H_body_camera.dot(H_aeroRef_aeroBody.dot(H_camera_body))
-
-            # Realign heading to face north using initial compass data
-            if compass_enabled == 1:
-                H_aeroRef_aeroBody = H_aeroRef_aeroBody.dot( tf.euler_matrix(0, 0, heading_north_yaw, 'sxyz'))
-
-            # Show debug messages here
-            if debug_enable == 1:
-                os.system('clear') # This helps in displaying the messages to be more readable
-                print("DEBUG: Raw RPY[deg]: {}".format( np.array( tf.euler_from_matrix( H_T265Ref_T265body, 'sxyz')) * 180 / m.pi))
-                print("DEBUG: NED RPY[deg]: {}".format( np.array( tf.euler_from_matrix( H_aeroRef_aeroBody, 'sxyz')) * 180 / m.pi))
-                print("DEBUG: Raw pos xyz : {}".format( np.array( [data.translation.x, data.translation.y, data.translation.z])))
-                print("DEBUG: NED pos xyz : {}".format( np.array( tf.translation_from_matrix( H_aeroRef_aeroBody))))
-
-        # Fetch raw fisheye image frames
-        f1 = frames.get_fisheye_frame(1).as_video_frame()
-        left_data = np.asanyarray(f1.get_data())
-        f2 = frames.get_fisheye_frame(2).as_video_frame()
-        right_data = np.asanyarray(f2.get_data())
-
-        # Process image streams
-        frame_copy = {"left" : left_data, "right" : right_data}
-
-        # Undistort and crop the center of the frames
-        center_undistorted = {"left" : cv2.remap(src = frame_copy["left"],
-                                      map1 = undistort_rectify["left"][0],
-                                      map2 = undistort_rectify["left"][1],
-                                      interpolation = cv2.INTER_LINEAR),
-                              "right" : cv2.remap(src = frame_copy["right"],
-                                      map1 = undistort_rectify["right"][0],
-                                      map2 = undistort_rectify["right"][1],
-                                      interpolation = cv2.INTER_LINEAR)}
-
-        # Run AprilTag detection algorithm on rectified image. 
-        # Params:
-        #   tag_image_source for "left" or "right"
-        #   tag_landing_size for actual size of the tag
-        tags = at_detector.detect(center_undistorted[tag_image_source], True, camera_params, tag_landing_size)
-
-        if tags != []:
-            for tag in tags:
-                # Check for the tag that we want to land on
-                if tag.tag_id == tag_landing_id:
-                    is_landing_tag_detected = True
-                    H_camera_tag = tf.euler_matrix(0, 0, 0, 'sxyz')
-                    H_camera_tag[0][3] = tag.pose_t[0]
-                    H_camera_tag[1][3] = tag.pose_t[1]
-                    H_camera_tag[2][3] = tag.pose_t[2]
-                    print("INFO: Detected landing tag", str(tag.tag_id), " relative to camera at x:", H_camera_tag[0][3], ", y:", H_camera_tag[1][3], ", z:", H_camera_tag[2][3])
-        else:
-            # print("INFO: No tag detected")
-            is_landing_tag_detected = False
-
-        # If enabled, display tag-detected image in a pop-up window, required a monitor to be connected
-        if visualization == 1:
-            # Create color image from source
-            tags_img = center_undistorted[tag_image_source]
-                
-            # For each detected tag, draw a bounding box and put the id of the tag in the center
-            for tag in tags:
-                # Setup bounding box
-                for idx in range(len(tag.corners)):
-                    cv2.line(tags_img, 
-                            tuple(tag.corners[idx-1, :].astype(int)), 
-                            tuple(tag.corners[idx, :].astype(int)), 
-                            thickness = 2,
-                            color = (255, 0, 0))
-
-                # The text to be put in the image, here we simply put the id of the detected tag
-                text = str(tag.tag_id)
-
-                # get boundary of this text
-                textsize = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1, 2)[0]
-
-                # Put the text in the middle of the image
-                cv2.putText(tags_img, 
-                            text,
-                            org = (((tag.corners[0, 0] + tag.corners[2, 0] - textsize[0])/2).astype(int), 
-                                   ((tag.corners[0, 1] + tag.corners[2, 1] + textsize[1])/2).astype(int)),
-                            fontFace = cv2.FONT_HERSHEY_SIMPLEX,
-                            fontScale = 0.5,
-                            thickness = 2,
-                            color = (255, 0, 0))
-
-            # Display the image in a window
-            cv2.imshow(WINDOW_TITLE, tags_img)
-
-            # Read keyboard input on the image window
-            key = cv2.waitKey(1)
-            if key == ord('q') or cv2.getWindowProperty(WINDOW_TITLE, cv2.WND_PROP_VISIBLE) < 1:
+        # Wait for the most recent fisheye frameset
+        image_frame = image_slot.get(timeout = 1)
+        if image_frame is None:
+            if replay_source is not None and replay_source.finished():
+                # The detections still in the pool belong to the replay
+                while detector_pool is not None and detector_pool.pending() > 0:
+                    collect_pool_results(timeout = 1)
                 break
+            continue
+
+        if not process_image_frame(image_frame):
+            break
+        image_stats.tick(time.time() - image_frame["arrival_time"])
 
 except KeyboardInterrupt:
     print("INFO: KeyboardInterrupt has been caught. Cleaning up...")     
 
 finally:
-    pipe.stop()
+    report_stage_stats()
+    if detector_pool is not None:
+        detector_pool.close()
+    if tag_viewer is not None:
+        tag_viewer.close()
+    if stereo_depth_worker is not None:
+        stereo_depth_worker.close()
+    if inbound_msg_filter is not None:
+        print(inbound_msg_filter.report())
+    if replay_source is not None:
+        print(replay_source.report())
+        if args.replay_targets:
+            replay_source.save_targets(args.replay_targets)
+            print("INFO: Landing targets of the replay saved to", args.replay_targets)
+    if pipe is not None:
+        pipe.stop()
+    if stream_recorder is not None:
+        stream_recorder.close()
     vehicle.close()
     print("INFO: Realsense pipeline and vehicle object closed.")
-    sys.exit()
\ No newline at end of file
+    sys.exit()
@@ -32,6 +32,11 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from dronekit import connect, VehicleMode
 from pymavlink import mavutil
 
+import realtime_utils
+import mavlink_inbound_filter
+import mavlink_param_server
+import scale_estimator
+
 #######################################
 # Parameters
 #######################################
@@ -41,6 +46,9 @@ connection_string_default = '/dev/ttyUSB0'
 connection_baudrate_default = 921600
 connection_timeout_sec_default = 5
 
+# MAVLink component id of this script, the GCS addresses the parameters below with it
+mavlink_component_id = 197      # MAV_COMP_ID_VISUAL_INERTIAL_ODOMETRY
+
 # Transformation to convert different camera orientations to NED convention. Replace camera_orientation_default for your configuration.
 #   0: Forward, USB port to the right
 #   1: Downfacing, USB port to the right 
@@ -80,12 +88,54 @@ body_offset_z = 0  # In meters (m)
 # Global scale factor, position x y z will be scaled up/down by this factor
 scale_factor = 1.0
 
+# Online scale calibration: the T265 displacement is compared against an independent distance source of the FCU.
+# Source name: (MAVLink message, rate at which it is requested from the FCU)
+scale_calib_sources = {
+    'rangefinder'   : ('DISTANCE_SENSOR', 10),
+    'baro'          : ('SCALED_PRESSURE', 10),
+    'gps'           : ('GPS_RAW_INT',     5),
+}
+scale_calib_source_default = 'rangefinder'
+scale_calib_max_std = 0.02      # The estimate is considered converged when its standard deviation is below this
+scale_calib_report_hz = 1
+
+# Pose jump is indicated when position changes abruptly. The behavior is not well documented yet (as of librealsense 2.34.0)
+jump_threshold = 0.1 # in meters, from trials and errors, should be relative to how frequent is the position data obtained (200Hz for the T265)
+
+# Settings that can be changed from the GCS while running, as MAVLink parameter name: (variable, type, check for a valid value).
+# Changes are saved to param_file_default and loaded on next start, except for settings given on the command line.
+bridge_params = {
+    'T265_SCALE'        : ('scale_factor',                      float,  lambda v: v > 0),
+    'T265_BODY_OFS_EN'  : ('body_offset_enabled',               int,    lambda v: v in (0, 1)),
+    'T265_BODY_OFS_X'   : ('body_offset_x',                     float,  lambda v: abs(v) < 10),
+    'T265_BODY_OFS_Y'   : ('body_offset_y',                     float,  lambda v: abs(v) < 10),
+    'T265_BODY_OFS_Z'   : ('body_offset_z',                     float,  lambda v: abs(v) < 10),
+    'T265_CAM_ORIENT'   : ('camera_orientation',                int,    lambda v: v in (0, 1, 2)),
+    'T265_VPE_HZ'       : ('vision_position_estimate_msg_hz',   float,  lambda v: 0 < v <= 200),
+    'T265_VPD_HZ'       : ('vision_position_delta_msg_hz',      float,  lambda v: 0 < v <= 200),
+    'T265_VSE_HZ'       : ('vision_speed_estimate_msg_hz',      float,  lambda v: 0 < v <= 200),
+    'T265_JUMP_THR'     : ('jump_threshold',                    float,  lambda v: v > 0),
+}
+param_file_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 't265_to_mavlink_params.json')
+
 # Enable using yaw from compass to align north (zero degree is facing north)
 compass_enabled = 0
+attitude_msg_hz_default = 10    # Rate at which ATTITUDE is requested from the FCU when compass is enabled
+
+# Only decode the inbound MAVLink messages that are used, and ask the FCU to stop streaming the others
+enable_inbound_msg_filter = True
 
 # pose data confidence: 0x0 - Failed / 0x1 - Low / 0x2 - Medium / 0x3 - High 
 pose_data_confidence_level = ('FAILED', 'Low', 'Medium', 'High')
 
+# Real-time mode: SCHED_FIFO priority of the pose loop thread, the message writer threads run one level below
+rt_priority_default = 50
+# In real-time mode automatic garbage collection is disabled, the young generation is collected every N pose frames instead
+gc_collect_interval_frames = 200
+# and every gc_full_collect_interval_sec, at the same point, all generations: the objects that survive the young
+# collections end up in the older ones, and reference cycles among them would otherwise never be freed
+gc_full_collect_interval_sec = 10
+
 # lock for thread synchronization
 lock = threading.Lock()
 
@@ -96,6 +146,15 @@ lock = threading.Lock()
 # FCU connection variables
 vehicle = None
 is_vehicle_connected = False
+inbound_msg_filter = None
+
+# Parameter server for the settings above
+param_server = None
+
+# Online scale calibration
+scale_calib = None
+scale_calib_gps_origin = None
+is_scale_calib_converged = False
 
 # Camera-related variables
 pipe = None
@@ -109,6 +168,7 @@ prev_data = None
 H_aeroRef_aeroBody = None
 V_aeroRef_aeroBody = None
 heading_north_yaw = None
+t265_position_aeroRef = None    # Unscaled position in NED, for the scale calibration
 current_confidence_level = None
 current_time_us = 0
 
@@ -133,11 +193,25 @@ parser.add_argument('--vision_position_delta_msg_hz', type=float,
 parser.add_argument('--vision_speed_estimate_msg_hz', type=float,
                     help="Update frequency for VISION_SPEED_DELTA message. If not specified, a default value will be used.")
 parser.add_argument('--scale_calib_enable', default=False, action='store_true',
-                    help="Scale calibration. Only run while NOT in flight")
+                    help="Online scale calibration against a distance source of the FCU, converges during a normal hover with some climbs and descents")
+parser.add_argument('--scale_calib_source', choices=sorted(scale_calib_sources),
+                    help="Reference for the scale calibration. If not specified, a default source will be used.")
+parser.add_argument('--scale_calib_apply', default=False, action='store_true',
+                    help="Apply the estimated scale once the scale calibration has converged")
 parser.add_argument('--camera_orientation', type=int,
                     help="Configuration for camera orientation. Currently supported: forward, usb port to the right - 0; downward, usb port to the right - 1, 2: forward tilted down 45deg")
 parser.add_argument('--debug_enable',type=int,
                     help="Enable debug messages on terminal")
+parser.add_argument('--realtime', default=False, action='store_true',
+                    help="Real-time mode: SCHED_FIFO priority for the pose loop and writer threads, locked memory and controlled garbage collection. Requires root or CAP_SYS_NICE")
+parser.add_argument('--rt_priority', type=int,
+                    help="SCHED_FIFO priority (1-99) of the pose loop in real-time mode. If not specified, a default value will be used.")
+parser.add_argument('--cpu_affinity',
+                    help="CPUs to pin the pose loop and writer threads to, e.g. '2,3' or '2-3'")
+parser.add_argument('--latency_stats', default=False, action='store_true',
+                    help="Record and report scheduling latency histograms per thread (always on in real-time mode)")
+parser.add_argument('--param_file',
+                    help="File where parameters changed from the GCS are saved. If not specified, a default file will be used.")
 
 args = parser.parse_args()
 
@@ -147,8 +221,15 @@ vision_position_estimate_msg_hz = args.vision_position_estimate_msg_hz
 vision_position_delta_msg_hz = args.vision_position_delta_msg_hz
 vision_speed_estimate_msg_hz = args.vision_speed_estimate_msg_hz
 scale_calib_enable = args.scale_calib_enable
+scale_calib_source = args.scale_calib_source
+scale_calib_apply = args.scale_calib_apply
 camera_orientation = args.camera_orientation
 debug_enable = args.debug_enable
+realtime_enable = args.realtime
+rt_priority = args.rt_priority
+cpu_affinity = args.cpu_affinity
+latency_stats_enable = args.latency_stats or args.realtime
+param_file = args.param_file
 
 # Using default values if no specified inputs
 if not connection_string:
@@ -192,12 +273,13 @@ else:
     print("INFO: Using compass: Disabled")
 
 if scale_calib_enable == True:
-    print("\nINFO: SCALE CALIBRATION PROCESS. DO NOT RUN DURING FLIGHT.\nINFO: TYPE IN NEW SCALE IN FLOATING POINT FORMAT\n")
+    if not scale_calib_source:
+        scale_calib_source = scale_calib_source_default
+    print("INFO: Online scale calibration: Enabled, against", scale_calib_source, ", result will be", "applied" if scale_calib_apply else "reported only")
+if scale_factor == 1.0:
+    print("INFO: Using default scale factor", scale_factor)
 else:
-    if scale_factor == 1.0:
-        print("INFO: Using default scale factor", scale_factor)
-    else:
-        print("INFO: Using scale factor", scale_factor)
+    print("INFO: Using scale factor", scale_factor)
 
 if not camera_orientation:
     camera_orientation = camera_orientation_default
@@ -205,18 +287,9 @@ if not camera_orientation:
 else:
     print("INFO: Using camera orientation", camera_orientation)
 
-if camera_orientation == 0:     # Forward, USB port to the right
-    H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
-    H_T265body_aeroBody = np.linalg.inv(H_aeroRef_T265Ref)
-elif camera_orientation == 1:   # Downfacing, USB port to the right
-    H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
-    H_T265body_aeroBody = np.array([[0,1,0,0],[1,0,0,0],[0,0,-1,0],[0,0,0,1]])
-elif camera_orientation == 2:   # 45degree forward
-    H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
-    H_T265body_aeroBody = (tf.euler_matrix(m.pi/4, 0, 0)).dot(np.linalg.inv(H_aeroRef_T265Ref))
-else:                           # Default is facing forward, USB port to the right
-    H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
-    H_T265body_aeroBody = np.linalg.inv(H_aeroRef_T265Ref)
+if not param_file:
+    param_file = param_file_default
+print("INFO: Using parameter file", param_file)
 
 if not debug_enable:
     debug_enable = 0
@@ -225,11 +298,84 @@ else:
     np.set_printoptions(precision=4, suppress=True) # Format output on terminal 
     print("INFO: Debug messages enabled.")
 
+if not rt_priority:
+    rt_priority = rt_priority_default
+
+if cpu_affinity:
+    cpu_affinity = realtime_utils.parse_cpu_list(cpu_affinity)
+
+if realtime_enable:
+    print("INFO: Real-time mode: Enabled, priority", rt_priority, "CPUs", sorted(cpu_affinity) if cpu_affinity else "all")
+else:
+    print("INFO: Real-time mode: Disabled")
+
+if latency_stats_enable:
+    print("INFO: Scheduling latency statistics: Enabled")
+
 
 #######################################
 # Functions
 #######################################
 
+# Compute the transformations that only depend on the settings, once, instead of for every pose
+def update_transform_cache():
+    global H_aeroRef_T265Ref, H_T265body_aeroBody, H_body_camera, H_camera_body
+    if camera_orientation == 0:     # Forward, USB port to the right
+        H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
+        H_T265body_aeroBody = np.linalg.inv(H_aeroRef_T265Ref)
+    elif camera_orientation == 1:   # Downfacing, USB port to the right
+        H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
+        H_T265body_aeroBody = np.array([[0,1,0,0],[1,0,0,0],[0,0,-1,0],[0,0,0,1]])
+    elif camera_orientation == 2:   # 45degree forward
+        H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
+        H_T265body_aeroBody = (tf.euler_matrix(m.pi/4, 0, 0)).dot(np.linalg.inv(H_aeroRef_T265Ref))
+    else:                           # Default is facing forward, USB port to the right
+        H_aeroRef_T265Ref   = np.array([[0,0,-1,0],[1,0,0,0],[0,-1,0,0],[0,0,0,1]])
+        H_T265body_aeroBody = np.linalg.inv(H_aeroRef_T265Ref)
+
+    # Offsets from body's center of gravity (or IMU) to camera's origin
+    H_body_camera = tf.euler_matrix(0, 0, 0, 'sxyz')
+    H_body_camera[0][3] = body_offset_x
+    H_body_camera[1][3] = body_offset_y
+    H_body_camera[2][3] = body_offset_z
+    H_camera_body = np.linalg.inv(H_body_camera)
+
+# Apply a parameter change from the GCS. The pose loop holds the lock while it uses the settings,
+# so the new value and the transform cache take effect together between two poses.
+def apply_param(name, value):
+    (variable, value_type, is_valid) = bridge_params[name]
+    if value != value_type(value) or not is_valid(value_type(value)):
+        return None
+    value = value_type(value)
+
+    with lock:
+        globals()[variable] = value
+        update_transform_cache()
+
+    # Message rates take effect from the next run of the job
+    if variable == 'vision_position_estimate_msg_hz' and enable_msg_vision_position_estimate:
+        add_writer_job(send_vision_position_estimate_message, value)
+    elif variable == 'vision_position_delta_msg_hz' and enable_msg_vision_position_delta:
+        add_writer_job(send_vision_position_delta_message, value)
+    elif variable == 'vision_speed_estimate_msg_hz' and enable_msg_vision_speed_estimate:
+        add_writer_job(send_vision_speed_estimate_message, value)
+    return value
+
+# Serve the settings as MAVLink parameters. Stored values are used for the settings not given on the command line.
+def setup_param_server():
+    global param_server
+    param_server = mavlink_param_server.ParamServer(param_file, apply_param)
+    cli_variables = [variable for (variable, value) in vars(args).items() if value is not None]
+    for (name, (variable, value_type, is_valid)) in bridge_params.items():
+        param_server.add(name, globals()[variable])
+    for (name, value) in param_server.load().items():
+        (variable, value_type, is_valid) = bridge_params[name]
+        if variable in cli_variables or value != value_type(value) or not is_valid(value_type(value)):
+            continue
+        globals()[variable] = value_type(value)
+        param_server.values[name] = value
+        print("INFO: Using stored parameter", name, "=", value)
+
 # https://mavlink.io/en/messages/common.html#VISION_POSITION_ESTIMATE
 def send_vision_position_estimate_message():
     global is_vehicle_connected, current_time_us, H_aeroRef_aeroBody, reset_counter
@@ -408,7 +554,7 @@ def vehicle_connect():
     global vehicle, is_vehicle_connected
     
     try:
-        vehicle = connect(connection_string, wait_ready = True, baud = connection_baudrate, source_system = 1)
+        vehicle = connect(connection_string, wait_ready = True, baud = connection_baudrate, source_system = 1, source_component = mavlink_component_id)
     except:
         print('Connection error! Retrying...')
         sleep(1)
@@ -420,6 +566,25 @@ def vehicle_connect():
         is_vehicle_connected = True
         return True
 
+# Decode only the messages this script listens to, and only have the FCU stream those
+def setup_inbound_msg_filter():
+    global inbound_msg_filter
+    inbound_msg_filter = mavlink_inbound_filter.InboundFilter(vehicle)
+    inbound_msg_filter.subscribe('HEARTBEAT', 'STATUSTEXT', 'TIMESYNC', 'COMMAND_ACK')
+    inbound_msg_filter.subscribe('PARAM_REQUEST_LIST', 'PARAM_REQUEST_READ', 'PARAM_SET')
+    streamed_msg_rates = {}
+    if scale_calib_enable == True:
+        (msg_name, msg_hz) = scale_calib_sources[scale_calib_source]
+        inbound_msg_filter.subscribe(msg_name)
+        streamed_msg_rates[msg_name] = msg_hz
+    if compass_enabled == 1:
+        inbound_msg_filter.subscribe('ATTITUDE')
+        streamed_msg_rates['ATTITUDE'] = attitude_msg_hz_default
+    if inbound_msg_filter.install():
+        inbound_msg_filter.request_streams(streamed_msg_rates)
+    else:
+        inbound_msg_filter = None
+
 # List of notification events: https://github.com/IntelRealSense/librealsense/blob/development/include/librealsense2/h/rs_types.h
 # List of notification API: https://github.com/IntelRealSense/librealsense/blob/development/common/notifications.cpp
 def realsense_notification_callback(notif):
@@ -428,6 +593,8 @@ def realsense_notification_callback(notif):
     if notif.get_category() is rs.notification_category.pose_relocalization:
         reset_counter += 1
         send_msg_to_gcs('Relocalization detected')
+        if scale_calib is not None:
+            scale_calib.reset_anchor()
 
 def realsense_connect():
     global pipe, pose_sensor
@@ -449,15 +616,48 @@ def realsense_connect():
     # Start streaming with requested config
     pipe.start(cfg)
 
+# Feed the scale calibration with a reference sample from the FCU, paired with the latest unscaled T265 position
+def scale_calib_msg_callback(self, attr_name, msg):
+    global scale_calib_gps_origin
+    with lock:
+        if t265_position_aeroRef is None:
+            return
+        t265_altitude = -t265_position_aeroRef[2]
+
+        if scale_calib_source == 'rangefinder':
+            # Downward facing rangefinders only, distance in cm
+            if msg.orientation != mavutil.mavlink.MAV_SENSOR_ROTATION_PITCH_270 or not (msg.min_distance < msg.current_distance < msg.max_distance):
+                return
+            scale_calib.add_sample(t265_altitude, msg.current_distance / 100)
+        elif scale_calib_source == 'baro':
+            scale_calib.add_sample(t265_altitude, scale_estimator.pressure_altitude(msg.press_abs))
+        elif scale_calib_source == 'gps':
+            if msg.fix_type < mavutil.mavlink.GPS_FIX_TYPE_3D_FIX:
+                return
+            fix = (msg.lat * 1e-7, msg.lon * 1e-7, msg.alt * 1e-3)
+            if scale_calib_gps_origin is None:
+                scale_calib_gps_origin = fix
+            (north, east, up) = scale_estimator.gps_to_local(*(fix + scale_calib_gps_origin))
+            scale_calib.add_sample(tuple(t265_position_aeroRef), (north, east, -up))
+
+# Report the scale estimate and, once converged, apply it through the scale parameter if requested
+def report_scale_calib():
+    global is_scale_calib_converged
+    with lock:
+        (scale, std, num_samples) = (scale_calib.scale, scale_calib.std(), scale_calib.num_samples)
+        converged = scale_calib.is_converged(scale_calib_max_std)
+    print("INFO: Scale estimate %.4f +- %.4f (2 sigma) from %d samples, in use %.4f" % (scale, 2 * std, num_samples, scale_factor))
+
+    if converged and not is_scale_calib_converged:
+        is_scale_calib_converged = True
+        send_msg_to_gcs('Scale estimate %.3f +- %.3f' % (scale, 2 * std))
+        if scale_calib_apply:
+            param_server.set('T265_SCALE', round(scale, 4))
+            send_msg_to_gcs('Scale %.3f applied' % scale_factor)
+
 # Monitor user input from the terminal and perform action accordingly
 def user_input_monitor():
-    global scale_factor
     while True:
-        # Special case: updating scale
-        if scale_calib_enable == True:
-            scale_factor = float(input("INFO: Type in new scale as float number\n"))
-            print("INFO: New scale is ", scale_factor)
-
         if enable_auto_set_ekf_home:
             send_msg_to_gcs('Set EKF home with default GPS location')
             set_default_global_origin()
@@ -481,6 +681,9 @@ def user_input_monitor():
 # Main code starts here
 #######################################
 
+setup_param_server()
+update_transform_cache()
+
 print("INFO: Connecting to vehicle.")
 while (not vehicle_connect()):
     pass
@@ -494,24 +697,61 @@ if compass_enabled == 1:
     # Listen to the attitude data in aeronautical frame
     vehicle.add_message_listener('ATTITUDE', att_msg_callback)
 
+if scale_calib_enable == True:
+    scale_calib = scale_estimator.ScaleEstimator(initial_scale = scale_factor)
+    vehicle.add_message_listener(scale_calib_sources[scale_calib_source][0], scale_calib_msg_callback)
+
+if enable_inbound_msg_filter:
+    setup_inbound_msg_filter()
+
 # Send MAVlink messages in the background at pre-determined frequencies
 sched = BackgroundScheduler()
 
+# Scheduling latency of each thread, reported when the script exits
+latency_histograms = []
+
+writer_jobs = {}
+writer_histograms = {}
+
+# Writer jobs are wrapped to record how late they start and, in real-time mode, to set their thread priority.
+# Calling this again for the same function changes the rate of its job.
+def add_writer_job(func, hz):
+    name = func.__name__
+    if latency_stats_enable:
+        if name not in writer_histograms:
+            writer_histograms[name] = realtime_utils.LatencyHistogram(name)
+            latency_histograms.append(writer_histograms[name])
+        if realtime_enable:
+            func = realtime_utils.periodic_job(func, 1/hz, writer_histograms[name], rt_priority - 1, cpu_affinity)
+        else:
+            func = realtime_utils.periodic_job(func, 1/hz, writer_histograms[name])
+    if name in writer_jobs:
+        writer_jobs[name].modify(func = func)
+        writer_jobs[name].reschedule('interval', seconds = 1/hz)
+    else:
+        writer_jobs[name] = sched.add_job(func, 'interval', seconds = 1/hz, id = name)
+
 if enable_msg_vision_position_estimate:
-    sched.add_job(send_vision_position_estimate_message, 'interval', seconds = 1/vision_position_estimate_msg_hz)
+    add_writer_job(send_vision_position_estimate_message, vision_position_estimate_msg_hz)
 
 if enable_msg_vision_position_delta:
-    sched.add_job(send_vision_position_delta_message, 'interval', seconds = 1/vision_position_delta_msg_hz)
+    add_writer_job(send_vision_position_delta_message, vision_position_delta_msg_hz)
     send_vision_position_delta_message.H_aeroRef_PrevAeroBody = tf.quaternion_matrix([1,0,0,0]) 
     send_vision_position_delta_message.prev_time_us = int(round(time.time() * 1000000))
 
 if enable_msg_vision_speed_estimate:
-    sched.add_job(send_vision_speed_estimate_message, 'interval', seconds = 1/vision_speed_estimate_msg_hz)
+    add_writer_job(send_vision_speed_estimate_message, vision_speed_estimate_msg_hz)
 
 if enable_update_tracking_confidence_to_gcs:
     sched.add_job(update_tracking_confidence_to_gcs, 'interval', seconds = 1/update_tracking_confidence_to_gcs_hz_default)
     update_tracking_confidence_to_gcs.prev_confidence_level = -1
 
+if scale_calib_enable == True:
+    sched.add_job(report_scale_calib, 'interval', seconds = 1/scale_calib_report_hz)
+
+# Only once the writer jobs exist: a rate set from the GCS reschedules its job
+param_server.attach(vehicle)
+
 # A separate thread to monitor user input
 user_keyboard_input_thread = threading.Thread(target=user_input_monitor)
 user_keyboard_input_thread.daemon = True
@@ -526,6 +766,21 @@ send_msg_to_gcs('Sending vision messages to FCU')
 
 print("INFO: Press Enter to set EKF home at default location")
 
+# The pose loop latency is the time from the pose timestamp to the loop having the frame, relative to the best case seen
+if latency_stats_enable:
+    pose_latency_histogram = realtime_utils.LatencyHistogram('pose_loop')
+    latency_histograms.insert(0, pose_latency_histogram)
+    gc_latency_histogram = realtime_utils.LatencyHistogram('gc_collect')
+    min_pose_delay = None
+
+if realtime_enable:
+    realtime_utils.apply_realtime('pose_loop', rt_priority, cpu_affinity)
+    realtime_utils.lock_memory()
+    realtime_utils.disable_gc()
+    latency_histograms.append(gc_latency_histogram)
+    frames_since_gc = 0
+    last_full_gc = time.time()
+
 try:
     while True:
         # Monitor last_heartbeat to reconnect in case of lost connection
@@ -533,7 +788,12 @@ try:
             is_vehicle_connected = False
             print("WARNING: CONNECTION LOST. Last hearbeat was %f sec ago."% vehicle.last_heartbeat)
             print("WARNING: Attempting to reconnect ...")
-            vehicle_connect()
+            if vehicle_connect():
+                param_server.attach(vehicle)
+                if scale_calib_enable == True:
+                    vehicle.add_message_listener(scale_calib_sources[scale_calib_source][0], scale_calib_msg_callback)
+                if enable_inbound_msg_filter:
+                    setup_inbound_msg_filter()
             continue
         
         # Wait for the next set of frames from the camera
@@ -544,6 +804,12 @@ try:
 
         # Process data
         if pose:
+            if latency_stats_enable:
+                pose_delay = time.time() - pose.get_timestamp() / 1000
+                if min_pose_delay is None or pose_delay < min_pose_delay:
+                    min_pose_delay = pose_delay
+                pose_latency_histogram.record(pose_delay - min_pose_delay)
+
             with lock:
                 # Store the timestamp for MAVLink messages
                 current_time_us = int(round(time.time() * 1000000))
@@ -575,22 +841,21 @@ try:
                     delta_translation = [data.translation.x - prev_data.translation.x, data.translation.y - prev_data.translation.y, data.translation.z - prev_data.translation.z]
                     position_displacement = np.linalg.norm(delta_translation)
 
-                    # Pose jump is indicated when position changes abruptly. The behavior is not well documented yet (as of librealsense 2.34.0)
-                    jump_threshold = 0.1 # in meters, from trials and errors, should be relative to how frequent is the position data obtained (200Hz for the T265)
                     if (position_displacement > jump_threshold):
                         send_msg_to_gcs('Pose jump detected')
                         print("Position jumped by: ", position_displacement)
                         reset_counter += 1
+                        if scale_calib is not None:
+                            scale_calib.reset_anchor()
                     
                 prev_data = data
 
+                # Unscaled position in NED for the scale calibration
+                if scale_calib_enable == True:
+                    t265_position_aeroRef = H_aeroRef_T265Ref[:3, :3].dot([data.translation.x, data.translation.y, data.translation.z])
+
                 # Take offsets from body's center of gravity (or IMU) to camera's origin into account
                 if body_offset_enabled == 1:
-                    H_body_camera = tf.euler_matrix(0, 0, 0, 'sxyz')
-                    H_body_camera[0][3] = body_offset_x
-                    H_body_camera[1][3] = body_offset_y
-                    H_body_camera[2][3] = body_offset_z
-                    H_camera_body = np.linalg.inv(H_body_camera)
                     H_aeroRef_aeroBody = H_body_camera.dot(H_aeroRef_aeroBody.dot(H_camera_body))
 
                 # Realign heading to face north using initial compass data
@@ -605,6 +870,17 @@ try:
                     print("DEBUG: Raw pos xyz : {}".format( np.array( [data.translation.x, data.translation.y, data.translation.z])))
                     print("DEBUG: NED pos xyz : {}".format( np.array( tf.translation_from_matrix( H_aeroRef_aeroBody))))
 
+            # Collect garbage right after a pose was handled, the next one is about 5 ms away
+            if realtime_enable:
+                frames_since_gc += 1
+                if frames_since_gc >= gc_collect_interval_frames:
+                    frames_since_gc = 0
+                    generation = 0
+                    if time.time() - last_full_gc >= gc_full_collect_interval_sec:
+                        generation = 2
+                        last_full_gc = time.time()
+                    gc_latency_histogram.record(realtime_utils.collect_gc(generation))
+
 except KeyboardInterrupt:
     send_msg_to_gcs('Closing the script...')  
 
@@ -613,6 +889,10 @@ except:
     print("Unexpected error:", sys.exc_info()[0])
 
 finally:
+    for histogram in latency_histograms:
+        print(histogram.report())
+    if inbound_msg_filter is not None:
+        print(inbound_msg_filter.report())
     pipe.stop()
     vehicle.close()
     print("INFO: Realsense pipeline and vehicle object closed.")
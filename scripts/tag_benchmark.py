@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Synthetic fisheye AprilTag benchmark          ##
+#####################################################
+# Accuracy and latency of the tag detection paths (remap, raw, raw crop) and detector configurations, on
+# tag36h11 tags and landing pads rendered into the raw fisheye image with the calibration of cfg/t265.yaml,
+# where the true pose of every tag is known. The poses are solved as t265_precland_apriltags.py does: the
+# corners of all the tags of the scene in one solve (tag_bundle), or for a single tag on the remap path the
+# pose estimated by the detector itself ("remap pose").
+#
+# Each sweep varies one factor around the nominal condition, the others keep their nominal value:
+#   - distance_m: distance from the camera to the tag
+#   - tilt_deg: angle between the tag normal and the line of sight, about a random axis in the tag plane
+#   - blur_px: length of a motion blur in a random direction, in raw pixels
+#   - noise: standard deviation of the sensor noise, in gray levels
+#   - lighting: gain, offset and gradient of the illumination, see lightings
+# Sample i of every condition places the tag at the same random position in the field of view and rotation
+# about its normal, so the conditions are compared on the same poses.
+#
+# Per scene, condition, path and configuration: recall, detection latency (including the remap or the
+# undistortion of the corners and the pose solve), position and rotation errors of the pose, and error and
+# bias of the target angles sent in LANDING_TARGET. Results as a table, and as CSV and JSON for comparisons
+# across versions and computers:
+#   python3 tag_benchmark.py --csv results.csv --json results.json
+
+import math as m
+import time
+import json
+import argparse
+
+import numpy as np
+import cv2
+
+import fisheye_rectify
+import fisheye_tag_detection
+import landing_target
+import tag_bundle
+import tag_detector_tuning
+
+nominal = {"distance_m": 1.5, "tilt_deg": 0.0, "blur_px": 0.0, "noise": 2.0, "lighting": "normal"}
+
+sweeps = {"distance_m": [0.5, 1.0, 1.5, 2.0, 3.0, 5.0],
+          "tilt_deg": [0.0, 20.0, 40.0, 60.0, 70.0],
+          "blur_px": [0.0, 2.0, 4.0, 8.0, 12.0],
+          "noise": [0.0, 2.0, 5.0, 10.0, 20.0],
+          "lighting": ["normal", "dark", "overexposed", "low_contrast", "gradient"]}
+
+# Applied to the rendered image, black 0 and white 255: gain, offset, and the drop of brightness from the right
+# to the left edge of the image as a fraction
+lightings = {"normal": (1.0, 0.0, 0.0),
+             "dark": (0.15, 0.0, 0.0),
+             "overexposed": (1.5, 80.0, 0.0),
+             "low_contrast": (0.25, 100.0, 0.0),
+             "gradient": (1.0, 0.0, 0.8)}
+
+# Landing pad of the pad scene, in the format of tag_bundle
+default_pad_layout = {0: (0.144, (0.0, 0.0)), 1: (0.048, (0.13, 0.0)), 2: (0.048, (-0.13, 0.0))}
+
+# Texture of a landing pad, square and centered on the origin of the pad. Returns (texture, pixels per meter)
+def pad_texture(layout, cell_px=10, margin_m=0.02):
+    ppm = cell_px / min(size / 8 for (size, position) in layout.values())
+    extent = max(max(abs(x), abs(y)) + size * 5 / 8 for (size, (x, y)) in layout.values()) + margin_m
+    side = int(m.ceil(2 * extent * ppm)) | 1
+    texture = np.full((side, side), 255, dtype=np.uint8)
+    center = (side - 1) / 2
+    for (tag_id, (size, (x, y))) in layout.items():
+        tag = fisheye_tag_detection.tag_texture(tag_id, int(round(size * ppm)))
+        # x right and y down on the pad are the columns and rows of the texture
+        x0 = int(round(center + x * ppm - (tag.shape[1] - 1) / 2))
+        y0 = int(round(center + y * ppm - (tag.shape[0] - 1) / 2))
+        texture[y0:y0 + tag.shape[0], x0:x0 + tag.shape[1]] = tag
+    return (texture, ppm)
+
+# Random pose of sample i at distance_m with tilt_deg: H_camera_tag for render_tag and the pose the detector
+# should find, in the frame of the AprilTag pose (x right, y down, z into the tag)
+def sample_pose(random, distance_m, tilt_deg, max_off_axis_deg):
+    # Direction of the tag uniformly distributed in a cone around the optical axis
+    off_axis = m.radians(max_off_axis_deg) * m.sqrt(random.uniform())
+    azimuth = random.uniform(0, 2 * m.pi)
+    direction = np.array([m.sin(off_axis) * m.cos(azimuth), m.sin(off_axis) * m.sin(azimuth), m.cos(off_axis)])
+    spin = random.uniform(0, 2 * m.pi)
+    tilt_axis = random.uniform(0, 2 * m.pi)
+
+    # Facing the camera, rotated about its normal, then tilted
+    R = np.diag([1.0, -1.0, -1.0])
+    R = R.dot(cv2.Rodrigues(np.array([0.0, 0.0, spin]))[0])
+    R = R.dot(cv2.Rodrigues(m.radians(tilt_deg) * np.array([m.cos(tilt_axis), m.sin(tilt_axis), 0.0]))[0])
+    H_camera_tag = np.eye(4)
+    H_camera_tag[:3, :3] = R
+    H_camera_tag[:3, 3] = direction * distance_m
+    # render_tag has y up and z out of the tag
+    return (H_camera_tag, R.dot(np.diag([1.0, -1.0, -1.0])), H_camera_tag[:3, 3].copy())
+
+def motion_blur(image, length_px, angle):
+    size = int(m.ceil(length_px)) | 1
+    kernel = np.zeros((size, size), dtype=np.float32)
+    c = (size - 1) / 2
+    dx = length_px / 2 * m.cos(angle)
+    dy = length_px / 2 * m.sin(angle)
+    # Sub-pixel line endpoints, 4 fractional bits
+    cv2.line(kernel, (int(round((c - dx) * 16)), int(round((c - dy) * 16))), (int(round((c + dx) * 16)), int(round((c + dy) * 16))),
+             1.0, thickness = 1, lineType = cv2.LINE_AA, shift = 4)
+    return cv2.filter2D(image, -1, kernel / kernel.sum(), borderType = cv2.BORDER_REPLICATE)
+
+# Raw image of the scene under condition, from a rendered image with black 0 and white 255
+def degrade(random, image, condition):
+    (gain, offset, gradient) = lightings[condition["lighting"]]
+    image = image.astype(np.float32) * gain + offset
+    if gradient > 0:
+        image *= np.linspace(1 - gradient, 1, image.shape[1], dtype=np.float32)[None, :]
+    blur_angle = random.uniform(0, m.pi)
+    if condition["blur_px"] > 0:
+        image = motion_blur(image, condition["blur_px"], blur_angle)
+    if condition["noise"] > 0:
+        image += random.normal(0, condition["noise"], image.shape).astype(np.float32)
+    return np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+def rotation_error_deg(R_estimated, R_true):
+    cos_angle = (np.trace(np.asarray(R_estimated).T.dot(R_true)) - 1) / 2
+    return m.degrees(m.acos(min(1.0, max(-1.0, cos_angle))))
+
+class Benchmark(object):
+    # detector: apriltags3.Detector. configs: detector configurations as in tag_detector_tuning.
+    # scenes: {name: tag_bundle.TagBundle}, a single tag being a pad of one tag at its origin
+    def __init__(self, detector, calib, geometry, scenes, configs, paths=('remap', 'remap pose', 'raw', 'raw crop'),
+                 samples=10, seed=0, max_off_axis_deg=25.0):
+        self.detector = detector
+        self.calib = calib
+        self.geometry = geometry
+        self.scenes = scenes
+        self.configs = configs
+        self.samples = samples
+        self.seed = seed
+        self.max_off_axis_deg = max_off_axis_deg
+
+        K = calib["K1"]
+        D = calib["D1"]
+        R = np.eye(3)
+        self.raw_size = calib["input"]
+        self.camera_params = geometry.camera_params()
+        self.rays = fisheye_tag_detection.camera_rays(K, D, self.raw_size)
+        self.textures = {name: pad_texture(bundle.layout) for (name, bundle) in scenes.items()}
+
+        maps = fisheye_rectify.build_maps(K, D, R, geometry.projection_matrix(), geometry.size())
+        self.maps = maps
+        crop = fisheye_tag_detection.raw_crop(K, D, R, geometry, self.raw_size)
+        raw_detectors = {"raw": fisheye_tag_detection.RawFisheyeDetector(detector, K, D, R, self.camera_params),
+                         "raw crop": fisheye_tag_detection.RawFisheyeDetector(detector, K, D, R, self.camera_params, crop)}
+        # Pose of the scene in an image, from the tags found with their corners in the rectified image
+        def bundle_path(detect):
+            return lambda image, bundle: bundle.solve(detect(image), self.camera_params)
+        all_paths = {"remap": bundle_path(lambda image: detector.detect(fisheye_rectify.remap(image, maps), False)),
+                     "remap pose": self.detector_pose}
+        for (name, raw_detector) in raw_detectors.items():
+            all_paths[name] = bundle_path((lambda raw_detector: lambda image: raw_detector.detect(image, None, estimate_tag_pose=False))(raw_detector))
+        self.paths = {name: all_paths[name] for name in paths}
+
+    # Pose of a single tag scene estimated by the detector on the remap path, None for scenes of several tags
+    def detector_pose(self, image, bundle):
+        if len(bundle.layout) != 1:
+            return None
+        (tag_id, (tag_size, position)) = list(bundle.layout.items())[0]
+        tags = self.detector.detect(fisheye_rectify.remap(image, self.maps), True,
+                                    fisheye_tag_detection.detector_camera_params(self.camera_params), tag_size)
+        return next((tag for tag in tags if tag.tag_id == tag_id), None)
+
+    # Raw images of the samples of a scene under condition, with the true pose of the pad
+    def render(self, scene, condition):
+        (texture, ppm) = self.textures[scene]
+        samples = []
+        for i in range(self.samples):
+            random = np.random.RandomState(self.seed + i)
+            (H_camera_tag, pose_R, pose_t) = sample_pose(random, condition["distance_m"], condition["tilt_deg"], self.max_off_axis_deg)
+            image = fisheye_tag_detection.render_tag(self.calib["K1"], self.calib["D1"], self.raw_size, H_camera_tag,
+                                                     texture, ppm, 1.0, background = 128, rays = self.rays)
+            samples.append((degrade(random, image, condition), pose_R, pose_t))
+        return samples
+
+    # Metrics of each path and configuration on the samples, {(path, config index): metrics}
+    def measure(self, scene, samples):
+        bundle = self.scenes[scene]
+        results = {}
+        for (config_index, config) in enumerate(self.configs):
+            tag_detector_tuning.apply_config(self.detector, config)
+            for (name, path) in self.paths.items():
+                if name == "remap pose" and len(bundle.layout) != 1:
+                    continue
+                # The first detection allocates the worker pool and buffers
+                path(samples[0][0], bundle)
+                latencies = []
+                errors = []
+                for (image, pose_R, pose_t) in samples:
+                    start = time.perf_counter()
+                    pad = path(image, bundle)
+                    latencies.append(time.perf_counter() - start)
+                    if pad is None:
+                        continue
+                    position = np.asarray(pad.pose_t).ravel()
+                    (x_angle, y_angle, distance) = landing_target.target_angles(position)
+                    (x_true, y_true, distance_true) = landing_target.target_angles(pose_t)
+                    errors.append((np.linalg.norm(position - pose_t), rotation_error_deg(pad.pose_R, pose_R),
+                                   x_angle - x_true, y_angle - y_true))
+                results[(name, config_index)] = self.metrics(latencies, errors)
+        return results
+
+    def metrics(self, latencies, errors):
+        result = {"samples": len(latencies), "detected": len(errors), "recall": len(errors) / len(latencies),
+                  "latency_mean_ms": float(np.mean(latencies)) * 1e3, "latency_p95_ms": float(np.percentile(latencies, 95)) * 1e3}
+        if not errors:
+            result.update(dict.fromkeys(("position_error_mean_mm", "position_error_p95_mm", "rotation_error_mean_deg",
+                                         "angle_error_mean_mrad", "x_angle_bias_mrad", "y_angle_bias_mrad")))
+            return result
+        errors = np.array(errors)
+        result.update({"position_error_mean_mm": float(np.mean(errors[:, 0])) * 1e3,
+                       "position_error_p95_mm": float(np.percentile(errors[:, 0], 95)) * 1e3,
+                       "rotation_error_mean_deg": float(np.mean(errors[:, 1])),
+                       "angle_error_mean_mrad": float(np.mean(np.hypot(errors[:, 2], errors[:, 3]))) * 1e3,
+                       "x_angle_bias_mrad": float(np.mean(errors[:, 2])) * 1e3,
+                       "y_angle_bias_mrad": float(np.mean(errors[:, 3])) * 1e3})
+        return result
+
+    # One row per scene, sweep value, path and configuration. Conditions shared by several sweeps (the nominal
+    # one) are measured once
+    def run(self, sweeps, verbose=True):
+        rows = []
+        measured = {}
+        for scene in self.scenes:
+            for (factor, values) in sweeps.items():
+                for value in values:
+                    condition = dict(nominal)
+                    condition[factor] = value
+                    key = (scene,) + tuple(sorted(condition.items()))
+                    if key not in measured:
+                        measured[key] = self.measure(scene, self.render(scene, condition))
+                    for ((name, config_index), result) in measured[key].items():
+                        row = {"scene": scene, "factor": factor, "value": value, "path": name}
+                        row.update(self.configs[config_index])
+                        row.update(condition)
+                        row.update(result)
+                        rows.append(row)
+                        if verbose:
+                            print_row(row)
+        return rows
+
+columns = ["scene", "factor", "value", "path", "quad_decimate", "nthreads", "refine_edges",
+           "distance_m", "tilt_deg", "blur_px", "noise", "lighting",
+           "samples", "detected", "recall", "latency_mean_ms", "latency_p95_ms",
+           "position_error_mean_mm", "position_error_p95_mm", "rotation_error_mean_deg",
+           "angle_error_mean_mrad", "x_angle_bias_mrad", "y_angle_bias_mrad"]
+
+def print_header():
+    print("%-5s %-10s %-12s %-10s %4s %3s %6s %8s %8s %8s %8s %8s %8s" % ("scene", "factor", "value", "path", "dec", "ref",
+          "recall", "mean ms", "p95 ms", "pos mm", "rot deg", "ang mrad", "bias x/y"))
+
+def print_row(row):
+    def value(v, fmt):
+        return "-" if v is None else fmt % v
+    print("%-5s %-10s %-12s %-10s %4.1f %3d %6.2f %8.2f %8.2f %8s %8s %8s %8s" % (
+          row["scene"], row["factor"], row["value"], row["path"], row["quad_decimate"], row["refine_edges"], row["recall"],
+          row["latency_mean_ms"], row["latency_p95_ms"], value(row["position_error_mean_mm"], "%.1f"),
+          value(row["rotation_error_mean_deg"], "%.2f"), value(row["angle_error_mean_mrad"], "%.2f"),
+          "-" if row["x_angle_bias_mrad"] is None else "%.1f/%.1f" % (row["x_angle_bias_mrad"], row["y_angle_bias_mrad"])))
+
+def write_csv(path, rows):
+    import csv
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames = columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def write_json(path, meta, rows):
+    with open(path, 'w') as f:
+        json.dump({"meta": meta, "results": rows}, f, indent=1)
+
+if __name__ == "__main__":
+    import apriltags3
+
+    parser = argparse.ArgumentParser(description='Benchmarks AprilTag detection on rendered fisheye images with known poses')
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml")
+    parser.add_argument('--apriltag_lib', type=str, default='apriltags',
+                        help="Directory of the AprilTag 3 library")
+    parser.add_argument('--tag_size', type=float, default=0.144,
+                        help="Size of the tag of the single tag scene in meters")
+    parser.add_argument('--scenes', type=str, nargs='+', default=['tag', 'pad'], choices=['tag', 'pad'],
+                        help="Single tag, and landing pad of several tags solved as one (see default_pad_layout)")
+    parser.add_argument('--sweeps', type=str, nargs='+', default=list(sweeps), choices=list(sweeps),
+                        help="Factors to vary around the nominal condition")
+    parser.add_argument('--paths', type=str, nargs='+', default=['remap', 'remap pose', 'raw', 'raw crop'],
+                        choices=['remap', 'remap pose', 'raw', 'raw crop'],
+                        help="Detection paths, see fisheye_tag_detection. remap pose: pose estimated by the detector, single tag only")
+    parser.add_argument('--quad_decimate', type=float, nargs='+', default=[1.0, 1.5, 2.0, 3.0],
+                        help="Detector configurations: quad_decimate values, each with and without refine_edges")
+    parser.add_argument('--nthreads', type=int, default=1,
+                        help="Detector threads")
+    parser.add_argument('--samples', type=int, default=10,
+                        help="Rendered images per condition")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the random poses, noise and blur directions")
+    parser.add_argument('--max_off_axis_deg', type=float, default=25,
+                        help="Largest angle between the optical axis and the direction of the tag")
+    parser.add_argument('--csv', type=str,
+                        help="Write the results to this CSV file")
+    parser.add_argument('--json', type=str,
+                        help="Write the results, with the conditions and the computer they were measured on, to this JSON file")
+    args = parser.parse_args()
+
+    calib = fisheye_rectify.load_calibration(args.calib)
+    geometry = fisheye_rectify.RectifyGeometry(300, 90)
+    layouts = {"tag": {0: (args.tag_size, (0.0, 0.0))}, "pad": default_pad_layout}
+    scenes = {name: tag_bundle.TagBundle(layouts[name]) for name in args.scenes}
+    configs = [{"quad_decimate": quad_decimate, "nthreads": args.nthreads, "refine_edges": refine_edges}
+               for quad_decimate in args.quad_decimate for refine_edges in (1, 0)]
+
+    detector = apriltags3.Detector(searchpath=[args.apriltag_lib, args.apriltag_lib + '/lib', args.apriltag_lib + '/lib64'],
+                                   families='tag36h11', nthreads=args.nthreads, quad_decimate=1.0, quad_sigma=0.0,
+                                   refine_edges=1, decode_sharpening=0.25, debug=0)
+    benchmark = Benchmark(detector, calib, geometry, scenes, configs, args.paths, args.samples, args.seed, args.max_off_axis_deg)
+
+    print("INFO: Host", tag_detector_tuning.host_fingerprint())
+    print("INFO: %d samples per condition, nominal condition %s" % (args.samples, nominal))
+    print_header()
+    start = time.time()
+    rows = benchmark.run({factor: sweeps[factor] for factor in args.sweeps})
+    print("INFO: Benchmark took %.0f s" % (time.time() - start))
+
+    if args.csv:
+        write_csv(args.csv, rows)
+    if args.json:
+        meta = {"time": time.time(), "host": tag_detector_tuning.host_fingerprint(), "opencv": cv2.__version__,
+                "numpy": np.__version__, "calib": args.calib, "raw_size": list(calib["input"]),
+                "rectified": {"size": list(geometry.size()), "camera_params": list(geometry.camera_params())},
+                "layouts": {name: {str(tag_id): [size, list(position)] for (tag_id, (size, position)) in layouts[name].items()}
+                            for name in args.scenes},
+                "nominal": nominal, "lightings": lightings, "samples": args.samples, "seed": args.seed,
+                "max_off_axis_deg": args.max_off_axis_deg}
+        write_json(args.json, meta, rows)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Landing pads made of several AprilTags        ##
+#####################################################
+# A single tag large enough to be seen from altitude leaves the field of view in the last meters. A pad
+# made of several tags of different sizes (e.g. small tags next to or nested in the large one) stays
+# visible all the way down. The corners of all the tags of the pad that are found go into one PnP solve
+# for the pose of the pad, instead of one pose estimate per tag.
+#
+# Layout: {tag_id: (size, (x, y))}, the size of the black square in meters and the position of the center
+# of the tag on the pad in meters, in the frame of the AprilTag pose: x right and y down when looking at
+# the printed pad, z into it. All tags must be printed upright. The landing target is the origin of the pad.
+
+import numpy as np
+import cv2
+
+import fisheye_tag_detection
+
+class BundleDetection(object):
+    def __init__(self, tag_ids, corners, pose_R, pose_t, pose_err, largest_corners, largest_size):
+        self.tag_ids = tag_ids                  # tags of the pad the pose was solved from
+        self.corners = corners                  # their corners, (4 * len(tag_ids), 2), detector coordinates
+        self.pose_R = pose_R                    # pose of the pad in the camera frame
+        self.pose_t = pose_t
+        self.pose_err = pose_err                # mean reprojection error in pixels
+        self.largest_corners = largest_corners  # corners of the largest tag found, and its size
+        self.largest_size = largest_size
+
+class TagBundle(object):
+    def __init__(self, layout):
+        self.layout = layout
+        self.object_points = {}
+        for (tag_id, (size, (x, y))) in layout.items():
+            self.object_points[tag_id] = fisheye_tag_detection.tag_object_points(size) + (x, y, 0)
+
+        self.solve_count = 0
+        self.tag_count = 0
+
+    # Pose of the pad from the tags detected in an undistorted image with the given [fx, fy, cx, cy], corners
+    # in the coordinates of the detector. Returns a BundleDetection, None if no tag of the pad was found
+    def solve(self, tags, camera_params):
+        tags = [tag for tag in tags if tag.tag_id in self.object_points]
+        if not tags:
+            return None
+
+        object_points = np.concatenate([self.object_points[tag.tag_id] for tag in tags])
+        image_points = np.concatenate([tag.corners for tag in tags]).astype(np.float64)
+        opencv_points = fisheye_tag_detection.opencv_points(image_points)
+        K = fisheye_tag_detection.camera_params_matrix(camera_params)
+        # All points are in the plane of the pad, IPPE is exact for them and needs no initial guess
+        (ok, rvec, tvec) = cv2.solvePnP(object_points, opencv_points.reshape(-1, 1, 2), K, None, flags = cv2.SOLVEPNP_IPPE)
+        if not ok:
+            return None
+        projected = cv2.projectPoints(object_points, rvec, tvec, K, None)[0].reshape(-1, 2)
+        error = np.mean(np.linalg.norm(projected - opencv_points, axis=1))
+
+        largest = max(tags, key=lambda tag: self.layout[tag.tag_id][0])
+        self.solve_count += 1
+        self.tag_count += len(tags)
+        return BundleDetection([tag.tag_id for tag in tags], image_points, cv2.Rodrigues(rvec)[0], tvec, error,
+                               largest.corners, self.layout[largest.tag_id][0])
+
+    def report(self):
+        mean = self.tag_count / self.solve_count if self.solve_count > 0 else 0.0
+        return "INFO: Landing pad: %d tags in the layout, %d poses solved, %.1f tags per pose" % (len(self.layout), self.solve_count, mean)
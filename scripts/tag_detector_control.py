@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Adaptive AprilTag detector settings           ##
+#####################################################
+# The cost of the detector is dominated by the quad detection, which runs on the image decimated by
+# quad_decimate. High above the pad the tag is only a few pixels wide and needs full resolution, while
+# close to the ground it fills the image and could be found on an image decimated several times.
+# Decoding always samples the full resolution image, so decimation does not cost accuracy of the corners
+# as long as the decimated tag is still large enough to be found.
+#
+# The controller picks the settings for the next frame from the pixel size of the landing tag in the last
+# frame. The settings are written into the C detector in place, the detector is never rebuilt (the library
+# recreates its worker pool by itself when nthreads changes).
+
+# Change settings of an apriltags3.Detector in place
+def set_detector_params(detector, quad_decimate=None, quad_sigma=None, nthreads=None, refine_edges=None):
+    settings = detector.tag_detector_ptr.contents
+    if refine_edges is not None:
+        settings.refine_edges = int(refine_edges)
+        detector.params['refine_edges'] = refine_edges
+    if quad_decimate is not None:
+        settings.quad_decimate = float(quad_decimate)
+        detector.params['quad_decimate'] = quad_decimate
+    if quad_sigma is not None:
+        settings.quad_sigma = float(quad_sigma)
+        detector.params['quad_sigma'] = quad_sigma
+    if nthreads is not None:
+        settings.nthreads = int(nthreads)
+        detector.params['nthreads'] = nthreads
+
+class AdaptiveDetectorControl(object):
+    # levels: (min_tag_px, quad_decimate, quad_sigma, nthreads), by increasing min_tag_px. The first level
+    # is used until the tag is found, and again as soon as it is lost.
+    # switch_frames: number of consecutive frames a smaller decimation is asked for before switching to it
+    def __init__(self, detector, levels, switch_frames=3):
+        self.detector = detector
+        self.levels = levels
+        self.switch_frames = switch_frames
+        self.level = None
+        self.candidate = None
+        self.candidate_count = 0
+        self.switch_count = 0
+        self.frame_count = dict.fromkeys(range(len(levels)), 0)
+        self.frame_time = dict.fromkeys(range(len(levels)), 0.0)
+        self.apply(0, "start")
+
+    # Replace the table, e.g. with one derived from the tuned configuration, and restart from its first level
+    def set_levels(self, levels):
+        self.levels = levels
+        self.level = None
+        self.candidate = None
+        self.frame_count = dict.fromkeys(range(len(levels)), 0)
+        self.frame_time = dict.fromkeys(range(len(levels)), 0.0)
+        self.apply(0, "new levels")
+
+    def apply(self, level, reason):
+        if level == self.level:
+            return
+        (min_tag_px, quad_decimate, quad_sigma, nthreads) = self.levels[level]
+        set_detector_params(self.detector, quad_decimate, quad_sigma, nthreads)
+        if self.level is not None:
+            self.switch_count += 1
+            print("INFO: Detector settings: quad_decimate %.1f, quad_sigma %.1f, nthreads %d (%s)" % (quad_decimate, quad_sigma, nthreads, reason))
+        self.level = level
+
+    # Size of the tag in pixels, the smaller of what is seen (the longest side) and what is expected from the
+    # distance, so a tag seen at an angle is not decimated too much
+    @staticmethod
+    def tag_size_px(corners, distance, focal_px, tag_size):
+        sides = [((corners[i][0] - corners[i - 1][0]) ** 2 + (corners[i][1] - corners[i - 1][1]) ** 2) ** 0.5 for i in range(len(corners))]
+        size_px = max(sides)
+        if distance is not None and distance > 0:
+            size_px = min(size_px, focal_px * tag_size / distance)
+        return size_px
+
+    # Result of a frame detected with the current settings. tag_px: pixel size of the landing tag, None if not found
+    def update(self, tag_px, detection_time):
+        self.frame_count[self.level] += 1
+        self.frame_time[self.level] += detection_time
+
+        if tag_px is None:
+            self.candidate = None
+            self.apply(0, "tag lost")
+            return
+
+        level = 0
+        for (i, (min_tag_px, quad_decimate, quad_sigma, nthreads)) in enumerate(self.levels):
+            if tag_px >= min_tag_px:
+                level = i
+
+        if level < self.level:
+            # The tag got smaller, switch right away so it is not lost
+            self.candidate = None
+            self.apply(level, "tag %.0f px" % tag_px)
+        elif level > self.level:
+            if level != self.candidate:
+                self.candidate = level
+                self.candidate_count = 0
+            self.candidate_count += 1
+            if self.candidate_count >= self.switch_frames:
+                self.candidate = None
+                self.apply(level, "tag %.0f px" % tag_px)
+        else:
+            self.candidate = None
+
+    def report(self):
+        lines = ["INFO: Detector settings switched %d times" % self.switch_count]
+        for (i, (min_tag_px, quad_decimate, quad_sigma, nthreads)) in enumerate(self.levels):
+            count = self.frame_count[i]
+            mean = self.frame_time[i] / count if count > 0 else 0.0
+            lines.append("INFO:     tag >= %3d px: quad_decimate %.1f, quad_sigma %.1f, nthreads %d: %d frames, mean %.1f ms" %
+                         (min_tag_px, quad_decimate, quad_sigma, nthreads, count, mean * 1e3))
+        return "\n".join(lines)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   AprilTag detection in worker processes        ##
+#####################################################
+# The detector releases the GIL while it runs, but the Python side of detect() (image conversion, building
+# the Detection objects, pose estimation wrappers) does not, and a single detector with nthreads=1 only
+# uses one core. The pool runs one detector per worker process instead. Frames are copied into slots of a
+# shared memory block, so only the slot index and a few parameters go through the task queue, and are
+# given to the least loaded worker (round-robin between equally loaded ones). Results are released in
+# the order the frames were submitted, so the landing target never goes back in time.
+#
+# Workers are forked, create the pool before starting threads or connecting to devices.
+#
+# Throughput at 1, 2 and 4 workers and the latency the pool adds, on recorded rectified frames or on tags
+# rendered with the calibration of cfg/t265.yaml:
+#   python3 tag_detector_pool.py --workers 1 2 4 --apriltag_lib /path/to/apriltags
+
+import time
+import queue
+import signal
+import argparse
+import collections
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import pipeline_utils
+
+def worker_main(worker_index, searchpath, detector_params, shm_name, frames_shape, tasks, results):
+    import apriltags3
+    import tag_detector_control
+
+    # Ctrl-C is for the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    detector = apriltags3.Detector(searchpath=searchpath, **detector_params)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(frames_shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            if task[0] == "configure":
+                tag_detector_control.set_detector_params(detector, **task[1])
+                continue
+            (_, slot, frame_number, (height, width), camera_params, tag_size) = task
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            tags = detector.detect(frames[slot, :height, :width], camera_params is not None, camera_params, tag_size)
+            results.put((worker_index, slot, frame_number, tags, time.perf_counter() - start, time.process_time() - cpu_start))
+    finally:
+        del frames
+        shm.close()
+
+class DetectorPool(object):
+    # frame_size: (width, height) of the largest frame submitted. detector_params: arguments of apriltags3.Detector
+    # slots_per_worker: frames queued per worker, including the one being detected
+    def __init__(self, num_workers, frame_size, searchpath, detector_params, slots_per_worker=2):
+        self.num_workers = num_workers
+        (width, height) = frame_size
+        frames_shape = (num_workers * slots_per_worker, height, width)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(frames_shape)))
+        self.frames = np.ndarray(frames_shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        context = pipeline_utils.fork_context()
+        self.results = context.Queue()
+        self.tasks = [context.Queue() for i in range(num_workers)]
+        self.free_slots = [list(range(i * slots_per_worker, (i + 1) * slots_per_worker)) for i in range(num_workers)]
+        self.in_flight = [0] * num_workers
+        self.next_worker = 0
+        self.workers = []
+        for i in range(num_workers):
+            worker = context.Process(target=worker_main, name="tag_detector_%d" % i,
+                                     args=(i, searchpath, detector_params, self.shm.name, frames_shape, self.tasks[i], self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.submitted = collections.deque()    # (frame_number, submit time, context), in submission order
+        self.done = {}                          # frame_number: (tags, detection time, cpu time), not released yet
+
+        self.submit_count = 0
+        self.drop_count = 0
+        self.release_count = 0
+        self.reorder_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.detection_time_sum = 0.0
+        self.cpu_time_sum = 0.0
+        self.worker_count = [0] * num_workers
+
+    # Same settings for all workers, see tag_detector_control.set_detector_params
+    def configure(self, **params):
+        for tasks in self.tasks:
+            tasks.put(("configure", params))
+
+    # Returns False, and drops the frame, when all workers are busy. camera_params: None to skip the pose
+    # estimates of the tags. context: given back with the result
+    def submit(self, frame_number, image, camera_params, tag_size, context=None):
+        candidates = [i for i in range(self.num_workers) if self.free_slots[i]]
+        if not candidates:
+            self.drop_count += 1
+            return False
+        worker = min(candidates, key=lambda i: (self.in_flight[i], (i - self.next_worker) % self.num_workers))
+        self.next_worker = (worker + 1) % self.num_workers
+
+        slot = self.free_slots[worker].pop()
+        (height, width) = image.shape[:2]
+        self.frames[slot, :height, :width] = image
+        self.in_flight[worker] += 1
+        self.submitted.append((frame_number, time.perf_counter(), context))
+        self.tasks[worker].put(("detect", slot, frame_number, (height, width), camera_params, tag_size))
+        self.submit_count += 1
+        return True
+
+    # Results in submission order, as (frame_number, tags, context, detection time, worker cpu time).
+    # timeout: how long to wait for the next result in order, 0 to only take what has arrived
+    def collect(self, timeout=0):
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                wait = deadline - time.perf_counter()
+                result = self.results.get(timeout=wait) if wait > 0 else self.results.get_nowait()
+            except queue.Empty:
+                break
+            (worker, slot, frame_number, tags, detection_time, cpu_time) = result
+            self.free_slots[worker].append(slot)
+            self.in_flight[worker] -= 1
+            self.worker_count[worker] += 1
+            if self.submitted and self.submitted[0][0] != frame_number:
+                self.reorder_count += 1
+            self.done[frame_number] = (tags, detection_time, cpu_time)
+            # The next result in order is there, take what else has arrived without waiting
+            if self.submitted and self.submitted[0][0] in self.done:
+                deadline = 0
+
+        released = []
+        now = time.perf_counter()
+        while self.submitted and self.submitted[0][0] in self.done:
+            (frame_number, submit_time, context) = self.submitted.popleft()
+            (tags, detection_time, cpu_time) = self.done.pop(frame_number)
+            latency = now - submit_time
+            self.release_count += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.detection_time_sum += detection_time
+            self.cpu_time_sum += cpu_time
+            released.append((frame_number, tags, context, detection_time, cpu_time))
+        return released
+
+    def pending(self):
+        return len(self.submitted)
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+    def report(self):
+        count = max(1, self.release_count)
+        return ("INFO: Detector pool: %d workers, submitted %d, dropped %d, out of order %d, per worker %s, "
+                "latency mean %.1f ms max %.1f ms, detection mean %.1f ms, worker CPU %.2f s" %
+                (self.num_workers, self.submit_count, self.drop_count, self.reorder_count, self.worker_count,
+                 self.latency_sum / count * 1e3, self.latency_max * 1e3, self.detection_time_sum / count * 1e3, self.cpu_time_sum))
+
+#######################################
+# Throughput and latency benchmark
+#######################################
+
+# Frames per second with all workers busy
+def measure_throughput(pool, frames, camera_params, tag_size, num_frames):
+    submitted = 0
+    released = 0
+    start = time.perf_counter()
+    while released < num_frames:
+        while submitted < num_frames and pool.submit(submitted, frames[submitted % len(frames)], camera_params, tag_size):
+            submitted += 1
+        released += len(pool.collect(timeout=1))
+    return num_frames / (time.perf_counter() - start)
+
+# Latency from submission to release of frames submitted at the given rate
+def measure_latency(pool, frames, camera_params, tag_size, num_frames, rate_hz):
+    latencies = []
+    submit_times = {}
+    start = time.perf_counter()
+    frame_number = 0
+    while len(latencies) < num_frames:
+        now = time.perf_counter()
+        if frame_number < num_frames and now >= start + frame_number / rate_hz:
+            if pool.submit(frame_number, frames[frame_number % len(frames)], camera_params, tag_size):
+                submit_times[frame_number] = now
+            else:
+                num_frames -= 1
+            frame_number += 1
+        for result in pool.collect(timeout=0.001):
+            latencies.append(time.perf_counter() - submit_times.pop(result[0]))
+    return latencies
+
+if __name__ == "__main__":
+    import glob
+    import cv2
+    import apriltags3
+    import fisheye_rectify
+    import tag_detector_tuning
+
+    parser = argparse.ArgumentParser(description='Measures AprilTag detection throughput and latency with a pool of worker processes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help="Numbers of workers to measure")
+    parser.add_argument('--images', type=str,
+                        help="Glob of recorded rectified grayscale frames. If not specified, tags are rendered with --calib")
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml, for rendered frames")
+    parser.add_argument('--apriltag_lib', type=str, default='apriltags',
+                        help="Directory of the AprilTag 3 library")
+    parser.add_argument('--tag_size', type=float, default=0.144,
+                        help="Size of the tag in meters")
+    parser.add_argument('--frames', type=int, default=300,
+                        help="Number of detections per measurement")
+    parser.add_argument('--rate', type=float, default=30,
+                        help="Frame rate in Hz for the latency measurement")
+    args = parser.parse_args()
+
+    geometry = fisheye_rectify.RectifyGeometry(300, 90)
+    if args.images:
+        frames = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in sorted(glob.glob(args.images))]
+    else:
+        frames = tag_detector_tuning.synthetic_frames(fisheye_rectify.load_calibration(args.calib), geometry, args.tag_size)
+    if not frames:
+        raise SystemExit("No frames")
+    camera_params = geometry.camera_params()
+    searchpath = [args.apriltag_lib, args.apriltag_lib + '/lib', args.apriltag_lib + '/lib64']
+    detector_params = dict(families='tag36h11', nthreads=1, quad_decimate=1.0, quad_sigma=0.0,
+                           refine_edges=1, decode_sharpening=0.25, debug=0)
+
+    # Reference: detection in this process
+    detector = apriltags3.Detector(searchpath=searchpath, **detector_params)
+    start = time.perf_counter()
+    for i in range(args.frames):
+        detector.detect(frames[i % len(frames)], True, camera_params, args.tag_size)
+    in_process_ms = (time.perf_counter() - start) / args.frames * 1e3
+    print("INFO: In process: %.1f frames/s, %.2f ms per frame" % (1e3 / in_process_ms, in_process_ms))
+
+    print("%-8s %12s %10s %16s %16s" % ("workers", "frames/s", "scaling", "latency mean ms", "latency p95 ms"))
+    single = None
+    for num_workers in args.workers:
+        pool = DetectorPool(num_workers, (frames[0].shape[1], frames[0].shape[0]), searchpath, detector_params)
+        try:
+            # Let the workers start and load the library
+            measure_throughput(pool, frames, camera_params, args.tag_size, 2 * num_workers)
+            throughput = measure_throughput(pool, frames, camera_params, args.tag_size, args.frames)
+            latencies = measure_latency(pool, frames, camera_params, args.tag_size, args.frames, args.rate)
+        finally:
+            pool.close()
+        if single is None:
+            single = throughput / num_workers
+        print("%-8d %12.1f %10.2f %16.2f %16.2f" % (num_workers, throughput, throughput / single,
+                                                    np.mean(latencies) * 1e3, np.percentile(latencies, 95) * 1e3))
+    print("INFO: The latency added by the pool is its latency at the given rate minus the in process time per frame")
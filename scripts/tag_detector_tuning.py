@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Startup auto-tuner for the AprilTag detector  ##
+#####################################################
+# Which combination of quad_decimate, nthreads and refine_edges the companion computer can afford depends
+# on its CPU. The tuner times the detector on a set of rectified frames for a grid of configurations and
+# picks the most accurate one whose per-frame time (95th percentile) fits in the deadline.
+#
+# Accuracy is measured against the most accurate configuration (full resolution, refined edges) on the same
+# frames: the share of its tags that are found (recall), then the mean distance of their corners. Only frames
+# where it finds the tags of interest count: on frames without tags every configuration is equally accurate,
+# and the fastest one would win.
+#
+# The result is stored per host, with the CPU it was measured on, and reused on the next start as long as
+# the hardware, the deadline and the image size are the same.
+#
+# Headless benchmark, on recorded rectified frames or on tags rendered with the calibration of cfg/t265.yaml:
+#   python3 tag_detector_tuning.py --deadline_ms 20 --images 'frames/*.png'
+
+import os
+import json
+import time
+import socket
+import platform
+import argparse
+
+import numpy as np
+
+import tag_detector_control
+
+# Identifies the hardware the timings were measured on
+def host_fingerprint():
+    cpu_model = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                (key, _, value) = line.partition(':')
+                if key.strip() in ('model name', 'Model', 'Hardware'):
+                    cpu_model = value.strip()
+    except IOError:
+        pass
+    return "%s|%s|%s|%d cpus" % (socket.gethostname(), platform.machine(), cpu_model, os.cpu_count())
+
+def default_grid(max_threads=None):
+    if max_threads is None:
+        max_threads = os.cpu_count()
+    threads = sorted(set([1, 2, 4, max_threads]))
+    return [{"quad_decimate": quad_decimate, "nthreads": nthreads, "refine_edges": refine_edges}
+            for quad_decimate in (1.0, 1.5, 2.0, 3.0)
+            for nthreads in threads if nthreads <= max_threads
+            for refine_edges in (1, 0)]
+
+def apply_config(detector, config):
+    tag_detector_control.set_detector_params(detector, quad_decimate = config["quad_decimate"],
+                                             nthreads = config["nthreads"], refine_edges = config["refine_edges"])
+
+# Detection time of each frame, and the corners of the tags found in each frame {tag_id: corners}
+def time_config(detector, frames, camera_params, tag_size, config):
+    apply_config(detector, config)
+    # The first detection allocates the worker pool and buffers
+    detector.detect(frames[0], True, camera_params, tag_size)
+    times = []
+    detections = []
+    for frame in frames:
+        start = time.perf_counter()
+        tags = detector.detect(frame, True, camera_params, tag_size)
+        times.append(time.perf_counter() - start)
+        detections.append({tag.tag_id: tag.corners for tag in tags})
+    return (times, detections)
+
+def accuracy(detections, reference):
+    found = 0
+    total = 0
+    corner_errors = []
+    for (tags, reference_tags) in zip(detections, reference):
+        for (tag_id, corners) in reference_tags.items():
+            total += 1
+            if tag_id in tags:
+                found += 1
+                corner_errors.append(np.mean(np.linalg.norm(tags[tag_id] - corners, axis=1)))
+    recall = found / total if total > 0 else 1.0
+    corner_error = float(np.mean(corner_errors)) if corner_errors else 0.0
+    return (recall, corner_error)
+
+# Whether the detector, as configured, finds one of tag_ids (any tag if None) in frame
+def shows_tags(detector, frame, tag_ids=None):
+    return any(tag_ids is None or tag.tag_id in tag_ids for tag in detector.detect(frame, False))
+
+# Returns the chosen configuration and the results of all configurations. The configuration is None when the
+# reference configuration finds one of tag_ids (any tag if None) in fewer than min_frames of the frames
+def tune(detector, frames, camera_params, tag_size, deadline_sec, grid=None, percentile=95, verbose=True,
+         tag_ids=None, min_frames=1):
+    if grid is None:
+        grid = default_grid()
+    reference_config = max(grid, key=lambda c: (-c["quad_decimate"], c["refine_edges"], c["nthreads"]))
+    (times, reference) = time_config(detector, frames, camera_params, tag_size, reference_config)
+
+    # Only the frames with the tags, and only their tags
+    reference = [{tag_id: corners for (tag_id, corners) in tags.items() if tag_ids is None or tag_id in tag_ids}
+                 for tags in reference]
+    frames = [frame for (frame, tags) in zip(frames, reference) if tags]
+    reference = [tags for tags in reference if tags]
+    if len(frames) < min_frames:
+        print("WARNING: Tags found in %d frames, at least %d are needed to tune the detector" % (len(frames), min_frames))
+        return (None, [])
+
+    results = []
+    for config in grid:
+        (times, detections) = time_config(detector, frames, camera_params, tag_size, config)
+        (recall, corner_error) = accuracy(detections, reference)
+        result = dict(config)
+        result.update({"time_ms": float(np.percentile(times, percentile)) * 1e3, "mean_ms": float(np.mean(times)) * 1e3,
+                       "recall": recall, "corner_error_px": corner_error})
+        results.append(result)
+        if verbose:
+            print("INFO: quad_decimate %.1f nthreads %d refine_edges %d: p%d %.2f ms, mean %.2f ms, recall %.2f, corner error %.2f px" %
+                  (config["quad_decimate"], config["nthreads"], config["refine_edges"], percentile,
+                   result["time_ms"], result["mean_ms"], recall, corner_error))
+
+    feasible = [r for r in results if r["time_ms"] <= deadline_sec * 1e3]
+    if feasible:
+        # Most accurate first, then the fastest of the equally accurate ones
+        best = min(feasible, key=lambda r: (-round(r["recall"], 3), round(r["corner_error_px"], 2), r["time_ms"]))
+    else:
+        best = min(results, key=lambda r: r["time_ms"])
+        print("WARNING: No detector configuration fits in %.1f ms, using the fastest one" % (deadline_sec * 1e3))
+    config = {key: best[key] for key in ("quad_decimate", "nthreads", "refine_edges")}
+    return (config, results)
+
+# Tunes on frames of image_size and stores the result for this host in store. Returns the configuration,
+# None, and nothing is stored, when the tags are found in too few frames (see tune)
+def tune_and_store(store, detector, frames, image_size, camera_params, tag_size, deadline_sec, tag_ids=None, min_frames=1,
+                   verbose=True):
+    (config, results) = tune(detector, frames, camera_params, tag_size, deadline_sec, verbose = verbose,
+                             tag_ids = tag_ids, min_frames = min_frames)
+    if config is not None:
+        store.save(deadline_sec, image_size, config, results)
+    return config
+
+# Tuning results, one per host, in a JSON file
+class TuningStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            print("WARNING: Could not read detector tuning file", self.path, ":", e)
+            return {}
+
+    # Stored configuration for this host, if it was tuned for the same deadline and image size
+    def load(self, deadline_sec, image_size):
+        entry = self.read().get(host_fingerprint())
+        if entry is None or entry["deadline_ms"] != round(deadline_sec * 1e3, 3) or tuple(entry["image_size"]) != tuple(image_size):
+            return None
+        return entry["config"]
+
+    def save(self, deadline_sec, image_size, config, results):
+        entries = self.read()
+        entries[host_fingerprint()] = {"deadline_ms": round(deadline_sec * 1e3, 3), "image_size": list(image_size),
+                                       "config": config, "results": results, "time": time.time()}
+        # Write to a temporary file first, so a crash never leaves a half-written file behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+# Rectified frames of tags rendered at several distances and positions, when no recorded frames are given
+def synthetic_frames(calib, geometry, tag_size, num_frames=20):
+    import fisheye_rectify
+    import fisheye_tag_detection
+
+    maps = fisheye_rectify.build_maps(calib["K1"], calib["D1"], np.eye(3), geometry.projection_matrix(), geometry.size())
+    texture = fisheye_tag_detection.tag_texture(0)
+    texture_tag_px = texture.shape[1] * 8 // 10
+    random = np.random.RandomState(0)
+    frames = []
+    for i in range(num_frames):
+        distance = 0.3 + 2.7 * i / max(1, num_frames - 1)
+        H_camera_tag = np.eye(4)
+        H_camera_tag[:3, :3] = np.diag([1.0, -1.0, -1.0])
+        H_camera_tag[:3, 3] = [random.uniform(-0.3, 0.3) * distance, random.uniform(-0.3, 0.3) * distance, distance]
+        raw = fisheye_tag_detection.render_tag(calib["K1"], calib["D1"], calib["input"], H_camera_tag, texture, texture_tag_px, tag_size)
+        # Some sensor noise, a perfectly clean image flatters the decimation
+        raw = np.clip(raw + random.normal(0, 4, raw.shape), 0, 255).astype(np.uint8)
+        frames.append(fisheye_rectify.remap(raw, maps))
+    return frames
+
+if __name__ == "__main__":
+    import glob
+    import cv2
+    import apriltags3
+    import fisheye_rectify
+
+    parser = argparse.ArgumentParser(description='Tunes the AprilTag detector configuration for this computer')
+    parser.add_argument('--deadline_ms', type=float, default=20,
+                        help="Per-frame detection deadline in ms")
+    parser.add_argument('--images', type=str,
+                        help="Glob of recorded rectified grayscale frames. If not specified, tags are rendered with --calib")
+    parser.add_argument('--calib', type=str, default='../cfg/t265.yaml',
+                        help="Calibration file in the format of cfg/t265.yaml, for rendered frames")
+    parser.add_argument('--apriltag_lib', type=str, default='apriltags',
+                        help="Directory of the AprilTag 3 library")
+    parser.add_argument('--tag_size', type=float, default=0.144,
+                        help="Size of the tag in meters")
+    parser.add_argument('--tag_ids', type=int, nargs='+',
+                        help="Only tune on frames with one of these tags. If not specified, frames with any tag")
+    parser.add_argument('--store', type=str,
+                        help="Save the result to this tuning file, as t265_precland_apriltags.py does")
+    args = parser.parse_args()
+
+    geometry = fisheye_rectify.RectifyGeometry(300, 90)
+    if args.images:
+        frames = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in sorted(glob.glob(args.images))]
+    else:
+        frames = synthetic_frames(fisheye_rectify.load_calibration(args.calib), geometry, args.tag_size)
+    if not frames:
+        raise SystemExit("No frames")
+    image_size = (frames[0].shape[1], frames[0].shape[0])
+
+    detector = apriltags3.Detector(searchpath=[args.apriltag_lib, args.apriltag_lib + '/lib', args.apriltag_lib + '/lib64'],
+                                   families='tag36h11', nthreads=1, quad_decimate=1.0, quad_sigma=0.0,
+                                   refine_edges=1, decode_sharpening=0.25, debug=0)
+    print("INFO: Host", host_fingerprint())
+    print("INFO: Tuning on %d frames of %dx%d for a deadline of %.1f ms" % (len(frames), image_size[0], image_size[1], args.deadline_ms))
+    if args.store:
+        config = tune_and_store(TuningStore(args.store), detector, frames, image_size, geometry.camera_params(), args.tag_size,
+                                args.deadline_ms / 1e3, args.tag_ids)
+    else:
+        (config, results) = tune(detector, frames, geometry.camera_params(), args.tag_size, args.deadline_ms / 1e3,
+                                 tag_ids = args.tag_ids)
+    print("INFO: Chosen configuration:", config)
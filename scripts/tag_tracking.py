@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Region of interest tracking for AprilTags     ##
+#####################################################
+# Once the landing tag has been found, it only moves a little between two frames. Instead of rectifying and
+# searching the whole image, the tracker predicts where the corners of the tag will be in the next frame,
+# from their previous position, the distance of the tag and the motion of the camera measured by the T265,
+# and detection runs in a padded region around them only.
+#
+# A full-frame search is done when there is no prediction (tag not seen in the previous frame) and every
+# full_search_interval frames, so other tags and a wrong prediction are never missed for long.
+
+import numpy as np
+
+class RoiTracker(object):
+    # image_size: (width, height) of the rectified image, camera_params: [fx, fy, cx, cy] of that image
+    def __init__(self, image_size, camera_params, padding_ratio=0.5, min_padding_px=16, min_roi_px=48, full_search_interval=30):
+        self.image_size = image_size
+        self.camera_params = camera_params
+        self.padding_ratio = padding_ratio
+        self.min_padding_px = min_padding_px
+        self.min_roi_px = min_roi_px
+        self.full_search_interval = full_search_interval
+
+        self.corners = None             # of the tracked tag in the last frame, rectified image coordinates
+        self.depth = None               # distance along the optical axis of the tracked tag in the last frame
+        self.H_ref_camera = None        # camera pose in the last frame
+        self.frames_since_full_search = 0
+
+        self.roi_frames = 0
+        self.roi_hits = 0
+        self.roi_time = 0.0
+        self.full_frames = 0
+        self.full_time = 0.0
+
+    # Region (x0, y0, x1, y1) to search in the frame taken at camera pose H_ref_camera, or None for the whole image.
+    # allow_full_search: False to keep searching the region while there is a prediction, even when a full search is due
+    def roi_for_frame(self, H_ref_camera, allow_full_search=True):
+        if self.corners is None or H_ref_camera is None or self.H_ref_camera is None:
+            return None
+        if allow_full_search and self.frames_since_full_search >= self.full_search_interval:
+            return None
+
+        corners = self.predict_corners(np.linalg.inv(H_ref_camera).dot(self.H_ref_camera))
+        if corners is None:
+            return None
+
+        (x_min, y_min) = corners.min(axis=0)
+        (x_max, y_max) = corners.max(axis=0)
+        padding = max(self.min_padding_px, self.padding_ratio * max(x_max - x_min, y_max - y_min))
+        (width, height) = self.image_size
+        x0 = int(max(0, x_min - padding))
+        y0 = int(max(0, y_min - padding))
+        x1 = int(min(width, x_max + padding + 1))
+        y1 = int(min(height, y_max + padding + 1))
+        if x1 - x0 < self.min_roi_px or y1 - y0 < self.min_roi_px:
+            return None
+        if (x1 - x0) * (y1 - y0) >= width * height:
+            return None
+        return (x0, y0, x1, y1)
+
+    # Move the corners of the last frame by the camera motion H_new_old, assuming they are all at the tag's depth
+    def predict_corners(self, H_new_old):
+        (fx, fy, cx, cy) = self.camera_params
+        points = np.column_stack(((self.corners[:, 0] - cx) / fx * self.depth,
+                                  (self.corners[:, 1] - cy) / fy * self.depth,
+                                  np.full(len(self.corners), self.depth)))
+        points = points.dot(H_new_old[:3, :3].T) + H_new_old[:3, 3]
+        if np.any(points[:, 2] <= 0):
+            return None
+        return np.column_stack((fx * points[:, 0] / points[:, 2] + cx,
+                                fy * points[:, 1] / points[:, 2] + cy))
+
+    # Result of the detection in a frame. roi: as returned by roi_for_frame, corners: of the tracked tag
+    # in rectified image coordinates or None if not detected, detection_time: rectification and detection
+    def update(self, roi, H_ref_camera, corners, depth, detection_time):
+        if roi is None:
+            self.full_frames += 1
+            self.full_time += detection_time
+            self.frames_since_full_search = 0
+        else:
+            self.roi_frames += 1
+            self.roi_time += detection_time
+            self.frames_since_full_search += 1
+            if corners is not None:
+                self.roi_hits += 1
+
+        if corners is None or depth is None or depth <= 0:
+            self.corners = None
+        else:
+            self.corners = np.asarray(corners, dtype=float)
+            self.depth = depth
+            self.H_ref_camera = H_ref_camera
+
+    def report(self):
+        hit_rate = 100.0 * self.roi_hits / self.roi_frames if self.roi_frames > 0 else 0.0
+        full_mean = self.full_time / self.full_frames if self.full_frames > 0 else 0.0
+        roi_mean = self.roi_time / self.roi_frames if self.roi_frames > 0 else 0.0
+        saved = (full_mean - roi_mean) * self.roi_frames if self.full_frames > 0 else 0.0
+        return ("INFO: Tag tracking: %d ROI frames, hit rate %.1f%%, %d full frames, mean %.1f ms ROI vs %.1f ms full, %.2f s saved" %
+                (self.roi_frames, hit_rate, self.full_frames, roi_mean * 1e3, full_mean * 1e3, saved))
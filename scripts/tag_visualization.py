@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Tag visualization in a separate process       ##
+#####################################################
+# Drawing and cv2.imshow / cv2.waitKey take as long as the X server or the VNC session wants, which must
+# never delay the landing target. The image stage only copies the raw fisheye frame (or a downsampled crop
+# of it, see fisheye_frontend.py), the detected corners and the search region into a shared memory slot and
+# returns. A viewer process rectifies, draws and shows (or writes) the most recent content of the slot, at
+# its own pace.
+#
+# The slot holds one frame. If the viewer is reading it when the next frame comes, that frame is dropped
+# instead of waiting for the viewer, so the image stage does the same work whether a viewer is slow or not.
+#
+# Headless: with an MJPEG file, the annotated frames are written at mjpeg_hz instead of being shown.
+#
+# Workers are forked, create the viewer before starting threads or connecting to devices.
+
+import time
+import queue
+import signal
+
+import numpy as np
+import cv2
+
+import fisheye_rectify
+import pipeline_utils
+
+max_tags = 32
+meta_size = 5 + 9 * max_tags       # frame number, tag count, region (x0, y0, x1, y1), tags (id, 4 corners)
+
+# Search region and tags, with their id in the middle, on a BGR image. corners in rectified image coordinates
+def draw_tags(image, tags, roi=None):
+    # Region the tags were searched in
+    if roi is not None:
+        cv2.rectangle(image, roi[:2], (roi[2] - 1, roi[3] - 1), color = (128, 128, 128), thickness = 1)
+
+    for (tag_id, corners) in tags:
+        # Setup bounding box
+        for idx in range(len(corners)):
+            cv2.line(image,
+                    tuple(corners[idx-1, :].astype(int)),
+                    tuple(corners[idx, :].astype(int)),
+                    thickness = 2,
+                    color = (255, 0, 0))
+
+        # The text to be put in the image, here we simply put the id of the detected tag
+        text = str(tag_id)
+        textsize = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1, 2)[0]
+        cv2.putText(image,
+                    text,
+                    org = (int((corners[0, 0] + corners[2, 0] - textsize[0]) / 2),
+                           int((corners[0, 1] + corners[2, 1] + textsize[1]) / 2)),
+                    fontFace = cv2.FONT_HERSHEY_SIMPLEX,
+                    fontScale = 0.5,
+                    thickness = 2,
+                    color = (255, 0, 0))
+    return image
+
+def viewer_main(control, lock, new_frame, quit, window_title, mjpeg_path, mjpeg_hz):
+    # Ctrl-C is for the main process, which stops the viewer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Slot and rectification maps, once the main process knows the camera
+    setup = control.get()
+    if setup is None:
+        return
+    (slot_spec, maps) = setup
+    slot = pipeline_utils.SharedLatestSlot('viewer', lock, new_frame, *slot_spec)
+
+    writer = None
+    last_write = 0.0
+    if mjpeg_path is None:
+        cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
+    try:
+        while True:
+            try:
+                if control.get_nowait() is None:
+                    break
+            except queue.Empty:
+                pass
+
+            if mjpeg_path is None:
+                # Keep the window responsive even without new frames
+                key = cv2.waitKey(1)
+                if key == ord('q') or cv2.getWindowProperty(window_title, cv2.WND_PROP_VISIBLE) < 1:
+                    quit.set()
+                    break
+            elif time.time() - last_write < 1 / mjpeg_hz:
+                time.sleep(0.01)
+                continue
+            item = slot.get(0.05)
+            if item is None:
+                continue
+
+            meta = item["meta"]
+            tag_count = int(meta[1])
+            roi = None if meta[2] < 0 else tuple(int(v) for v in meta[2:6])
+            tags = [(int(meta[6 + 9 * i]), meta[7 + 9 * i:15 + 9 * i].reshape(4, 2)) for i in range(tag_count)]
+            image = fisheye_rectify.remap(item["frame"], maps)
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            draw_tags(image, tags, roi)
+
+            if mjpeg_path is None:
+                cv2.imshow(window_title, image)
+            else:
+                if writer is None:
+                    writer = cv2.VideoWriter(mjpeg_path, cv2.VideoWriter_fourcc(*'MJPG'), mjpeg_hz, (image.shape[1], image.shape[0]))
+                writer.write(image)
+                last_write = time.time()
+    finally:
+        if writer is not None:
+            writer.release()
+        slot.close()
+
+class TagViewer(object):
+    # mjpeg_path: write the annotated frames to this file at mjpeg_hz instead of showing them in a window
+    def __init__(self, window_title, mjpeg_path=None, mjpeg_hz=5):
+        context = pipeline_utils.fork_context()
+        self.control = context.Queue()
+        self.lock = context.Lock()
+        self.new_frame = context.Event()
+        self.quit = context.Event()
+        self.slot = None
+        self.process = context.Process(target=viewer_main, name="tag_viewer",
+                                       args=(self.control, self.lock, self.new_frame, self.quit, window_title, mjpeg_path, mjpeg_hz))
+        self.process.daemon = True
+        self.process.start()
+        self.meta = np.zeros(meta_size)
+
+    # Shape of the published frames and the maps that rectify them into the image the corners are given in
+    def setup(self, frame_shape, maps):
+        self.slot = pipeline_utils.SharedLatestSlot('viewer', self.lock, self.new_frame,
+                                                    {"meta": ((meta_size,), np.float64), "frame": (frame_shape, np.uint8)})
+        self.control.put((self.slot.spec(), maps))
+
+    # Never waits: the frame is dropped if the viewer is reading the slot. tags: list of (tag_id, corners)
+    def publish(self, frame_number, raw_frame, tags, roi=None):
+        if self.slot is None:
+            return
+        tags = tags[:max_tags]
+        self.meta[0] = frame_number
+        self.meta[1] = len(tags)
+        self.meta[2:6] = -1 if roi is None else roi
+        for (i, (tag_id, corners)) in enumerate(tags):
+            self.meta[6 + 9 * i] = tag_id
+            self.meta[7 + 9 * i:15 + 9 * i] = np.asarray(corners).ravel()
+        self.slot.put(meta = self.meta, frame = raw_frame)
+
+    # The window was closed or `q` was pressed
+    def quit_requested(self):
+        return self.quit.is_set()
+
+    def close(self):
+        self.control.put(None)
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+        if self.slot is not None:
+            self.slot.close()
+
+    def report(self):
+        if self.slot is None:
+            return "INFO: Viewer: not set up"
+        return self.slot.report()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Tests of pipeline_utils                       ##
+#####################################################
+# python3 -m pytest test_pipeline_utils.py, or python3 test_pipeline_utils.py
+
+import unittest
+
+import pipeline_utils
+
+# Runs frames through the scheduler, the main work taking work_sec and a skipped frame skip_sec
+def run_frames(scheduler, num_frames, work_sec, skip_sec=0.001):
+    for i in range(num_frames):
+        (do_work, prefer_cheap, do_optional) = scheduler.plan()
+        scheduler.end_frame(work_sec if do_work else skip_sec, do_work)
+
+class DeadlineSchedulerTest(unittest.TestCase):
+    def test_skips_more_frames_while_the_work_misses(self):
+        # Detections of 60 ms against a 33 ms budget: the skipped frames must not reset the misses
+        scheduler = pipeline_utils.DeadlineScheduler('test', 0.033)
+        run_frames(scheduler, 300, 0.060)
+        self.assertEqual(scheduler.level, 3)
+        self.assertEqual(scheduler.work_every, scheduler.max_skip)
+        self.assertLess(scheduler.miss_count, 80)
+
+    def test_recovers_when_the_work_fits(self):
+        scheduler = pipeline_utils.DeadlineScheduler('test', 0.033)
+        run_frames(scheduler, 300, 0.060)
+        run_frames(scheduler, 2000, 0.010)
+        self.assertEqual(scheduler.level, 0)
+        self.assertEqual(scheduler.work_every, 1)
+
+if __name__ == "__main__":
+    unittest.main()
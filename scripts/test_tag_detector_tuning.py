@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+#####################################################
+##   Tests of tag_detector_tuning                  ##
+#####################################################
+# python3 -m pytest test_tag_detector_tuning.py, or python3 test_tag_detector_tuning.py
+
+import os
+import types
+import tempfile
+import unittest
+
+import numpy as np
+
+import tag_detector_tuning
+
+# Stand-in for apriltags3.Detector that finds the tags given per frame, by the mean of the frame
+class FakeDetector(object):
+    def __init__(self, tags_per_frame):
+        self.tags_per_frame = tags_per_frame
+        self.tag_detector_ptr = types.SimpleNamespace(contents = types.SimpleNamespace())
+        self.params = {}
+
+    def detect(self, frame, estimate_tag_pose=False, camera_params=None, tag_size=None):
+        corners = np.array([[10.0, 10.0], [20.0, 10.0], [20.0, 20.0], [10.0, 20.0]])
+        return [types.SimpleNamespace(tag_id = tag_id, corners = corners) for tag_id in self.tags_per_frame[int(frame.mean())]]
+
+class TuneAndStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.store = tag_detector_tuning.TuningStore(os.path.join(directory, 'tuning.json'))
+
+    def frames(self, count, value):
+        return [np.full((30, 30), value, dtype=np.uint8) for i in range(count)]
+
+    def tune_and_store(self, detector, frames, tag_ids):
+        return tag_detector_tuning.tune_and_store(self.store, detector, frames, (30, 30), [100, 100, 15, 15], 0.1, 1.0,
+                                                  tag_ids = tag_ids, min_frames = 3, verbose = False)
+
+    def test_frames_without_tags_give_no_config(self):
+        detector = FakeDetector({0: []})
+        self.assertIsNone(self.tune_and_store(detector, self.frames(5, 0), [0]))
+        self.assertEqual(self.store.read(), {})
+
+    def test_frames_with_other_tags_give_no_config(self):
+        detector = FakeDetector({1: [7]})
+        self.assertIsNone(self.tune_and_store(detector, self.frames(5, 1), [0]))
+        self.assertEqual(self.store.read(), {})
+
+    def test_frames_with_the_tag_are_tuned_and_stored(self):
+        detector = FakeDetector({0: [], 1: [0]})
+        config = self.tune_and_store(detector, self.frames(2, 0) + self.frames(3, 1), [0])
+        self.assertIsNotNone(config)
+        self.assertEqual(self.store.load(1.0, (30, 30)), config)
+
+    def test_shows_tags(self):
+        detector = FakeDetector({0: [], 1: [7]})
+        self.assertFalse(tag_detector_tuning.shows_tags(detector, self.frames(1, 0)[0]))
+        self.assertTrue(tag_detector_tuning.shows_tags(detector, self.frames(1, 1)[0]))
+        self.assertFalse(tag_detector_tuning.shows_tags(detector, self.frames(1, 1)[0], [0]))
+
+if __name__ == "__main__":
+    unittest.main()
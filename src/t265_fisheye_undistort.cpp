@@ -6,6 +6,13 @@
 #include <message_filters/sync_policies/approximate_time.h>
 #include <opencv2/opencv.hpp>
 #include <opencv2/highgui/highgui.hpp>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
 
 using namespace cv;
 using namespace std;
@@ -17,6 +24,133 @@ enum class CameraSide { LEFT, RIGHT };
 //////////////////////////////////////////////////
 Mat lmapx, lmapy, rmapx, rmapy;
 
+//////////////////////////////////////////////////
+// Cache of the rectification maps on disk.
+// Building the maps takes a while and a lot of temporary memory on small companion computers. The maps of each
+// camera are saved to a file together with a hash of the calibration, the output size and the OpenCV version.
+// On the next start the file is memory-mapped instead of recomputing the maps, as long as the hash matches,
+// otherwise the maps are rebuilt and the file overwritten.
+//////////////////////////////////////////////////
+struct MapCacheHeader
+{
+  char magic[8];
+  uint64_t key;
+  int32_t rows, cols, type1, type2;
+  uint64_t bytes1, bytes2;
+};
+
+const char map_cache_magic[8] = {'T', '2', '6', '5', 'M', 'A', 'P', '1'};
+
+// FNV-1a, enough to detect a changed calibration
+uint64_t hash_bytes(uint64_t hash, const void* data, size_t len)
+{
+  const unsigned char* bytes = static_cast<const unsigned char*>(data);
+  for (size_t i = 0; i < len; i++)
+  {
+    hash ^= bytes[i];
+    hash *= 1099511628211ULL;
+  }
+  return hash;
+}
+
+uint64_t rectification_key(const vector<Mat>& calibration, const Size& output_img_size)
+{
+  uint64_t hash = 14695981039346656037ULL;
+  for (const Mat& mat : calibration)
+  {
+    Mat values;
+    mat.convertTo(values, CV_64F);
+    values = values.clone();  // continuous
+    hash = hash_bytes(hash, values.data, values.total() * values.elemSize());
+  }
+  hash = hash_bytes(hash, &output_img_size.width, sizeof(output_img_size.width));
+  hash = hash_bytes(hash, &output_img_size.height, sizeof(output_img_size.height));
+  return hash_bytes(hash, CV_VERSION, strlen(CV_VERSION));
+}
+
+// The mapping stays valid for the lifetime of the node, map1 and map2 point into it
+bool load_cached_maps(const string& path, uint64_t key, const Size& size, Mat& map1, Mat& map2)
+{
+  int fd = open(path.c_str(), O_RDONLY);
+  if (fd < 0)
+  {
+    return false;
+  }
+  struct stat st;
+  if (fstat(fd, &st) != 0 || st.st_size < (off_t)sizeof(MapCacheHeader))
+  {
+    close(fd);
+    return false;
+  }
+  void* data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (data == MAP_FAILED)
+  {
+    return false;
+  }
+
+  const MapCacheHeader* header = static_cast<const MapCacheHeader*>(data);
+  if (memcmp(header->magic, map_cache_magic, sizeof(map_cache_magic)) != 0 || header->key != key ||
+      header->rows != size.height || header->cols != size.width ||
+      header->type1 != CV_32FC1 || header->type2 != CV_32FC1 ||
+      header->bytes1 != (uint64_t)size.area() * 4 || header->bytes2 != (uint64_t)size.area() * 4 ||
+      (uint64_t)st.st_size != sizeof(MapCacheHeader) + header->bytes1 + header->bytes2)
+  {
+    munmap(data, st.st_size);
+    return false;
+  }
+
+  unsigned char* payload = static_cast<unsigned char*>(data) + sizeof(MapCacheHeader);
+  map1 = Mat(size, CV_32FC1, payload);
+  map2 = Mat(size, CV_32FC1, payload + header->bytes1);
+  return true;
+}
+
+// Write to a temporary file first, so a crash never leaves a half-written file behind
+bool save_cached_maps(const string& path, uint64_t key, const Mat& map1, const Mat& map2)
+{
+  MapCacheHeader header;
+  memcpy(header.magic, map_cache_magic, sizeof(map_cache_magic));
+  header.key    = key;
+  header.rows   = map1.rows;
+  header.cols   = map1.cols;
+  header.type1  = map1.type();
+  header.type2  = map2.type();
+  header.bytes1 = map1.total() * map1.elemSize();
+  header.bytes2 = map2.total() * map2.elemSize();
+
+  string tmp_path = path + ".tmp";
+  FILE* file = fopen(tmp_path.c_str(), "wb");
+  if (file == NULL)
+  {
+    return false;
+  }
+  bool ok = fwrite(&header, sizeof(header), 1, file) == 1 &&
+            fwrite(map1.data, header.bytes1, 1, file) == 1 &&
+            fwrite(map2.data, header.bytes2, 1, file) == 1;
+  ok = (fclose(file) == 0) && ok;
+  return ok && rename(tmp_path.c_str(), path.c_str()) == 0;
+}
+
+void init_camera_maps(const string& cache_path, uint64_t key, const Mat& K, const Mat& D, const Mat& R, const Mat& P,
+                      const Size& output_img_size, Mat& map1, Mat& map2)
+{
+  if (!cache_path.empty() && load_cached_maps(cache_path, key, output_img_size, map1, map2))
+  {
+    ROS_INFO("Using cached rectification maps from %s", cache_path.c_str());
+    return;
+  }
+
+  // Float maps: fixed-point maps (CV_16SC2) are a quarter smaller but remap slower on x86, and have not been
+  // measured faster on an ARM board yet, see scripts/fisheye_rectify.py
+  fisheye::initUndistortRectifyMap(K, D, R, P, output_img_size, CV_32FC1, map1, map2);
+
+  if (!cache_path.empty() && !save_cached_maps(cache_path, key, map1, map2))
+  {
+    ROS_WARN("Could not cache rectification maps in %s", cache_path.c_str());
+  }
+}
+
 image_transport::Publisher pub_img_rect_left, pub_img_rect_right;
 
 sensor_msgs::CameraInfo output_camera_info_left, output_camera_info_right;
@@ -28,7 +162,7 @@ ros::Publisher left_camera_info_output_pub, right_camera_info_output_pub;
 // using the stereoRectify and initUndistortRectifyMap functions respectively.
 // See documentation for stereoRectify: https://docs.opencv.org/2.4/modules/calib3d/doc/camera_calibration_and_3d_reconstruction.html#stereorectify
 //////////////////////////////////////////////////
-void init_rectification_map(string param_file_path) 
+void init_rectification_map(string param_file_path, string map_cache_dir) 
 {
   Mat Q, P1, P2;
   Mat R1, R2, K1, K2, D1, D2, R;
@@ -62,8 +196,16 @@ void init_rectification_map(string param_file_path)
                 alpha, 
                 output_img_size);
  
-  fisheye::initUndistortRectifyMap(K1, D1, R1, P1, output_img_size, CV_32FC1, lmapx, lmapy);
-  fisheye::initUndistortRectifyMap(K2, D2, R2, P2, output_img_size, CV_32FC1, rmapx, rmapy);
+  // The maps only depend on the calibration and the output size
+  uint64_t key = rectification_key({K1, D1, K2, D2, R, Mat(T), Mat(size_input), Mat(size_output)}, output_img_size);
+  string left_cache_path, right_cache_path;
+  if (!map_cache_dir.empty())
+  {
+    left_cache_path  = map_cache_dir + "/t265_undistort_left.map";
+    right_cache_path = map_cache_dir + "/t265_undistort_right.map";
+  }
+  init_camera_maps(left_cache_path,  key, K1, D1, R1, P1, output_img_size, lmapx, lmapy);
+  init_camera_maps(right_cache_path, key, K2, D2, R2, P2, output_img_size, rmapx, rmapy);
 
   // Copy the parameters for rectified images to the camera_info messages
   output_camera_info_left.width   = size_output[0];
@@ -153,8 +295,27 @@ int main(int argc, char **argv)
     return 0;
   }
 
+  // Rectification maps are cached in this directory, an empty string disables the cache
+  string default_map_cache_dir;
+  const char* ros_home = getenv("ROS_HOME");
+  const char* home = getenv("HOME");
+  if (ros_home != NULL)
+  {
+    default_map_cache_dir = ros_home;
+  }
+  else if (home != NULL)
+  {
+    default_map_cache_dir = string(home) + "/.ros";
+  }
+  string map_cache_dir;
+  nh.param<string>("map_cache_dir", map_cache_dir, default_map_cache_dir);
+  if (!map_cache_dir.empty())
+  {
+    mkdir(map_cache_dir.c_str(), 0755);
+  }
+
   // Read the input parameters and perform initialization
-  init_rectification_map(param_file_path);
+  init_rectification_map(param_file_path, map_cache_dir);
 
   // The raw stereo images should be published as type sensor_msgs/Image
   image_transport::ImageTransport it(nh);